@@ -0,0 +1,162 @@
+""" Benchmarks the throughput and latency of the reconstruction models on CPU, for
+different model names, batch sizes and numbers of threads. Uses synthetic stand-ins
+for the external data (see ``flame.data.synthetic``), so it can run on any machine.
+
+Examples
+--------
+Run the benchmarks and store the results (in ``benchmarks/results``)::
+
+    python benchmarks/bench_recon.py run --models emoca-coarse,mica --batch-sizes 1,8 --threads 1,4
+
+Compare two runs::
+
+    python benchmarks/bench_recon.py compare results/a.json results/b.json
+"""
+
+import os
+import sys
+import json
+import time
+import click
+import socket
+import platform
+import subprocess
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+
+HERE = Path(__file__).parent
+MODELS = ['mica', 'deca-coarse', 'deca-dense', 'emoca-coarse', 'emoca-dense']
+
+
+def _parse_list(value, dtype=str):
+    return [dtype(v) for v in value.split(',') if v]
+
+
+def _get_meta():
+    """ Collects some information about the machine and code version. """
+    import torch
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        commit = None
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'host': socket.gethostname(),
+        'processor': platform.processor(),
+        'n_cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+    }
+
+
+def benchmark_model(model, batch_size, n_iter=10, n_warmup=2):
+    """ Measures the latency (per batch) and throughput (images per second) of a
+    single model for a given batch size. """
+    import torch
+    if model.__class__.__name__ == 'MicaReconModel':
+        images, kwargs = torch.rand(batch_size, 3, 112, 112), {}
+    else:
+        # Pass crop matrix and image size to avoid warnings
+        images = torch.rand(batch_size, 3, 224, 224)
+        kwargs = {'tform': np.tile(np.eye(3), (batch_size, 1, 1)),
+                  'img_size': np.full((batch_size, 2), 224)}
+
+    for _ in range(n_warmup):
+        model.reconstruct(images, **kwargs)
+
+    latencies = []
+    for _ in range(n_iter):
+        t_start = time.perf_counter()
+        model.reconstruct(images, **kwargs)
+        latencies.append(time.perf_counter() - t_start)
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'latency_ms': {
+            'mean': latencies.mean(),
+            'p50': np.percentile(latencies, 50),
+            'p90': np.percentile(latencies, 90),
+            'min': latencies.min(),
+        },
+        'throughput': batch_size / (latencies.mean() / 1000),
+    }
+
+
+@click.group()
+def main():
+    """ Offline (CPU) benchmarks of the reconstruction models. """
+    pass
+
+
+@main.command()
+@click.option('--assets', default=str(HERE / 'assets'), help='Directory with (synthetic) assets')
+@click.option('--models', default=','.join(MODELS), help='Comma-separated model names')
+@click.option('--batch-sizes', default='1,8', help='Comma-separated batch sizes')
+@click.option('--threads', default='1,4', help='Comma-separated numbers of torch threads')
+@click.option('--encoder-mode', default='sequential',
+              type=click.Choice(['sequential', 'stacked', 'threaded']),
+              help='How to run the encoders of the DECA/EMOCA models')
+@click.option('--n-iter', default=10, help='Number of timed iterations')
+@click.option('--n-warmup', default=2, help='Number of warm-up iterations')
+@click.option('--out', default=None, help='Output file (default: results/<date>.json)')
+def run(assets, models, batch_sizes, threads, encoder_mode, n_iter, n_warmup, out):
+    """ Runs the benchmarks and stores the results. """
+    import torch
+    from flame.data.synthetic import create_synthetic_assets
+
+    os.environ['FLAME_CONFIG'] = str(create_synthetic_assets(assets))
+    from flame import DecaReconModel, MicaReconModel
+
+    results = []
+    for name in _parse_list(models):
+        if name == 'mica':
+            model = MicaReconModel(device='cpu')
+        else:
+            model = DecaReconModel(name, device='cpu', encoder_mode=encoder_mode)
+
+        for n_threads in _parse_list(threads, int):
+            torch.set_num_threads(n_threads)
+            for batch_size in _parse_list(batch_sizes, int):
+                res = benchmark_model(model, batch_size, n_iter, n_warmup)
+                res.update({'model': name, 'batch_size': batch_size, 'n_threads': n_threads})
+                results.append(res)
+                click.echo(f"{name:>13} | bs={batch_size:<3} | threads={n_threads:<3} | "
+                           f"{res['latency_ms']['mean']:9.1f} ms/batch | "
+                           f"{res['throughput']:7.2f} img/s")
+
+    if out is None:
+        out = HERE / 'results' / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, 'w') as f_out:
+        meta = {**_get_meta(), 'encoder_mode': encoder_mode}
+        json.dump({'meta': meta, 'results': results}, f_out, indent=2)
+
+    click.echo(f"Saved results to {out}")
+
+
+@main.command()
+@click.argument('baseline', type=click.Path(exists=True))
+@click.argument('candidate', type=click.Path(exists=True))
+def compare(baseline, candidate):
+    """ Compares the throughput of two benchmark runs (CANDIDATE vs. BASELINE). """
+    runs = []
+    for f in (baseline, candidate):
+        with open(f, 'r') as f_in:
+            runs.append({(r['model'], r['batch_size'], r['n_threads']): r
+                         for r in json.load(f_in)['results']})
+
+    for key in sorted(set(runs[0]) & set(runs[1])):
+        base, cand = runs[0][key]['throughput'], runs[1][key]['throughput']
+        click.echo(f"{key[0]:>13} | bs={key[1]:<3} | threads={key[2]:<3} | "
+                   f"{base:7.2f} -> {cand:7.2f} img/s ({cand / base:5.2f}x)")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(HERE.parent))
+    main()
@@ -0,0 +1,104 @@
+""" Benchmarks the (vectorized) torch rasterizer (``flame.renderer.rasterize``) against a
+naive reference, which loops over the triangles (like the threads of the CUDA
+rasterizer), and checks that both give the same buffers. Uses random meshes, so it can
+run on any machine.
+
+Examples
+--------
+::
+
+    python benchmarks/bench_render.py --size 224 --n-tri 2000 --batch-size 2
+"""
+
+import sys
+import time
+import click
+import numpy as np
+from pathlib import Path
+
+HERE = Path(__file__).parent
+
+
+def rasterize_naive(f_vs, h, w):
+    """ Reference rasterizer, which processes one triangle at a time (in the same way as
+    the CUDA kernel) and, for equal depths, keeps the lowest triangle index. """
+    import torch
+    from flame.renderer import _barycentric
+
+    bz, n_tri = f_vs.shape[:2]
+    depth = torch.full((bz, h, w), 1e6, dtype=f_vs.dtype)
+    triangle = torch.full((bz, h, w), -1, dtype=torch.int32)
+    baryw = torch.zeros((bz, h, w, 3), dtype=f_vs.dtype)
+    for b in range(bz):
+        for i in range(n_tri):
+            face = f_vs[b, i]
+            x_min = max(int(face[:, 0].min().ceil()), 0)
+            x_max = min(int(face[:, 0].max().floor()), w - 1)
+            y_min = max(int(face[:, 1].min().ceil()), 0)
+            y_max = min(int(face[:, 1].max().floor()), h - 1)
+            if x_max < x_min or y_max < y_min:
+                continue
+
+            py, px = torch.meshgrid(torch.arange(y_min, y_max + 1), torch.arange(x_min, x_max + 1),
+                                    indexing='ij')
+            p = torch.stack([px.reshape(-1), py.reshape(-1)], dim=-1).to(f_vs.dtype)
+            n = p.shape[0]
+            bary = _barycentric(p, face[0, :2].expand(n, 2), face[1, :2].expand(n, 2),
+                                face[2, :2].expand(n, 2))
+            inside = (bary[:, 2] >= 0) & (bary[:, 1] >= 0) & (bary[:, 0] > 0)
+            z = 1. / (bary / face[:, 2]).sum(dim=-1)
+
+            for (x, y), bw, zp, ins in zip(p.long().tolist(), bary, z, inside):
+                if ins and zp < depth[b, y, x]:
+                    depth[b, y, x] = zp
+                    triangle[b, y, x] = i
+                    baryw[b, y, x] = bw
+
+    return depth, triangle, baryw
+
+
+def random_faces(batch_size, n_tri, size, seed=0):
+    """ Creates random (small) triangles in pixel coordinates, with positive depths. """
+    import torch
+    gen = torch.Generator().manual_seed(seed)
+    centers = torch.rand(batch_size, n_tri, 1, 3, generator=gen) * torch.tensor([size, size, 1.])
+    offsets = (torch.rand(batch_size, n_tri, 3, 3, generator=gen) - 0.5) * torch.tensor([12., 12., 0.1])
+    f_vs = centers + offsets
+    f_vs[..., 2] += 1
+    return f_vs
+
+
+def _time(fn, n_iter):
+    latencies = []
+    for _ in range(n_iter):
+        t_start = time.perf_counter()
+        out = fn()
+        latencies.append(time.perf_counter() - t_start)
+
+    return out, np.mean(latencies) * 1000
+
+
+@click.command()
+@click.option('--size', default=224, help='Width and height of the image')
+@click.option('--n-tri', default=2000, help='Number of triangles per image')
+@click.option('--batch-size', default=2, help='Number of images')
+@click.option('--n-iter', default=5, help='Number of timed iterations (of the torch rasterizer)')
+def main(size, n_tri, batch_size, n_iter):
+    """ Compares the torch rasterizer with the naive reference. """
+    import torch
+    from flame.renderer import rasterize
+
+    f_vs = random_faces(batch_size, n_tri, size)
+    rasterize(f_vs, size, size)  # warm-up
+    (depth, tri, bary), t_torch = _time(lambda: rasterize(f_vs, size, size), n_iter)
+    (depth_ref, tri_ref, bary_ref), t_naive = _time(lambda: rasterize_naive(f_vs, size, size), 1)
+
+    click.echo(f"torch: {t_torch:9.1f} ms | naive: {t_naive:9.1f} ms ({t_naive / t_torch:.1f}x)")
+    click.echo(f"Triangle buffers equal: {torch.equal(tri, tri_ref)}, "
+               f"max. depth diff: {(depth - depth_ref).abs().max():.2e}, "
+               f"max. bary diff: {(bary - bary_ref).abs().max():.2e}")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(HERE.parent))
+    main()
@@ -1,2 +1,3 @@
 from .deca import DecaReconModel
-from .mica import MicaReconModel
\ No newline at end of file
+from .mica import MicaReconModel
+from .identity import IdentityLockedReconModel
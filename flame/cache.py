@@ -0,0 +1,377 @@
+""" Module with caches that skip repeated work: a cache of encoder outputs, such that
+identical (e.g., duplicate images) and, optionally, near-identical (e.g., static
+stretches of a video) crops skip the encoders entirely, and a persistent cache of crop
+parameters, such that reconstructing the same source again (e.g., with another model)
+skips face detection.
+
+Examples
+--------
+>>> from flame import DecaReconModel
+>>> from flame.cache import EncoderCache
+>>> recon_model = DecaReconModel('emoca-coarse', device='cpu')  # doctest: +SKIP
+>>> recon_model.encoder_cache = EncoderCache(max_size=4096, threshold=0.02)  # doctest: +SKIP
+"""
+
+import os
+import torch
+import hashlib
+import threading
+import numpy as np
+import torch.nn.functional as F
+from pathlib import Path
+from collections import OrderedDict
+
+from .crop import FALLBACKS
+from .utils import get_logger
+
+logger = get_logger()
+
+
+def _thumbnail(image, size=16):
+    """ Returns standardized (zero mean, unit variance) grayscale thumbnails of a
+    batch of images (B x 3 x H x W), which are insensitive to noise, compression
+    artifacts and (global) brightness/contrast changes. """
+    thumb = F.adaptive_avg_pool2d(image.float().mean(dim=1, keepdim=True), size).flatten(1)
+    thumb = thumb - thumb.mean(dim=1, keepdim=True)
+    return (thumb / (thumb.std(dim=1, keepdim=True) + 1e-6)).cpu()
+
+
+class EncoderCache:
+    """ A least-recently-used cache of (per-image) encoder outputs, keyed by a hash of
+    the (cropped and preprocessed) input image. Assign it to the ``encoder_cache``
+    attribute of a reconstruction model to use it; it is thread-safe.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of cached images; when full, the least recently used image is
+        evicted
+    threshold : float
+        If not ``None``, an image that is not in the cache also counts as a hit if the
+        root mean squared difference between its (standardized, 16 x 16 grayscale)
+        thumbnail and that of a cached image is below this value; values around 0.02
+        only match (practically) unchanged frames, while larger values also match
+        frames with small movements
+    path : str, Path
+        If not ``None``, a file to persist the cache to (with ``save``), from which it is
+        loaded (if it exists) when the cache is created
+
+    Attributes
+    ----------
+    hits : int
+        Number of (exact or near-duplicate) cache hits
+    misses : int
+        Number of cache misses
+    """
+    def __init__(self, max_size=1024, threshold=None, path=None):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.path = None if path is None else Path(path)
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()  # key -> (thumbnail, outputs, namespace)
+        self._thumbs = None  # stacked thumbnails (and keys) for near-duplicate lookups
+        self._lock = threading.Lock()
+
+        if self.path is not None and self.path.is_file():
+            self._entries = torch.load(self.path, map_location='cpu')
+            logger.info(f"Loaded {len(self._entries)} cached encodings from {self.path}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """ Removes all cached encodings. """
+        with self._lock:
+            self._entries.clear()
+            self._thumbs = None
+
+    @staticmethod
+    def hash(image, namespace=''):
+        """ Returns the key of a single (preprocessed) image, which also depends on the
+        ``namespace`` (e.g., identifying the model that encodes the image). """
+        data = image.detach().to('cpu', torch.float32).contiguous().numpy().tobytes()
+        return hashlib.sha1(namespace.encode() + data).hexdigest()
+
+    def _nearest(self, thumb, namespace):
+        """ Returns the key of the most similar cached image (or ``None``). """
+        if self._thumbs is None:
+            # Entries loaded from disk may not have a thumbnail
+            keys = [key for key, entry in self._entries.items() if entry[0] is not None]
+            thumbs = [self._entries[key][0] for key in keys]
+            self._thumbs = (keys, torch.stack(thumbs) if thumbs else None)
+
+        keys, thumbs = self._thumbs
+        if thumbs is None:
+            return None
+
+        dist = ((thumbs - thumb) ** 2).mean(dim=1).sqrt()
+        # Only match images encoded by the same model
+        for idx in dist.argsort().tolist():
+            if dist[idx] > self.threshold:
+                return None
+
+            if self._entries[keys[idx]][2] == namespace:
+                return keys[idx]
+
+        return None
+
+    def lookup(self, images, namespace=''):
+        """ Looks up a batch of images.
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            A B x 3 x H x W tensor with (preprocessed) images
+        namespace : str
+            Identifies the model that encodes the images
+
+        Returns
+        -------
+        keys : list
+            The key of each image (to be used with ``insert``)
+        outputs : list
+            The cached outputs of each image (or ``None`` for cache misses)
+        """
+        keys = [self.hash(img, namespace) for img in images]
+        thumbs = _thumbnail(images) if self.threshold is not None else [None] * len(keys)
+
+        outputs = []
+        with self._lock:
+            for key, thumb in zip(keys, thumbs):
+                if key not in self._entries and self.threshold is not None:
+                    key = self._nearest(thumb, namespace) or key
+
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    outputs.append(self._entries[key][1])
+                    self.hits += 1
+                else:
+                    outputs.append(None)
+                    self.misses += 1
+
+        return keys, outputs
+
+    def insert(self, keys, images, outputs, namespace=''):
+        """ Adds the outputs of a batch of images (see ``lookup``) to the cache and
+        evicts the least recently used images if the cache is full. """
+        thumbs = _thumbnail(images) if self.threshold is not None else [None] * len(keys)
+
+        with self._lock:
+            for key, thumb, out in zip(keys, thumbs, outputs):
+                self._entries[key] = (thumb, out, namespace)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            self._thumbs = None
+
+    def save(self, path=None):
+        """ Writes the cache to disk (to ``path`` or, if ``None``, the path given
+        when creating the cache). """
+        path = Path(path or self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so that an interrupted write does not
+        # corrupt an existing cache file
+        f_tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with self._lock:
+            torch.save(self._entries, f_tmp)
+
+        os.replace(f_tmp, path)
+
+
+def source_key(path):
+    """ Returns a key that identifies a source (image or video) file, which changes
+    when the file changes. """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return f'{path}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+class CropCache:
+    """ A persistent (SQLite) cache of the crop parameters (crop matrix, landmarks and
+    bounding box) of frames, keyed by the source file, frame index and crop model,
+    such that later runs on the same source (e.g., with another reconstruction
+    model) skip face detection and landmark estimation. Optionally, it also stores the
+    (PNG compressed) crops themselves, which also skips warping.
+
+    Frames in which no face was detected are cached as well (and raise the same
+    ``ValueError`` as the crop model).
+
+    Parameters
+    ----------
+    path : str, Path
+        Path to the SQLite database; if ``None``, ``crops.sqlite`` in the cache
+        directory (see ``flame.utils.get_cache_dir``) is used
+    store_crops : bool
+        Whether to store the crops (as lossless PNGs of the 8-bit crops, which take
+        about 100 KB per 224 x 224 crop)
+
+    Examples
+    --------
+    >>> from flame.crop import FanCropModel
+    >>> crop_model = FanCropModel(device='cpu')  # doctest: +SKIP
+    >>> cache = CropCache()
+    >>> crop = cache.crop(crop_model, img, source_key('my_video.mp4'), 0)  # doctest: +SKIP
+    """
+    def __init__(self, path=None, store_crops=False):
+        from .utils import get_cache_dir
+
+        self.path = Path(path) if path is not None else get_cache_dir() / 'crops.sqlite'
+        self.store_crops = store_crops
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """ The database connection of the current process (connections cannot be
+        shared with forked worker processes). """
+        import sqlite3
+
+        if self._conn is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            # Allows reading while another process (e.g., worker) writes
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS crops (source TEXT, frame INTEGER, '
+                               'model TEXT, detected INTEGER, tform BLOB, img_size BLOB, lm BLOB, '
+                               'bbox BLOB, crop BLOB, PRIMARY KEY (source, frame, model))')
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def __getstate__(self):
+        return {'path': self.path, 'store_crops': self.store_crops}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._conn, self._pid = None, None
+
+    @staticmethod
+    def _model_key(crop_model):
+        return f'{crop_model.__class__.__name__}|{crop_model.target_size[0]}x{crop_model.target_size[1]}'
+
+    def get(self, crop_model, source, frame_idx):
+        """ Returns the cached row (as a dictionary) of a frame or ``None``. """
+        row = self.conn.execute(
+            'SELECT detected, tform, img_size, lm, bbox, crop FROM crops WHERE source=? AND '
+            'frame=? AND model=?', (source, int(frame_idx), self._model_key(crop_model))
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        detected, tform, img_size, lm, bbox, crop = row
+        if not detected:
+            return {'detected': False}
+
+        # `detected` is 1 + the index of the fallback that found the face
+        shapes = {'tform': (3, 3), 'img_size': (2,), 'lm': (-1, 2), 'bbox': (4, 2)}
+        out = {'detected': True, 'crop': crop, 'fallback': FALLBACKS[detected - 1]}
+        for key, data in zip(shapes, (tform, img_size, lm, bbox)):
+            dtype = np.int64 if key == 'img_size' else np.float64
+            out[key] = np.frombuffer(data, dtype=dtype).reshape(shapes[key])
+
+        return out
+
+    def put(self, crop_model, source, frame_idx, out=None):
+        """ Adds the crop output (see ``crop``) of a frame to the cache (which is only
+        written to disk after ``commit``); ``None`` means that no face was detected. """
+        detected = 0 if out is None else FALLBACKS.index(out.get('fallback', 'detected')) + 1
+        row = (source, int(frame_idx), self._model_key(crop_model), detected)
+        if out is None:
+            row += (None,) * 5
+        else:
+            arrays = [out['tform'][0].astype(np.float64), out['img_size'][0].astype(np.int64),
+                      np.asarray(out['lm'][0], dtype=np.float64), out['bbox'][0].astype(np.float64)]
+            crop = self._encode_crop(crop_model, out['img_crop']) if self.store_crops else None
+            row += tuple(arr.tobytes() for arr in arrays) + (crop,)
+
+        self.conn.execute('INSERT OR REPLACE INTO crops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def commit(self):
+        """ Writes the added crops to disk. """
+        self.conn.commit()
+
+    @staticmethod
+    def _encode_crop(crop_model, img_crop):
+        """ Encodes a preprocessed (1 x 3 x H x W) crop as an 8-bit PNG. """
+        import cv2
+        mean, scale = crop_model._crop_norm
+        img = img_crop[0].permute(1, 2, 0).cpu().numpy() * scale + mean
+        _, data = cv2.imencode('.png', np.clip(np.round(img), 0, 255).astype(np.uint8))
+        return data.tobytes()
+
+    @staticmethod
+    def _decode_crop(crop_model, data):
+        """ Decodes a crop encoded with ``_encode_crop`` (and preprocesses it). """
+        import cv2
+        mean, scale = crop_model._crop_norm
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        img = (img.astype(np.float32) - mean) / scale
+        return torch.from_numpy(img.transpose(2, 0, 1).copy())[None].to(crop_model.device)
+
+    def crop(self, crop_model, image, source, frame_idx, track=False, prev=None, max_reuse=5):
+        """ Crops a frame with a crop model, unless it is cached.
+
+        Parameters
+        ----------
+        crop_model : FanCropModel, InsightFaceCropModel
+            The crop model
+        image : np.ndarray
+            The (RGB) frame
+        source : str
+            Key of the source of the frame (see ``source_key``)
+        frame_idx : int
+            Index of the frame in the source
+        track : bool
+            Whether to crop with the crop model's ``crop_tracked`` method (instead of
+            ``crop``)
+        prev : dict
+            Output of the previous frame, passed to ``crop_tracked``
+        max_reuse : int
+            Passed to ``crop_tracked``
+
+        Returns
+        -------
+        out : dict
+            The crop output (see the crop model's ``crop`` or ``crop_tracked`` method)
+
+        Raises
+        ------
+        ValueError
+            If no face was detected (now or in an earlier run)
+        """
+        cached = self.get(crop_model, source, frame_idx)
+        if cached is None:
+            try:
+                if track:
+                    out = crop_model.crop_tracked(image, prev, max_reuse)
+                else:
+                    out = crop_model.crop(image)
+            except ValueError:
+                self.put(crop_model, source, frame_idx, None)
+                raise
+
+            self.put(crop_model, source, frame_idx, out)
+            return out
+
+        if not cached['detected']:
+            raise ValueError("Could not detect any faces!")
+
+        if cached['crop'] is not None:
+            out = {'img_crop': self._decode_crop(crop_model, cached['crop']),
+                   'tform': cached['tform'][np.newaxis, ...],
+                   'img_size': cached['img_size'][np.newaxis, ...]}
+        else:
+            out = crop_model.recrop(image, cached['tform'])
+
+        out['lm'] = cached['lm'][np.newaxis, ...]
+        out['bbox'] = cached['bbox'][np.newaxis, ...]
+        if track:
+            out['fallback'] = cached['fallback']
+            reused = out['fallback'] == 'previous' and prev is not None
+            out['n_reused'] = prev['n_reused'] + 1 if reused else 0
+
+        return out
@@ -0,0 +1,186 @@
+""" Command line interface of the ``flame`` package. Installing the package adds a
+``flame`` command with several subcommands (run ``flame --help`` for an overview). """
+
+import click
+
+RECON_MODELS = ['mica', 'deca-coarse', 'deca-dense', 'emoca-coarse', 'emoca-dense']
+BACKENDS = ['torch', 'jit', 'onnx']
+
+
+def _parse_ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+@click.group()
+def main():
+    """ Command line interface for FLAME-based reconstruction models. """
+    pass
+
+
+@main.command()
+@click.option('--name', default='emoca-coarse', type=click.Choice(RECON_MODELS),
+              help='Name of the reconstruction model')
+@click.option('--device', default='cuda', type=click.Choice(['cuda', 'cpu']),
+              help='Device to run the models on')
+@click.option('--host', default='127.0.0.1', help='Host to listen on')
+@click.option('--port', default=8000, help='Port to listen on')
+@click.option('--socket', default=None, help='Unix socket to listen on (instead of host/port)')
+@click.option('--max-batch-size', default=8, help='Maximum number of images per batch')
+@click.option('--max-wait', default=10., help='Maximum time (in ms) to wait to fill a batch')
+@click.option('--output', default='mesh', type=click.Choice(['mesh', 'params']),
+              help='Return vertices and matrices (mesh) or parameters (params)')
+@click.option('--n-crop-threads', default=4, help='Number of threads used for cropping')
+@click.option('--backend', default='torch', type=click.Choice(BACKENDS),
+              help='Backend of the reconstruction model')
+@click.option('--max-body-size', default=16., help='Maximum size (in MB) of a request body')
+def serve(name, device, host, port, socket, max_batch_size, max_wait, output, n_crop_threads,
+          backend, max_body_size):
+    """ Starts a micro-batching reconstruction server. """
+    from .server import serve as _serve
+    _serve(name, device, host, port, socket, max_batch_size, max_wait / 1000, output,
+           n_crop_threads, backend, int(max_body_size * 2 ** 20))
+
+
+@main.command()
+@click.argument('source', type=click.Path(exists=True))
+@click.argument('out_dir', type=click.Path())
+@click.option('--name', default='emoca-coarse', type=click.Choice(RECON_MODELS),
+              help='Name of the reconstruction model')
+@click.option('--device', default='cuda', type=click.Choice(['cuda', 'cpu']),
+              help='Device to run the models on')
+@click.option('--batch-size', default=None, type=int,
+              help='Number of images reconstructed at once (default: tuned value or 8)')
+@click.option('--chunk-size', default=256, help='Number of frames per output chunk')
+@click.option('--n-workers', default=1, help='Number of worker processes, each processing '
+                                             'a separate segment of frames (CPU only)')
+@click.option('--n-threads', default=None, type=int, help='Number of torch threads per worker')
+@click.option('--quantize', default=None, type=click.Path(exists=True),
+              help='Directory with cropped images to calibrate int8 encoders with (CPU only)')
+@click.option('--max-error-mm', default=None, type=float,
+              help='Only use the int8 encoders if their max. vertex error is below this value')
+@click.option('--backend', default='torch', type=click.Choice(BACKENDS),
+              help='Backend of the reconstruction model')
+@click.option('--encoder-cache', default=0, help='Number of encodings to cache, such that '
+                                                 'duplicate frames are only encoded once')
+@click.option('--near-dup-threshold', default=None, type=float,
+              help='Also reuse the encodings of near-duplicate frames (see EncoderCache)')
+@click.option('--crop-cache', is_flag=True,
+              help='Cache the crop parameters (in the cache directory), such that later runs on '
+                   'the same source (e.g., with another model) skip face detection')
+@click.option('--store-crops', is_flag=True, help='Also store the crops in the crop cache')
+@click.option('--max-reuse', default=5, help='Max. number of consecutive frames without a '
+                                             'detected face that reuse an earlier face location')
+@click.option('--texture', is_flag=True, help='Also extract the (UV) texture of each frame and '
+                                              'save the average texture (not for MICA)')
+def recon(source, out_dir, name, device, batch_size, chunk_size, n_workers, n_threads, quantize,
+          max_error_mm, backend, encoder_cache, near_dup_threshold, crop_cache, store_crops,
+          max_reuse, texture):
+    """ Reconstructs all frames from SOURCE (an image directory or video file) and
+    stores the results in OUT_DIR; interrupted jobs can be resumed by running the
+    same command again. Unless given explicitly, the batch size and number of threads
+    (of a single worker) are taken from ``flame tune`` (if run on this machine). """
+    from .pipeline import ReconPipeline
+    from .tuning import load_tuning
+
+    from .cache import CropCache
+
+    cache = CropCache(store_crops=store_crops) if crop_cache or store_crops else None
+    pipeline = ReconPipeline(name, device, batch_size or 8, backend, cache, max_reuse, texture)
+    tuning = load_tuning(pipeline.recon_model)
+    if tuning is not None:
+        if batch_size is None:
+            pipeline.batch_size = tuning['batch_size']
+
+        if n_threads is None and n_workers == 1:
+            pipeline.recon_model.set_num_threads(tuning['n_threads'])
+
+    if encoder_cache > 0:
+        from .cache import EncoderCache
+        pipeline.recon_model.encoder_cache = EncoderCache(encoder_cache, near_dup_threshold)
+
+    if quantize is not None:
+        pipeline.recon_model.quantize(quantize, max_error_mm=max_error_mm,
+                                       batch_size=pipeline.batch_size)
+
+    pipeline.run(source, out_dir, chunk_size, n_workers, n_threads)
+
+
+@main.command()
+@click.argument('calib_dir', type=click.Path(exists=True))
+@click.option('--name', default='emoca-coarse', type=click.Choice(RECON_MODELS),
+              help='Name of the reconstruction model')
+@click.option('--eval-dir', default=None, type=click.Path(exists=True),
+              help='Directory with cropped images to evaluate on (default: CALIB_DIR)')
+@click.option('--batch-size', default=16, help='Batch size for calibration and evaluation')
+@click.option('--out', default=None, type=click.Path(), help='Output file (JSON) for the report')
+def quantize(calib_dir, name, eval_dir, batch_size, out):
+    """ Quantizes the encoders of a reconstruction model (to int8, on CPU) using the
+    cropped images in CALIB_DIR for calibration and reports the resulting vertex
+    error (in mm) and speedup. """
+    import json
+    from . import DecaReconModel, MicaReconModel
+
+    if name == 'mica':
+        recon_model = MicaReconModel(device='cpu')
+    else:
+        recon_model = DecaReconModel(name, device='cpu')
+
+    report = recon_model.quantize(calib_dir, eval_dir, batch_size=batch_size)
+    click.echo(json.dumps(report, indent=2))
+
+    if out is not None:
+        with open(out, 'w') as f_out:
+            json.dump(report, f_out, indent=2)
+
+
+@main.command()
+@click.option('--name', default='emoca-coarse', type=click.Choice(RECON_MODELS),
+              help='Name of the reconstruction model')
+@click.option('--device', default='cpu', type=click.Choice(['cuda', 'cpu']),
+              help='Device to run the models on')
+@click.option('--backend', default='torch', type=click.Choice(BACKENDS),
+              help='Backend of the reconstruction model')
+@click.option('--batch-sizes', default='1,2,4,8,16', help='Comma-separated batch sizes to try')
+@click.option('--threads', default=None, help='Comma-separated numbers of threads to try '
+                                              '(default: powers of two up to the number of cores)')
+@click.option('--n-iter', default=5, help='Number of timed runs per setting')
+@click.option('--max-latency-ms', default=None, type=float,
+              help='Only consider settings with a latency (per batch) below this value')
+def tune(name, device, backend, batch_sizes, threads, n_iter, max_latency_ms):
+    """ Finds the number of threads and batch size with the highest throughput on this
+    machine and stores them (in the cache directory) for later runs. """
+    from . import DecaReconModel, MicaReconModel
+    from .tuning import autotune
+
+    if name == 'mica':
+        recon_model = MicaReconModel(device=device, backend=backend)
+    else:
+        recon_model = DecaReconModel(name, device=device, backend=backend)
+
+    n_threads = None if threads is None else _parse_ints(threads)
+    best = autotune(recon_model, _parse_ints(batch_sizes), n_threads, n_iter, max_latency_ms)
+    click.echo(f"Best: n_threads={best['n_threads']}, batch_size={best['batch_size']} "
+               f"({best['throughput']:.1f} img/s, {best['latency_ms']:.1f} ms/batch)")
+
+
+@main.command()
+@click.argument('out_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('f_out', type=click.Path())
+@click.option('--source', default=None, type=click.Path(exists=True),
+              help='Image directory or video that was reconstructed (default: from the manifest)')
+@click.option('--device', default='cpu', type=click.Choice(['cuda', 'cpu']),
+              help='Device to render on')
+@click.option('--batch-size', default=32, help='Number of frames rendered at once')
+@click.option('--scale', default=1., help='Factor to resize the frames with (e.g., 0.5)')
+@click.option('--fps', default=None, type=float, help='Frame rate (default: that of the source)')
+def qc(out_dir, f_out, source, device, batch_size, scale, fps):
+    """ Renders a quality control video (F_OUT) of the results of ``flame recon`` in
+    OUT_DIR, which overlays the reconstructed meshes, landmarks and crop boxes onto the
+    original frames. """
+    from .qc import render_qc_video
+
+    render_qc_video(out_dir, f_out, source, batch_size, device, fps, scale=scale)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,51 @@
+import os
+import time
 import yaml
+import contextlib
 import torch
+import numpy as np
 from pathlib import Path
 from abc import ABCMeta, abstractmethod
 
+from .utils import get_logger
 
-class FlameReconModel(metaclass=ABCMeta):
+logger = get_logger()
 
-    def _load_cfg(self):
-        """ Loads a (default) config file. """
-        data_dir = Path(__file__).parent / 'data'
-        cfg = data_dir / 'config.yaml'
 
-        if not cfg.is_file():
-            raise ValueError(f"Could not find {str(cfg)}! "
-                              "Did you run the validate_external_data.py script?")
+def load_config():
+    """ Loads the (default) config file with the paths to the external data; a different
+    config file can be used by setting the ``FLAME_CONFIG`` environment variable to its
+    path. """
+    data_dir = Path(__file__).parent / 'data'
+    cfg = Path(os.environ.get('FLAME_CONFIG', data_dir / 'config.yaml'))
+
+    if not cfg.is_file():
+        raise ValueError(f"Could not find {str(cfg)}! "
+                          "Did you run the validate_external_data.py script?")
+
+    with open(cfg, "r") as f_in:
+        return yaml.safe_load(f_in)
+
+
+class FlameReconModel(metaclass=ABCMeta):
+
+    # Optional cache of encoder outputs (see flame.cache.EncoderCache)
+    encoder_cache = None
 
-        with open(cfg, "r") as f_in:
-            self.cfg = yaml.safe_load(f_in)
+    def _load_cfg(self):
+        """ Loads the config file (see ``load_config``). """
+        self.cfg = load_config()
 
     def _check_input(self, image, expected_wh=(224, 224), dtype=torch.float32):
         """ Assumes that self.device attribute exists. """
         if not torch.is_tensor(image):
-            # Expects a 1 x 224 x 224 x 3 tensor
-            image = torch.from_numpy(image).to(self.device)
+            # Expects a (batch x) 224 x 224 x 3 array
+            image = torch.from_numpy(image)
 
-        # Check data type       
-        image = image.to(dtype=dtype)
+        # Check data type and device
+        image = image.to(device=self.device, dtype=dtype)
 
-        if image.shape[0] != 1:
+        if image.ndim == 3:
             # Add singleton batch dimension
             image = image.unsqueeze(dim=0)
 
@@ -41,6 +59,263 @@ class FlameReconModel(metaclass=ABCMeta):
 
         return image
 
+    def _autocast(self):
+        """ Returns the (autocast) context in which the encoders are run, according
+        to the ``precision`` of the model. """
+        if getattr(self, 'precision', 'float32') == 'bfloat16':
+            return torch.autocast(self.device, dtype=torch.bfloat16)
+
+        return contextlib.nullcontext()
+
+    @property
+    def _memory_format(self):
+        """ The memory format used by the encoders: channels last (NHWC) for the
+        'bfloat16' precision, which is the layout the (oneDNN) CPU kernels use natively,
+        and contiguous otherwise. """
+        if getattr(self, 'precision', 'float32') == 'bfloat16':
+            return torch.channels_last
+
+        return torch.contiguous_format
+
+    def _to_memory_format(self, x):
+        """ Converts an image batch (or convolutional model) to the memory format used
+        by the encoders (see ``_memory_format``); note that models are converted in
+        place. """
+        if self._memory_format == torch.contiguous_format:
+            return x
+
+        if torch.is_tensor(x):
+            return x.contiguous(memory_format=self._memory_format)
+
+        return x.to(memory_format=self._memory_format)
+
+    def share_memory(self):
+        """ Moves all (torch) submodels and tensors to shared memory, such that
+        (forked or spawned) worker processes can use them without copying. """
+        for value in vars(self).values():
+            if isinstance(value, torch.nn.Module):
+                value.share_memory()
+            elif torch.is_tensor(value):
+                value.share_memory_()
+
+        return self
+
+    def warmup(self, batch_sizes=(1,), n_iter=2):
+        """ Runs the model a couple of times on random images (of each given batch size),
+        such that one-time costs (like tracing the graphs of the 'jit' backend and
+        initializing kernels and memory pools) are not incurred by the first real
+        batch(es).
+
+        Parameters
+        ----------
+        batch_sizes : tuple
+            Batch sizes to warm up (e.g., the batch sizes used by a server)
+        n_iter : int
+            Number of runs per batch size
+        """
+        w, h = self._crop_img_size
+        for batch_size in batch_sizes:
+            image = torch.rand(batch_size, 3, h, w, device=self.device)
+            for _ in range(n_iter):
+                self.reconstruct(image, **self._dummy_kwargs(batch_size))
+
+    def reconstruct_faces(self, crops):
+        """ Reconstructs all faces cropped by the crop model's ``crop_faces`` method
+        (i.e., possibly multiple faces from multiple images) in a single batch and
+        groups the results per image.
+
+        Parameters
+        ----------
+        crops : dict
+            Output of ``crop_faces``
+
+        Returns
+        -------
+        out : list
+            A list with, for each image, a dictionary with the same keys as the output of
+            ``reconstruct`` (with the faces of that image along the first dimension), or
+            ``None`` if no face was detected in the image
+        """
+        img_idx = crops['img_idx']
+        groups = [None] * crops['n_images']
+        if img_idx.size == 0:
+            return groups
+
+        out = self.reconstruct(crops['img_crop'], **self._crop_kwargs(crops))
+        for i in np.unique(img_idx):
+            groups[i] = {key: value[img_idx == i] for key, value in out.items()}
+
+        return groups
+
+    def _crop_kwargs(self, crops):
+        """ Extra arguments for ``reconstruct`` from the output of a crop model. """
+        return {}
+
+    def _dummy_kwargs(self, batch_size):
+        """ Extra arguments for ``reconstruct`` when called on random images. """
+        return {}
+
+    def set_num_threads(self, n_threads):
+        """ Sets the number of threads used for inference (by torch and, if the
+        'onnx' backend is used, by onnxruntime). """
+        torch.set_num_threads(n_threads)
+        if getattr(self, 'backend', 'torch') == 'onnx':
+            for graph in (self._encoder_graph, self._decoder_graph):
+                graph.n_threads = n_threads
+                graph._create_session()
+
+    def _update_cache_namespace(self):
+        """ Sets the namespace of the outputs of this model in the ``encoder_cache``, as
+        outputs differ between models (and versions and settings of the same model);
+        computed once (after loading the model), as it involves checking the data files,
+        and again whenever one of the settings (e.g., quantization) changes. """
+        from .export import _cache_key
+        self._cache_namespace = (f"{_cache_key(self)}|{getattr(self, 'backend', 'torch')}|"
+                                 f"{getattr(self, 'precision', 'float32')}|"
+                                 f"{getattr(self, '_quantized', False)}")
+
+    def _encode_cached(self, image):
+        """ Encodes a batch of images, but only runs the encoders for the images that
+        are not in the ``encoder_cache`` (if set). """
+        cache = self.encoder_cache
+        if cache is None:
+            return self._encode(image)
+
+        namespace = self._cache_namespace
+        keys, outputs = cache.lookup(image, namespace)
+        todo = [i for i, out in enumerate(outputs) if out is None]
+        if todo:
+            enc = self._encode(image[todo])
+            # Store a (CPU) copy per image, so that entries do not keep the batch alive
+            if torch.is_tensor(enc):
+                new = [enc[j].cpu().clone() for j in range(len(todo))]
+            else:
+                new = [{k: v[j].cpu().clone() for k, v in enc.items()} for j in range(len(todo))]
+
+            cache.insert([keys[i] for i in todo], image[todo], new, namespace)
+            for i, out in zip(todo, new):
+                outputs[i] = out
+
+        if torch.is_tensor(outputs[0]):
+            return torch.stack(outputs).to(self.device)
+
+        return {k: torch.stack([out[k] for out in outputs]).to(self.device) for k in outputs[0]}
+
+    def _load_crops(self, directory):
+        """ Loads all (already cropped) images from a directory as a preprocessed
+        batch (in the same way as the crop model preprocesses its crops). """
+        from .io import FrameReader
+
+        reader = FrameReader(directory)
+        if reader.is_video or len(reader) == 0:
+            raise ValueError(f"Directory {directory} does not contain any images!")
+
+        mean, scale = self._crop_norm
+        images = [self._check_input((img.astype(np.float32) - mean) / scale, self._crop_img_size)
+                  for _, img in reader.iter_frames()]
+
+        return torch.cat(images)
+
+    def quantize(self, calib_dir, eval_dir=None, max_error_mm=None, batch_size=16):
+        """ Replaces the encoders by (int8) quantized versions for faster inference on
+        CPU and reports the resulting error on the decoded FLAME meshes.
+
+        Parameters
+        ----------
+        calib_dir : str, Path
+            Directory with (already cropped) images used to calibrate the quantized
+            activations (which should be representative of the images the model will
+            be used for; a couple of hundred images is usually enough)
+        eval_dir : str, Path
+            Directory with (cropped) images used to compute the error of the quantized
+            model; if ``None``, the calibration images are used (which may
+            underestimate the error)
+        max_error_mm : float
+            If not ``None``, the maximum acceptable (per-vertex) error in millimeters; if
+            the maximum error of the quantized model is larger, the original (float32)
+            encoders are kept
+        batch_size : int
+            Batch size used for calibration and evaluation
+
+        Returns
+        -------
+        report : dict
+            Dictionary with the number of evaluation images (``"n_images"``), statistics
+            of the per-vertex (Euclidean) error between the float32 and quantized FLAME
+            meshes in millimeters (``"mean_mm"``, ``"median_mm"``, ``"p95_mm"``,
+            ``"p99_mm"``, ``"max_mm"``), the speedup of the encoders
+            (``"encoder_speedup"``), and whether the quantized encoders are used
+            (``"accepted"``)
+
+        Raises
+        ------
+        ValueError
+            If the model does not run on CPU, does not use the 'torch' backend, or does
+            not use 'float32' precision
+        """
+        if self.device != 'cpu':
+            raise ValueError("Quantized models can only run on CPU!")
+
+        if getattr(self, 'backend', 'torch') != 'torch':
+            raise ValueError("Only models with the 'torch' backend can be quantized, "
+                             f"not '{self.backend}'!")
+
+        if getattr(self, 'precision', 'float32') != 'float32':
+            raise ValueError("Only models with 'float32' precision can be quantized!")
+
+        calib = self._load_crops(calib_dir)
+        images = calib if eval_dir is None else self._load_crops(eval_dir)
+
+        v_orig, t_orig = self._flame_vertices(images, batch_size)
+        quantized = self._quantize_encoders(calib, batch_size)
+        # Not every model has all submodels (e.g., `E_stacked` only exists in stacked mode)
+        originals = {name: getattr(self, name, None) for name in quantized}
+
+        for name, model in quantized.items():
+            setattr(self, name, model)
+
+        v_quant, t_quant = self._flame_vertices(images, batch_size)
+
+        # FLAME vertices are in meters
+        error = np.linalg.norm(v_quant - v_orig, axis=-1).ravel() * 1000
+        report = {
+            'n_images': images.shape[0],
+            'mean_mm': float(error.mean()),
+            'median_mm': float(np.median(error)),
+            'p95_mm': float(np.percentile(error, 95)),
+            'p99_mm': float(np.percentile(error, 99)),
+            'max_mm': float(error.max()),
+            'encoder_speedup': t_orig / t_quant,
+            'accepted': bool(max_error_mm is None or error.max() <= max_error_mm),
+        }
+
+        if report['accepted']:
+            # Make sure that (cached) encodings of the original encoders are not reused
+            self._quantized = True
+            self._update_cache_namespace()
+            logger.info(f"Quantized encoders: mean error {report['mean_mm']:.3f} mm, max error "
+                        f"{report['max_mm']:.3f} mm, {report['encoder_speedup']:.2f}x faster")
+        else:
+            logger.warning(f"Max. error of quantized encoders ({report['max_mm']:.3f} mm) is "
+                           f"larger than {max_error_mm} mm; keeping the original encoders")
+            for name, model in originals.items():
+                setattr(self, name, model)
+
+        return report
+
+    def _flame_vertices(self, images, batch_size=16):
+        """ Encodes images and decodes the FLAME vertices (in model space), and
+        returns these together with the total encoding time. """
+        v, t_encode = [], 0.
+        with torch.inference_mode():
+            for start in range(0, images.shape[0], batch_size):
+                t_start = time.perf_counter()
+                enc = self._encode(images[start:start + batch_size])
+                t_encode += time.perf_counter() - t_start
+                v.append(self._decode_flame(enc).cpu().numpy())
+
+        return np.concatenate(v), t_encode
+
     def get_faces(self):
         
         if hasattr(self, 'dense'):
@@ -15,16 +15,21 @@ or the ``insightface`` package [2]_.
 import os
 import cv2
 import math
+import threading
 import contextlib
 import numpy as np
 from pathlib import Path
 from skimage.io import imread
-from skimage.transform import estimate_transform, warp
+from skimage.transform import estimate_transform, warp, SimilarityTransform
 
 from .utils import get_logger
+from .profiling import stage
 
 logger = get_logger()
 
+# How a face was found by ``crop_tracked`` (see ``BaseModel.crop_tracked``)
+FALLBACKS = ['detected', 'local', 'previous', 'low_threshold']
+
 
 class BaseModel:
     
@@ -63,6 +68,143 @@ class BaseModel:
 
         return img
     
+    def _create_bbox(self, lm, scale=1.25):
+        """ Creates a bounding box (bbox) based on the landmarks by creating
+        a box around the outermost landmarks (+10%), as done in the original
+        DECA usage.
+
+        Parameters
+        ----------
+        scale : float
+            Factor to scale the bounding box with
+        """
+        left = np.min(lm[:, 0])
+        right = np.max(lm[:, 0])
+        top = np.min(lm[:, 1])
+        bottom = np.max(lm[:, 1])
+
+        orig_size = (right - left + bottom - top) / 2 * 1.1
+        center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0])
+        size = int(orig_size * scale)
+        return np.array(
+            [
+                [center[0] - size / 2, center[1] - size / 2],  # bottom left
+                [center[0] - size / 2, center[1] + size / 2],  # top left
+                [center[0] + size / 2, center[1] - size / 2],  # bottom right
+                [center[0] + size / 2, center[1] + size / 2],  # top right
+            ]
+        )  
+
+    def crop_tracked(self, image, prev=None, max_reuse=5):
+        """ Crops an image (frame) like ``crop``, but with cheap fallbacks when no face
+        is detected, for use with consecutive video frames. The fallbacks, in order:
+
+        1. ``"local"``: detect the face in a region around the face in the previous
+           frame (which is cheaper than, and often succeeds where, detection in the
+           full image fails, e.g., for small faces)
+        2. ``"previous"``: reuse the face location of the previous frame (at most
+           ``max_reuse`` consecutive frames)
+        3. ``"low_threshold"``: a single detection pass in the full image with a lower
+           detection threshold
+
+        Parameters
+        ----------
+        image : str, Path, np.ndarray
+            The image (path or RGB numpy array)
+        prev : dict
+            Output of ``crop_tracked`` for the previous frame (or ``None``)
+        max_reuse : int
+            Maximum number of consecutive frames for which the face of an earlier
+            frame can be reused
+
+        Returns
+        -------
+        out : dict
+            The output of ``crop`` with the extra keys ``"fallback"`` (see above, or
+            ``"detected"`` if the face was detected normally) and ``"n_reused"`` (the
+            number of consecutive frames that reused an earlier face)
+
+        Raises
+        ------
+        ValueError
+            If no face was found with any of the fallbacks
+        """
+        with stage('load'):
+            img = self._load_image(image)
+
+        out, fallback = self._crop_detected(img), 'detected'
+        if out is None and prev is not None:
+            with stage('fallback'):
+                out, fallback = self._crop_local(img, prev), 'local'
+                if out is None and prev['n_reused'] < max_reuse:
+                    out, fallback = self._crop_previous(img, prev), 'previous'
+
+        if out is None:
+            with stage('fallback'):
+                out, fallback = self._crop_low_threshold(img), 'low_threshold'
+
+        if out is None:
+            raise ValueError("Could not detect any faces!")
+
+        out['fallback'] = fallback
+        out['n_reused'] = prev['n_reused'] + 1 if fallback == 'previous' else 0
+        return out
+
+    @staticmethod
+    def _local_region(img, box, scale=2.):
+        """ Returns a region (x1, y1, x2, y2) of ``scale`` times the size of a box
+        (around the same center), clipped to the image. """
+        center, size = (box[:2] + box[2:]) / 2, (box[2:] - box[:2]).max() * scale
+        x1, y1 = np.maximum(center - size / 2, 0).astype(int)
+        x2, y2 = np.minimum(center + size / 2, img.shape[1::-1]).astype(int)
+        return x1, y1, x2, y2
+
+    @staticmethod
+    def _stack_faces(faces, n_images):
+        """ Stacks the crop outputs of (multiple) faces into a single batch, with the
+        index of the image each face belongs to (``"img_idx"``). """
+        import torch
+
+        out = {'img_idx': np.array([i for i, _ in faces], dtype=np.int64), 'n_images': n_images}
+        if not faces:
+            return out
+
+        for key in faces[0][1]:
+            values = [face[key] for _, face in faces]
+            out[key] = torch.cat(values) if torch.is_tensor(values[0]) else np.concatenate(values)
+
+        return out
+
+    def crop_faces(self, images):
+        """ Crops *all* detected faces in one or more images (unlike ``crop``, which
+        picks a single face per image) as a single batch, which can be reconstructed
+        at once with the reconstruction model's ``reconstruct_faces`` method.
+
+        Parameters
+        ----------
+        images : str, Path, np.ndarray, list
+            An image (path or RGB numpy array) or a list of images
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the same keys as the output of ``crop``, but with all
+            faces concatenated along the first (batch) dimension, and ``"img_idx"``
+            (the index of the image of each face) and ``"n_images"``; only contains the
+            latter two if no face was detected
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+
+        faces = []
+        for i, image in enumerate(images):
+            with stage('load'):
+                img = self._load_image(image)
+
+            faces.extend((i, face) for face in self._crop_all(img))
+
+        return self._stack_faces(faces, len(images))
+
     def close(self):
         
         if hasattr(self, '_warned_about_multiple_faces'):
@@ -80,6 +222,11 @@ class FanCropModel(BaseModel):
     target_size : tuple
         Length 2 tuple with desired width/heigth of cropped image; should be (224, 224)
         for EMOCA and DECA
+    min_detection_confidence : float
+        Minimum confidence of detected faces
+    fallback_confidence : float
+        Minimum confidence of the (last resort) detection pass when no face is
+        detected with ``min_detection_confidence``
     
     Attributes
     ----------
@@ -87,13 +234,22 @@ class FanCropModel(BaseModel):
         The initialized face alignment model from ``face_alignment``, using 2D landmarks    
     """
 
-    def __init__(self, device='cuda', target_size=(224, 224), min_detection_confidence=0.5):
+    # (mean, scale) of the preprocessed crops
+    _crop_norm = (0., 255.)
+
+    # Number of landmarks (``"lm"``) per face
+    n_lm = 68
+
+    def __init__(self, device='cuda', target_size=(224, 224), min_detection_confidence=0.5,
+                 fallback_confidence=0.2):
         from face_alignment import LandmarksType, FaceAlignment
         self.device = device
         self.target_size = target_size
+        self.fallback_confidence = fallback_confidence
         self.model = FaceAlignment(LandmarksType._2D, device=device,
                                    face_detector_kwargs={'filter_threshold': min_detection_confidence})
         self._warned_about_multiple_faces = False
+        self._threshold_lock = threading.Lock()
 
     def _load_image(self, image):
         """Loads image using PIL if it's not already
@@ -101,35 +257,106 @@ class FanCropModel(BaseModel):
         if isinstance(image, (str, Path)):
             image = np.array(imread(image))
 
-        self.img_orig = image
         return image
 
-    def _create_bbox(self, lm, scale=1.25):
-        """ Creates a bounding box (bbox) based on the landmarks by creating
-        a box around the outermost landmarks (+10%), as done in the original
-        DECA usage.
+    def _get_landmarks(self, img, faces=None):
+        """ Detects the faces (unless given) and estimates their landmarks (as two
+        separate stages, which is equivalent to ``get_landmarks_from_image``). Returns
+        a list with the landmarks and detector box (x1, y1, x2, y2) of each face, or
+        ``None`` if no face was detected. """
+        if faces is None:
+            with stage('detection', self.device):
+                faces = self.model.face_detector.detect_from_image(img.copy())
+
+        if len(faces) == 0:
+            return None
+
+        with stage('landmarks', self.device):
+            lm = self.model.get_landmarks_from_image(img.copy(), detected_faces=faces)
+
+        return [(lm_, np.asarray(face[:4], dtype=np.float64)) for lm_, face in zip(lm, faces)]
+
+    def _get_landmarks_low_threshold(self, img):
+        """ Runs ``_get_landmarks`` with the (lower) ``fallback_confidence`` threshold. """
+        detector = self.model.face_detector
+        # Note: older versions of face_alignment have a typo (fiter) in the name
+        attr = 'filter_threshold' if hasattr(detector, 'filter_threshold') else 'fiter_threshold'
+
+        # The threshold is an attribute of the (shared) detector, so only one thread
+        # at a time can change it
+        with self._threshold_lock:
+            threshold = getattr(detector, attr)
+            setattr(detector, attr, min(threshold, self.fallback_confidence))
+            try:
+                return self._get_landmarks(img)
+            finally:
+                setattr(detector, attr, threshold)
+
+    def _select_face(self, faces):
+        """ Picks the largest face (if multiple faces are detected) from the output
+        of ``_get_landmarks``. """
+        if len(faces) > 1:
+            if not self._warned_about_multiple_faces:
+                logger.warning(f"More than one face (i.e., {len(faces)}) detected; "
+                               "picking largest one!")
+                self._warned_about_multiple_faces = True
 
-        Parameters
-        ----------
-        scale : float
-            Factor to scale the bounding box with
-        """
-        left = np.min(lm[:, 0])
-        right = np.max(lm[:, 0])
-        top = np.min(lm[:, 1])
-        bottom = np.max(lm[:, 1])
+            # Definitely not foolproof, but pick the face with the biggest 
+            # bounding box (alternative idea: correlate with canonical bbox)
+            bbox = [self._create_bbox(lm) for lm, _ in faces]
+            areas = np.array([self._get_area(bb) for bb in bbox])
+            return faces[areas.argmax()]
 
-        orig_size = (right - left + bottom - top) / 2 * 1.1
-        center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0])
-        size = int(orig_size * scale)
-        return np.array(
-            [
-                [center[0] - size / 2, center[1] - size / 2],  # bottom left
-                [center[0] - size / 2, center[1] + size / 2],  # top left
-                [center[0] + size / 2, center[1] - size / 2],  # bottom right
-                [center[0] + size / 2, center[1] + size / 2],  # top right
-            ]
-        )  
+        return faces[0]
+
+    def _crop_detected(self, img):
+        faces = self._get_landmarks(img)
+        return None if faces is None else self._crop_face(img, *self._select_face(faces))
+
+    def _crop_low_threshold(self, img):
+        faces = self._get_landmarks_low_threshold(img)
+        return None if faces is None else self._crop_face(img, *self._select_face(faces))
+
+    @staticmethod
+    def _lm_box(lm):
+        """ Returns the box (x1, y1, x2, y2) around a set of landmarks. """
+        return np.r_[lm.min(axis=0), lm.max(axis=0)]
+
+    @staticmethod
+    def _face_box(lm):
+        """ Approximates the detector box (x1, y1, x2, y2) of a face from its landmarks,
+        for outputs without a detector box (e.g., from ``flame.cache.CropCache``). The
+        landmark model moves the center of a box up by 12% of its height (as detector
+        boxes are lower than the landmarks), so the box is moved down by as much. """
+        center = (lm.min(axis=0) + lm.max(axis=0)) / 2
+        size = (lm.max(axis=0) - lm.min(axis=0)).max()
+        center[1] += 0.12 * size
+        return np.r_[center - size / 2, center + size / 2]
+
+    def _crop_local(self, img, prev):
+        box = self._lm_box(prev['lm'][0])
+        x1, y1, x2, y2 = self._local_region(img, box)
+        with stage('detection', self.device):
+            faces = self.model.face_detector.detect_from_image(img[y1:y2, x1:x2].copy())
+
+        if len(faces) == 0:
+            return None
+
+        # Map the boxes back to the full image
+        faces = [np.r_[face[:4] + [x1, y1, x1, y1], face[4:]] for face in faces]
+        return self._crop_face(img, *self._select_face(self._get_landmarks(img, faces)))
+
+    def _crop_previous(self, img, prev):
+        # Reuse the detector box of the previous frame as is; the landmark model
+        # interprets boxes around landmarks differently (tighter and higher), so
+        # deriving the box from the landmarks would drift over consecutive frames
+        if 'face_box' in prev:
+            box = prev['face_box'][0]
+        else:
+            box = self._face_box(prev['lm'][0])
+
+        (lm, _), = self._get_landmarks(img, [box])
+        return self._crop_face(img, lm, box)
 
     def _get_area(self, bbox):
         """ Computes the area of a bounding box in pixels. """         
@@ -139,15 +366,19 @@ class FanCropModel(BaseModel):
         return nx * ny
 
     def _crop(self, img_orig, bbox):
-        """ Using the bounding box (`self.bbox`), crops the image by warping the image
-        based on a similarity transform of the bounding box to the corners of target size
-        image. """
+        """ Using the bounding box, crops the image by warping the image based on a
+        similarity transform of the bounding box to the corners of target size image.
+        Returns both the cropped image and the (similarity) transform. """
         w, h = self.target_size
         dst = np.array([[0, 0], [0, w - 1], [h - 1, 0]])
-        self.tform = estimate_transform("similarity", bbox[:3, :], dst)
+        tform = estimate_transform("similarity", bbox[:3, :], dst)
+        return self._warp(img_orig, tform), tform
 
+    def _warp(self, img_orig, tform):
+        """ Warps the image to the target size with a (similarity) transform. """
         # Note to self: preserve_range needs to be True, because otherwise `warp` will scale the data!
-        return warp(img_orig, self.tform.inverse, output_shape=(w, h), preserve_range=True)
+        w, h = self.target_size
+        return warp(img_orig, tform.inverse, output_shape=(w, h), preserve_range=True)
 
     def _preprocess(self, img_crop):
         """ Transposes (channels, width, height), rescales (/255) the data,
@@ -159,6 +390,113 @@ class FanCropModel(BaseModel):
         img_crop = torch.tensor(img_crop, dtype=torch.float32).to(self.device)
         return img_crop.unsqueeze(0)  # add singleton batch dim
 
+    def crop(self, image):
+        """ Runs all steps of the cropping / preprocessing pipeline necessary for use
+        with Flame-based models such as DECA/EMOCA, without storing anything on the
+        model object (so it is safe to call from multiple threads at the same time).
+
+        Parameters
+        -----------
+        image : str, Path, np.ndarray
+            Either a string or ``pathlib.Path`` object to an image or a numpy array
+            (width x height x 3) representing the already loaded RGB image
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"img_crop"`` (the preprocessed and cropped
+            image as a 1 x 3 x 224 x 224 ``torch.Tensor``), ``"tform"`` (a 1 x 3 x 3
+            array with the crop matrix), ``"img_size"`` (a 1 x 2 array with the
+            original image width and height), ``"lm"`` (a 1 x 68 x 2 array with the
+            landmarks), ``"bbox"`` (a 1 x 4 x 2 array with the bounding box) and
+            ``"face_box"`` (a 1 x 4 array with the box of the face detector)
+
+        Examples
+        --------
+        The outputs can be passed directly to the reconstruction model:
+
+        >>> from flame.data import get_example_img
+        >>> from flame import DecaReconModel
+        >>> crop_model = FanCropModel(device='cpu')
+        >>> out = crop_model.crop(get_example_img())
+        >>> out['img_crop'].shape
+        torch.Size([1, 3, 224, 224])
+        >>> recon_model = DecaReconModel('emoca-coarse', device='cpu')
+        >>> recon = recon_model.reconstruct(out['img_crop'], out['tform'], out['img_size'])
+        """
+
+        # Load image if not already a h x w x 3 numpy array
+        with stage('load'):
+            img_orig = self._load_image(image)
+
+        # Estimate landmarks; if no face is detected, try once more with a lower
+        # detection threshold
+        out = self._crop_detected(img_orig)
+        if out is None:
+            out = self._crop_low_threshold(img_orig)
+
+        if out is None:
+            raise ValueError("Could not detect any faces!")
+
+        return out
+
+    def _crop_face(self, img_orig, lm, face_box):
+        """ Crops a single face given its landmarks and detector box and returns the
+        output of ``crop``. """
+        # Create bounding box based on landmarks, use that to crop image, and return
+        # preprocessed (normalized, to tensor) image
+        bbox = self._create_bbox(lm)
+        with stage('warp'):
+            img_crop, tform = self._crop(img_orig, bbox)
+
+        with stage('preprocess', self.device):
+            img_crop = self._preprocess(img_crop)
+
+        h, w = img_orig.shape[:2]
+        return {
+            'img_crop': img_crop,
+            'tform': tform.params[np.newaxis, ...],
+            'img_size': np.array([[w, h]]),
+            'lm': lm[np.newaxis, ...],
+            'bbox': bbox[np.newaxis, ...],
+            'face_box': face_box[np.newaxis, ...],
+        }
+
+    def _crop_all(self, img_orig):
+        """ Crops all detected faces in an image (see ``crop_faces``). """
+        faces = self._get_landmarks(img_orig)
+        return [] if faces is None else [self._crop_face(img_orig, lm, box) for lm, box in faces]
+
+    def recrop(self, image, tform):
+        """ Crops an image with a known crop matrix (e.g., from an earlier ``crop``
+        of the same image, see ``flame.cache.CropCache``), which skips the (expensive)
+        detection and landmark estimation.
+
+        Parameters
+        ----------
+        image : str, Path, np.ndarray
+            Path to an image or a numpy array (height x width x 3) with the RGB image
+        tform : np.ndarray
+            A 3 x 3 array with the crop matrix
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"img_crop"``, ``"tform"`` and ``"img_size"``
+            (see ``crop``)
+        """
+        with stage('load'):
+            img_orig = self._load_image(image)
+
+        with stage('warp'):
+            img_crop = self._warp(img_orig, SimilarityTransform(matrix=tform))
+
+        with stage('preprocess', self.device):
+            img_crop = self._preprocess(img_crop)
+
+        h, w = img_orig.shape[:2]
+        return {'img_crop': img_crop, 'tform': tform[np.newaxis, ...], 'img_size': np.array([[w, h]])}
+
     def __call__(self, image):
         """ Runs all steps of the cropping / preprocessing pipeline
         necessary for use with Flame-based models such as DECA/EMOCA. 
@@ -174,6 +512,13 @@ class FanCropModel(BaseModel):
         torch.Tensor
             The preprocessed (normalized) and cropped image as a ``torch.Tensor``
             of shape (1, 3, 224, 224), as EMOCA expects (the 1 is the batch size)
+
+        Notes
+        -----
+        This method stores the original image (``img_orig``), crop transform
+        (``tform``), landmarks (``lm``) and bounding box (``bbox``) on the model
+        object; use the ``crop`` method instead when using the model from multiple
+        threads.
         
         Examples
         --------
@@ -187,44 +532,18 @@ class FanCropModel(BaseModel):
         torch.Size([1, 3, 224, 224])
         """
 
-        # Load image if not already a h x w x 3 numpy array
         img_orig = self._load_image(image)
+        out = self.crop(img_orig)
 
-        # Estimate landmarks
-        lm = self.model.get_landmarks_from_image(img_orig.copy())
-        if lm is None:
-            # Try decreasing detection threshold    
-            while lm is None:
-                # Note: typo (fiter) in original face_alignment source code
-                self.face_detector.fiter_threshold -= 0.1
-                if self.face_detector.fiter_threshold < 0:
-                    raise ValueError("Could not detect any faces!")
-                lm = self.model.get_landmarks_from_image(img_orig.copy())
-        
-        elif len(lm) > 1:
-            if not self._warned_about_multiple_faces:
-                logger.warning(f"More than one face (i.e., {len(lm)}) detected; "
-                               "picking largest one!")
-                self._warned_about_multiple_faces = True
-
-            # Definitely not foolproof, but pick the face with the biggest 
-            # bounding box (alternative idea: correlate with canonical bbox)
-            bbox = [self._create_bbox(lm_) for lm_ in lm]
-            areas = np.array([self._get_area(bb) for bb in bbox])
-            idx = areas.argmax()
-            lm, bbox = lm[idx], bbox[idx]                        
-        else:
-            lm = lm[0]
-            bbox = self._create_bbox(lm)
-        
-        # Create bounding box based on landmarks, use that to crop image, and return
-        # preprocessed (normalized, to tensor) image        
-        img_crop = self._crop(img_orig, bbox)
-        return self._preprocess(img_crop)
+        self.img_orig = img_orig
+        self.tform = SimilarityTransform(matrix=out['tform'][0])
+        self.lm, self.bbox = out['lm'][0], out['bbox'][0]
+        return out['img_crop']
 
     def viz_qc(self, f_out=None, return_rgba=False):
-        """ Visualizes the inferred 3D landmarks & bounding box, as well as the final
-        cropped image.
+        """ Visualizes the estimated landmarks and bounding box of the last image
+        processed by ``__call__`` (see ``flame.qc.QCRenderer``; to visualize many frames,
+        use ``flame.qc.render_qc_video``).
 
         Parameters
         ----------
@@ -237,51 +556,35 @@ class FanCropModel(BaseModel):
         Returns
         -------
         img : np.ndarray
-            The rendered image as a numpy array (if ``f_out`` is ``None``)
+            The rendered image as a numpy array (if ``return_rgba`` is ``True``)
         
         Examples
         --------
         To visualize the landmark and (EMOCA-style) bounding box:
         
-        >>> from medusa.data import get_example_frame
-        >>> img = get_example_frame()
-        >>> fan = FAN(lm_type='2D')
-        >>> cropped_img = fan.prepare_for_emoca(img) 
-        >>> viz_img = fan.viz_qc(return_rgba=True)
+        >>> from flame.data import get_example_img
+        >>> crop_model = FanCropModel(device='cpu')
+        >>> cropped_img = crop_model(get_example_img())
+        >>> viz_img = crop_model.viz_qc(return_rgba=True)
         >>> viz_img.shape
         (480, 640, 4)
         """
-        import io
-        import matplotlib.pyplot as plt
-        from matplotlib.patches import Rectangle
+        from .qc import QCRenderer
 
         if f_out is None and return_rgba is False:
             raise ValueError("Either supply f_out or set return_rgb to True!")
 
-        fig, ax = plt.subplots(constrained_layout=True)
-        ax.imshow(self.img_orig)
-        ax.axis("off")
-        ax.plot(self.lm[:, 0], self.lm[:, 1], marker="o", ms=2, ls="")
+        if getattr(self, 'lm', None) is None:
+            raise ValueError("No image was processed yet; call the model on an image first!")
+
+        renderer = QCRenderer(faces=None, lm_color=(31, 119, 180))
+        img = renderer.render([self.img_orig.astype(np.uint8)], lm=self.lm[None], bbox=self.bbox[None])[0]
 
-        w = self.bbox[2, 0] - self.bbox[0, 0]
-        h = self.bbox[3, 1] - self.bbox[2, 1]
-        rect = Rectangle(self.bbox[0, :], w, h, facecolor="none", edgecolor="r")
-        ax.add_patch(rect)
-    
         if f_out is not None:
-            fig.savefig(f_out)
-            plt.close()
-        else:
-            io_buf = io.BytesIO()
-            fig.savefig(io_buf, format="raw", dpi=100)
-            io_buf.seek(0)
-            img = np.reshape(
-                np.frombuffer(io_buf.getvalue(), dtype=np.uint8),
-                newshape=(int(fig.bbox.bounds[3]), int(fig.bbox.bounds[2]), -1),
-            )
-            io_buf.close()
-            plt.close()
-            return img
+            cv2.imwrite(str(f_out), img[:, :, ::-1])
+
+        if return_rgba:
+            return np.dstack([img, np.full(img.shape[:2], 255, dtype=np.uint8)])
 
 
 class InsightFaceCropModel(BaseModel):
@@ -295,13 +598,23 @@ class InsightFaceCropModel(BaseModel):
     target_size : tuple
         Length 2 tuple with desired width/heigth of cropped image; should be (112, 112)
         for MICA
+    fallback_confidence : float
+        Minimum confidence of the (last resort) detection pass of ``crop_tracked``
     """    
     
-    def __init__(self, device='cuda', target_size=(112, 112)):
+    # (mean, scale) of the preprocessed crops
+    _crop_norm = (127.5, 127.5)
+
+    # Number of landmarks (keypoints, ``"lm"``) per face
+    n_lm = 5
+
+    def __init__(self, device='cuda', target_size=(112, 112), fallback_confidence=0.2):
         """ Initialize InsightFaceCropModel. """
         self.device = device
         self.target_size = target_size
+        self.fallback_confidence = fallback_confidence
         self.app = None
+        self._threshold_lock = threading.Lock()
         self._setup_model()
 
     def _setup_model(self):
@@ -311,43 +624,185 @@ class InsightFaceCropModel(BaseModel):
             self.app = FaceAnalysis(name='antelopev2', providers=[f'{self.device.upper()}ExecutionProvider'])
             self.app.prepare(ctx_id=0, det_size=(224, 224))  # must be 224x224 (not 112x112)
 
-    def __call__(self, image):
-        import torch
-        from insightface.app.common import Face
-        from insightface.utils import face_align
-        
-        img = cv2.imread(str(image))
-        bboxes, kpss = self.app.det_model.detect(img, max_num=0, metric='default')
+    def _load_image(self, image):
+        """ Loads the image (as BGR, as expected by ``insightface``) if it's not
+        already a numpy array; numpy arrays are assumed to be RGB. """
+        if isinstance(image, (str, Path)):
+            return cv2.imread(str(image))
+
+        return np.ascontiguousarray(image[:, :, ::-1])
+
+    def crop(self, image):
+        """ Detects the face, aligns it to the Arcface template and preprocesses it,
+        without storing anything on the model object (so it is safe to call from
+        multiple threads at the same time).
+
+        Parameters
+        ----------
+        image : str, Path, np.ndarray
+            Either a string or ``pathlib.Path`` object to an image or a numpy array
+            (height x width x 3) representing the already loaded RGB image
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"img_crop"`` (a 1 x 3 x 112 x 112
+            ``torch.Tensor``), ``"tform"`` (a 1 x 3 x 3 array with the alignment
+            matrix), ``"img_size"`` (a 1 x 2 array with the original image width and
+            height), ``"lm"`` (a 1 x 5 x 2 array with the keypoints) and ``"bbox"``
+            (a 1 x 4 x 2 array with the bounding box corners)
+        """
+        with stage('load'):
+            img = self._load_image(image)
+
+        out = self._crop_detected(img)
+        if out is None:
+            raise ValueError("Could not detect any faces!")
+
+        return out
+
+    def _detect(self, img):
+        """ Detects the faces in a (BGR) image and returns their boxes and keypoints. """
+        # Note: the detection model also estimates the (5) landmarks
+        with stage('detection', self.device):
+            return self.app.det_model.detect(img, max_num=0, metric='default')
+
+    def _crop_center(self, img, bboxes, kpss):
+        """ Crops the detected face closest to the image center (if any). """
+        if bboxes.shape[0] == 0:
+            return None
+
         i = self._get_center(bboxes, img)
-        bbox = bboxes[i, 0:4]
-        det_score = bboxes[i, 4]
-        kps = None
-        if kpss is not None:
-            kps = kpss[i]
-        
-        # Crop to target size using keypoints (kps)
-        face = Face(bbox=bbox, kps=kps, det_score=det_score)
-        af_img = face_align.norm_crop(img, landmark=face.kps, image_size=self.target_size[0])
+        return self._crop_face(img, bboxes[i], kpss[i])
+
+    def _crop_detected(self, img):
+        return self._crop_center(img, *self._detect(img))
+
+    def _crop_low_threshold(self, img):
+        det_model = self.app.det_model
+        # The threshold is an attribute of the (shared) detector, so only one thread
+        # at a time can change it
+        with self._threshold_lock:
+            threshold = det_model.det_thresh
+            det_model.det_thresh = min(threshold, self.fallback_confidence)
+            try:
+                return self._crop_detected(img)
+            finally:
+                det_model.det_thresh = threshold
+
+    def _prev_face(self, prev):
+        """ Returns the box (x1, y1, x2, y2) and keypoints of the face in the output
+        of ``crop_tracked`` for the previous frame. """
+        bbox, kps = prev['bbox'][0], prev['lm'][0]
+        return np.r_[bbox.min(axis=0), bbox.max(axis=0)], kps
+
+    def _crop_local(self, img, prev):
+        box = self._prev_face(prev)[0]
+        x1, y1, x2, y2 = self._local_region(img, box)
+        bboxes, kpss = self._detect(np.ascontiguousarray(img[y1:y2, x1:x2]))
+        if bboxes.shape[0] == 0:
+            return None
+
+        # Map the boxes and keypoints back to the full image and pick the face
+        # closest to the previous face (which is not necessarily at the center of
+        # the region, as the region is clipped to the image)
+        bboxes = bboxes + [x1, y1, x1, y1, 0]
+        centers = (bboxes[:, :2] + bboxes[:, 2:4]) / 2
+        i = np.linalg.norm(centers - (box[:2] + box[2:]) / 2, axis=1).argmin()
+        return self._crop_face(img, bboxes[i], kpss[i] + [x1, y1])
+
+    def _crop_previous(self, img, prev):
+        # Reuses the keypoints (and thus the alignment) of the previous frame
+        box, kps = self._prev_face(prev)
+        return self._crop_face(img, np.r_[box, 0.], kps)
+
+    def _crop_face(self, img, bbox, kps):
+        """ Aligns a single face given its keypoints and returns the output of ``crop``. """
+        from insightface.utils import face_align
+
+        # Crop to target size using keypoints (kps); same as `face_align.norm_crop`,
+        # but we want to keep the alignment matrix
+        with stage('warp'):
+            M = face_align.estimate_norm(kps, image_size=self.target_size[0])
+            af_img = self._warp(img, M)
+
+        with stage('preprocess', self.device):
+            af_img = self._preprocess(af_img)
+
+        x1, y1, x2, y2 = bbox[0:4]
+        h, w = img.shape[:2]
+
+        return {
+            'img_crop': af_img,
+            'tform': np.r_[M, [[0, 0, 1]]][np.newaxis, ...],
+            'img_size': np.array([[w, h]]),
+            'lm': kps[np.newaxis, ...],
+            'bbox': np.array([[[x1, y1], [x1, y2], [x2, y1], [x2, y2]]]),
+        }
+
+    def _crop_all(self, img):
+        """ Crops all detected faces in an image (see ``crop_faces``). """
+        bboxes, kpss = self._detect(img)
+        return [self._crop_face(img, bbox, kps) for bbox, kps in zip(bboxes, kpss)]
+
+    def _warp(self, img, M):
+        """ Warps the (BGR) image to the target size with a 2 x 3 affine matrix. """
+        size = self.target_size[0]
+        return cv2.warpAffine(img, M, (size, size), borderValue=0.0)
+
+    def _preprocess(self, af_img):
+        """ Normalizes the (BGR) crop, converts it to RGB and casts it to a
+        1 x 3 x 112 x 112 tensor. """
+        import torch
         #af_img = cv2.dnn.blobFromImages([af_img], 1.0 / 127.5, (112, 112), (127.5, 127.5, 127.5), swapRB=True)[0]
         # Channel-wise mean subtraction (- 127.5), scaling (* 1 / 127.5), BGR -> RGB
         af_img = ((af_img - 127.5) * (1 / 127.5)).transpose(2, 0, 1)
-        
+
         # Add singleton batch dim (shape: 1 x 3 x 112 x 112), cast to device
-        af_img = torch.tensor(af_img[None, ::-1, ...].copy()).to(self.device)
-        #af_img = torch.tensor(af_img).cuda()[None]
+        return torch.tensor(af_img[None, ::-1, ...].copy()).to(self.device)
 
-        #deca_img = face_align.norm_crop(img, landmark=face.kps, image_size=224)
-        
-        return af_img
+    def recrop(self, image, tform):
+        """ Aligns an image with a known alignment matrix (e.g., from an earlier
+        ``crop`` of the same image, see ``flame.cache.CropCache``), which skips the
+        (expensive) detection.
+
+        Parameters
+        ----------
+        image : str, Path, np.ndarray
+            Path to an image or a numpy array (height x width x 3) with the RGB image
+        tform : np.ndarray
+            A 3 x 3 array with the alignment matrix
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"img_crop"``, ``"tform"`` and ``"img_size"``
+            (see ``crop``)
+        """
+        with stage('load'):
+            img = self._load_image(image)
+
+        with stage('warp'):
+            af_img = self._warp(img, tform[:2])
+
+        with stage('preprocess', self.device):
+            af_img = self._preprocess(af_img)
+
+        h, w = img.shape[:2]
+        return {'img_crop': af_img, 'tform': tform[np.newaxis, ...], 'img_size': np.array([[w, h]])}
+
+    def __call__(self, image):
+        return self.crop(image)['img_crop']
 
     def _dist(self, p1, p2):
         return math.sqrt(((p1[0] - p2[0]) ** 2) + ((p1[1] - p2[1]) ** 2))
     
     def _get_center(self, bboxes, img):
         
-        img_center = img.shape[0] // 2, img.shape[1] // 2
+        # (x, y), like the centers of the boxes
+        img_center = img.shape[1] // 2, img.shape[0] // 2
         size = bboxes.shape[0]
-        distance = np.Inf
+        distance = np.inf
         j = 0
         for i in range(size):
             x1, y1, x2, y2 = bboxes[i, 0:4]
@@ -359,3 +814,170 @@ class InsightFaceCropModel(BaseModel):
                 j = i
 
         return j
+
+
+class CombinedCropModel(InsightFaceCropModel):
+    """ Cropping model that detects the face(s) only once (with ``insightface``) and
+    creates both the (aligned, 112 x 112) crop for MICA and the (224 x 224) crop for
+    DECA/EMOCA. The latter is based on the 68 landmarks estimated by the
+    ``insightface`` landmark model (instead of ``face_alignment``), using the same
+    bounding box as ``FanCropModel``.
+
+    Parameters
+    ----------
+    device : str
+        Either 'cuda' (GPU) or 'cpu'
+    deca_size : tuple
+        Width and height of the DECA/EMOCA crops
+    mica_size : tuple
+        Width and height of the MICA crops
+    fallback_confidence : float
+        Minimum confidence of the (last resort) detection pass of ``crop_tracked``
+
+    Examples
+    --------
+    >>> from flame.data import get_example_img
+    >>> crop_model = CombinedCropModel(device='cpu')
+    >>> out = crop_model.crop(get_example_img())
+    >>> out['deca']['img_crop'].shape, out['mica']['img_crop'].shape
+    (torch.Size([1, 3, 224, 224]), torch.Size([1, 3, 112, 112]))
+    """
+    def __init__(self, device='cuda', deca_size=(224, 224), mica_size=(112, 112),
+                 fallback_confidence=0.2):
+        self.deca_size = deca_size
+        super().__init__(device, target_size=mica_size, fallback_confidence=fallback_confidence)
+
+    def _crop_deca(self, img, lm):
+        """ Crops the (BGR) image for DECA/EMOCA based on the 68 landmarks. """
+        import torch
+
+        bbox = self._create_bbox(lm)
+        w, h = self.deca_size
+        dst = np.array([[0, 0], [0, w - 1], [h - 1, 0]])
+        tform = estimate_transform("similarity", bbox[:3, :], dst)
+
+        # Same as FanCropModel (which expects RGB images)
+        img_crop = warp(img[:, :, ::-1], tform.inverse, output_shape=(w, h), preserve_range=True)
+        img_crop = torch.tensor(img_crop.transpose(2, 0, 1) / 255., dtype=torch.float32)
+        return img_crop.to(self.device).unsqueeze(0), tform.params, bbox
+
+    def crop(self, image):
+        """ Detects the face (closest to the center) and crops it for both MICA and
+        DECA/EMOCA, without storing anything on the model object.
+
+        Parameters
+        ----------
+        image : str, Path, np.ndarray
+            Either a string or ``pathlib.Path`` object to an image or a numpy array
+            (height x width x 3) representing the already loaded RGB image
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"mica"`` and ``"deca"``, each with a dictionary
+            with the same keys as the output of ``InsightFaceCropModel.crop`` and
+            ``FanCropModel.crop``, respectively (with 68 landmarks for ``"deca"``)
+
+        Raises
+        ------
+        ValueError
+            If no face was detected
+        """
+        with stage('load'):
+            img = self._load_image(image)
+
+        out = self._crop_detected(img)
+        if out is None:
+            raise ValueError("Could not detect any faces!")
+
+        return out
+
+    def _prev_face(self, prev):
+        return super()._prev_face(prev['mica'])
+
+    def _crop_face(self, img, bbox, kps):
+        """ Crops a single face for both MICA and DECA/EMOCA (see ``crop``). """
+        from insightface.app.common import Face
+
+        mica = super()._crop_face(img, bbox, kps)
+
+        face = Face(bbox=bbox[0:4], kps=kps, det_score=bbox[4])
+        with stage('landmarks', self.device):
+            lm = self.app.models['landmark_3d_68'].get(img, face)[:, :2]
+
+        deca_img, tform, deca_bbox = self._crop_deca(img, lm)
+        return {
+            'mica': mica,
+            'deca': {
+                'img_crop': deca_img,
+                'tform': tform[np.newaxis, ...],
+                'img_size': mica['img_size'],
+                'lm': lm[np.newaxis, ...],
+                'bbox': deca_bbox[np.newaxis, ...],
+            },
+        }
+
+    def crop_faces(self, images):
+        """ Crops all detected faces in one or more images (see
+        ``BaseModel.crop_faces``) for both MICA and DECA/EMOCA.
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"mica"`` and ``"deca"``, each with the
+            (batched) output of ``BaseModel.crop_faces`` (including ``"img_idx"``)
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+
+        faces = []
+        for i, image in enumerate(images):
+            with stage('load'):
+                img = self._load_image(image)
+
+            faces.extend((i, face) for face in self._crop_all(img))
+
+        return {name: self._stack_faces([(i, face[name]) for i, face in faces], len(images))
+                for name in ('mica', 'deca')}
+
+    def crop_batch(self, images):
+        """ Crops a batch of images (see ``crop``).
+
+        Parameters
+        ----------
+        images : list
+            List of images (paths or RGB numpy arrays)
+
+        Returns
+        -------
+        out : dict
+            A dictionary with the keys ``"mica"`` and ``"deca"`` (see ``crop``), with the
+            outputs of all images in which a face was detected concatenated along the
+            first (batch) dimension, and ``"detected"``, a boolean array indicating
+            for each image whether a face was detected
+        """
+        import torch
+
+        crops, detected = [], []
+        for image in images:
+            try:
+                crops.append(self.crop(image))
+                detected.append(True)
+            except ValueError:
+                detected.append(False)
+
+        out = {'detected': np.array(detected)}
+        for name in ('mica', 'deca'):
+            if not crops:
+                out[name] = None
+                continue
+
+            out[name] = {}
+            for key in crops[0][name]:
+                values = [crop[name][key] for crop in crops]
+                out[name][key] = torch.cat(values) if key == 'img_crop' else np.concatenate(values)
+
+        return out
+
+    def __call__(self, image):
+        return self.crop(image)
@@ -0,0 +1,166 @@
+""" Generates synthetic stand-ins for the external (licensed) data needed by the
+reconstruction models: a FLAME model file with random shape/pose bases, checkpoints with
+random weights for DECA/EMOCA and MICA, and a dense template. These have the same
+shapes (and topology) as the real data, so they can be used for testing and
+benchmarking without access to the actual data, but the reconstructions are of
+course meaningless.
+
+Examples
+--------
+>>> import os
+>>> from flame.data.synthetic import create_synthetic_assets
+>>> cfg = create_synthetic_assets('./synthetic_data')  # doctest: +SKIP
+>>> os.environ['FLAME_CONFIG'] = str(cfg)  # models now load the synthetic data
+"""
+
+import yaml
+import torch
+import pickle
+import numpy as np
+from pathlib import Path
+
+from ..utils import load_obj
+from ..decoders import DetailGenerator
+from ..deca.encoders import ResnetEncoder
+from ..mica.encoders import Arcface, MappingNetwork
+
+# Number of vertices of the dense mesh (and faces of the dense template)
+N_DENSE_VERTS = 59315
+N_DENSE_FACES = 117380
+
+
+def create_flame_model(f_out, seed=0):
+    """ Creates a FLAME model file with the FLAME topology (from the head template)
+    but random shape, expression and pose bases.
+
+    Parameters
+    ----------
+    f_out : str, Path
+        Path of the output (pickle) file
+    seed : int
+        Seed for the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    v, _, f, _ = load_obj(Path(__file__).parent / 'head_template.obj')
+    v, f = v[0].numpy().astype(np.float64), f[0].numpy().astype(np.uint32)
+    n_v, n_j = v.shape[0], 5  # FLAME has 5 joints: global, neck, jaw, and two eyes
+
+    weights = rng.random((n_v, n_j))
+    J_regressor = rng.random((n_j, n_v))
+
+    flame = {
+        'f': f,
+        'v_template': v,
+        'shapedirs': rng.normal(0, 1e-3, size=(n_v, 3, 400)),  # 300 shape + 100 exp
+        'posedirs': rng.normal(0, 1e-3, size=(n_v, 3, (n_j - 1) * 9)),
+        'J_regressor': J_regressor / J_regressor.sum(axis=1, keepdims=True),
+        'kintree_table': np.array([[2 ** 32 - 1, 0, 1, 1, 1], [0, 1, 2, 3, 4]]),
+        'weights': weights / weights.sum(axis=1, keepdims=True),
+    }
+
+    with open(f_out, 'wb') as f_out:
+        pickle.dump(flame, f_out)
+
+
+def create_dense_template(f_out, seed=0):
+    """ Creates a dense template (like ``texture_data_256.npy``) that maps random
+    pixels of the 256 x 256 UV map to random locations on the FLAME faces.
+
+    Parameters
+    ----------
+    f_out : str, Path
+        Path of the output (npy) file
+    seed : int
+        Seed for the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    _, _, f, _ = load_obj(Path(__file__).parent / 'head_template.obj')
+    f = f[0].numpy()
+
+    pixels = rng.choice(256 * 256, size=N_DENSE_VERTS, replace=False)
+    template = {
+        'x_coords': (pixels % 256).astype(np.float64),
+        'y_coords': (pixels // 256).astype(np.float64),
+        'valid_pixel_ids': np.arange(N_DENSE_VERTS),
+        'valid_pixel_3d_faces': f[rng.integers(0, f.shape[0], size=N_DENSE_VERTS)],
+        'valid_pixel_b_coords': rng.dirichlet(np.ones(3), size=N_DENSE_VERTS),
+        'f': rng.integers(0, N_DENSE_VERTS, size=(N_DENSE_FACES, 3)),
+    }
+    np.save(f_out, template)
+
+
+def create_deca_checkpoint(f_out, seed=0):
+    """ Creates a checkpoint with random weights for all DECA/EMOCA submodels
+    (in the format created by ``validate_external_data.py``). """
+    torch.manual_seed(seed)
+    checkpoint = {
+        'E_flame': ResnetEncoder(outsize=236).state_dict(),
+        'E_detail': ResnetEncoder(outsize=128).state_dict(),
+        'E_expression': ResnetEncoder(outsize=50).state_dict(),
+        'D_detail': DetailGenerator(latent_dim=128 + 50 + 3).state_dict(),
+    }
+    torch.save(checkpoint, f_out)
+
+
+def create_mica_checkpoint(f_out, seed=0):
+    """ Creates a checkpoint with random weights for the MICA submodels (in the
+    format of the original MICA checkpoint). """
+    torch.manual_seed(seed)
+    arcface = Arcface()
+    for module in arcface.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            # The default initialization makes the (deep) network's output explode
+            torch.nn.init.kaiming_normal_(module.weight)
+            module.weight.data *= 0.5
+
+    mapping = MappingNetwork(512, 300, 300).state_dict()
+    checkpoint = {
+        'arcface': arcface.state_dict(),
+        'flameModel': {'regressor.' + key: value for key, value in mapping.items()},
+    }
+    torch.save(checkpoint, f_out)
+
+
+def create_synthetic_assets(out_dir, seed=0, overwrite=False):
+    """ Creates all synthetic assets and a config file pointing to them.
+
+    Parameters
+    ----------
+    out_dir : str, Path
+        Output directory (created if it does not exist)
+    seed : int
+        Seed for the random number generators
+    overwrite : bool
+        Whether to recreate assets that already exist
+
+    Returns
+    -------
+    cfg_path : pathlib.Path
+        Path to the config file; set the ``FLAME_CONFIG`` environment variable to
+        this path to use the synthetic assets
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    assets = {
+        'flame_path': (out_dir / 'generic_model.pkl', create_flame_model),
+        'deca_path': (out_dir / 'deca_model.tar', create_deca_checkpoint),
+        'mica_path': (out_dir / 'mica.tar', create_mica_checkpoint),
+        'dense_template_path': (out_dir / 'texture_data_256.npy', create_dense_template),
+    }
+
+    cfg = {}
+    for key, (f_out, create) in assets.items():
+        if overwrite or not f_out.is_file():
+            create(f_out, seed=seed)
+
+        cfg[key] = str(f_out)
+
+    # EMOCA uses the same submodels (plus E_expression) as DECA
+    cfg['emoca_path'] = cfg['deca_path']
+
+    cfg_path = out_dir / 'config.yaml'
+    with open(cfg_path, 'w') as f_out:
+        yaml.dump(cfg, f_out, default_flow_style=False)
+
+    return cfg_path
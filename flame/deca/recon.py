@@ -5,15 +5,23 @@ used in Medusa.
        Face Capture and Animation. *arXiv preprint arXiv:2204.11312*.
 """ 
 
+import cv2
 import torch
+import contextvars
+import torch.nn.functional as F
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from ..utils import get_logger
+from ..profiling import stage
 from ..core import FlameReconModel
+from ..export import load_onnx_graphs, load_traced_graphs
+from ..optimize import load_folded, StackedEncoders, quantize_static
 from .encoders import ResnetEncoder
-from ..decoders import FLAME, DetailGenerator
-from ..utils import vertex_normals, load_obj, upsample_mesh
+from ..decoders import FLAME, FLAMETex, DetailGenerator
+from ..uv import UVRasterTable
+from ..utils import vertex_normals, load_obj, upsample_mesh, generate_triangles
 from ..transforms import create_viewport_matrix, create_ortho_matrix, crop_matrix_to_3d
 
 logger = get_logger()
@@ -35,18 +43,63 @@ class DecaReconModel(FlameReconModel):
         that the image is not cropped!
     device : str
         Either 'cuda' (uses GPU) or 'cpu'
+    tform : np.ndarray
+        A 3x3 numpy array with the cropping transformation matrix (see Attributes)
+    fold_bn : bool
+        Whether to fold the batch norm layers of the encoders into their convolutions
+        (see ``flame.optimize.fold_batchnorm``), which speeds up inference
+    encoder_mode : str
+        How to run the encoders (two for 'deca-dense' and 'emoca-coarse', three for
+        'emoca-dense') on the same image: 'sequential' (one after the other), 'stacked'
+        (as a single vectorized module, see ``flame.optimize.StackedEncoders``), or
+        'threaded' (concurrently, in separate threads); the latter two may make better
+        use of the available cores at small batch sizes
+    backend : str
+        Either 'torch', 'jit', or 'onnx'; 'jit' traces the encoders and decoders into
+        (frozen) TorchScript graphs, once per batch size (see ``warmup``); 'onnx' exports
+        them to ONNX graphs (once, see ``flame.export``) and runs these with onnxruntime
+        (on CPU only)
+    onnx_threads : int, tuple
+        Number of intra-op threads or a tuple with the number of intra-op and inter-op
+        threads used by onnxruntime (only used if ``backend='onnx'``)
+    precision : str
+        Either 'float32' or 'bfloat16'; the latter runs the encoders with bfloat16
+        autocast and the channels last memory format, which is considerably faster
+        on CPUs with bfloat16 support (e.g., Xeons with AMX or AVX512-BF16) at the
+        cost of a small error; the decoders always run in float32 (only used if
+        ``backend='torch'``)
+    albedo : bool
+        Whether to also decode the albedo (diffuse texture in UV space) from the
+        estimated texture parameters with the FLAME texture model (``tex_path`` in
+        the config), which is returned as ``"albedo"`` by ``reconstruct``
+    albedo_size : int
+        Width and height of the albedo maps; the texture basis (512 x 512) is
+        downsampled to this size once, when the model is created
+    output_backend : str
+        Either 'numpy' or 'torch'; the latter returns the outputs of ``reconstruct`` as
+        (float32) tensors on the model's device (instead of numpy arrays), such that
+        the dense upsampling and world transform also run on the device and the outputs
+        can be used by downstream torch code without copies
 
     Attributes
     ----------
     tform : np.ndarray
         A 3x3 numpy array with the cropping transformation matrix;
         needs to be set before running the actual reconstruction!
+
+    Notes
+    -----
+    The ``tform`` and ``img_size`` attributes are only used by ``__call__``; the
+    ``reconstruct`` method takes them as arguments instead, which means that a
+    single model object can be shared across threads.
     """    
 
     # May have some speed benefits
     torch.backends.cudnn.benchmark = True
 
-    def __init__(self, name, img_size=None, device="cuda", tform=None):
+    def __init__(self, name, img_size=None, device="cuda", tform=None, fold_bn=True,
+                 encoder_mode='sequential', backend='torch', onnx_threads=None,
+                 precision='float32', albedo=False, albedo_size=256, output_backend='numpy'):
         """ Initializes an DECA-like model object. """
         super().__init__()
         self.name = name
@@ -54,13 +107,33 @@ class DecaReconModel(FlameReconModel):
         self.device = device
         self.dense = 'dense' in name
         self.tform = tform
+        self.fold_bn = fold_bn
+        self.encoder_mode = encoder_mode
+        self.backend = backend
+        self.precision = precision
+        self.albedo = albedo
+        self.albedo_size = albedo_size
+        self.output_backend = output_backend
         self._warned_about_tform = False
+        self._warned_about_img_size = False
         self._check()
         self._load_cfg()  # sets self.cfg
         self._load_data()
         self._crop_img_size = (224, 224)
+        self._crop_norm = (0., 255.)  # (mean, scale) of crops (see FanCropModel)
         self._create_submodels()
 
+        if self.backend == 'jit':
+            self._encoder_graph, self._decoder_graph = load_traced_graphs(self)
+        elif self.backend == 'onnx':
+            self._encoder_graph, self._decoder_graph = load_onnx_graphs(self, onnx_threads)
+
+            # The (torch) encoders are not needed anymore, so free their memory
+            for key in self._encoder_keys + ['E_stacked']:
+                setattr(self, key, None)
+
+        self._update_cache_namespace()
+
     def _check(self):
         """ Does some checks of the parameters. """ 
         MODELS = ['deca-coarse', 'deca-dense', 'emoca-coarse', 'emoca-dense']        
@@ -70,26 +143,64 @@ class DecaReconModel(FlameReconModel):
         DEVICES = ['cuda', 'cpu']
         if self.device not in DEVICES:
             raise ValueError(f"Device must be in {DEVICES}, but got {self.device}!")
-        
-        if self.img_size is None:
-            logger.warning("Arg `img_size` not given; beware, cannot render recon "
-                           "on top of original image anymore (only on cropped image)")
+
+        ENCODER_MODES = ['sequential', 'stacked', 'threaded']
+        if self.encoder_mode not in ENCODER_MODES:
+            raise ValueError(f"Encoder mode must be in {ENCODER_MODES}, but got {self.encoder_mode}!")
+
+        BACKENDS = ['torch', 'jit', 'onnx']
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Backend must be in {BACKENDS}, but got {self.backend}!")
+
+        if self.backend == 'onnx' and self.device != 'cpu':
+            raise ValueError("The 'onnx' backend only supports device 'cpu'!")
+
+        PRECISIONS = ['float32', 'bfloat16']
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Precision must be in {PRECISIONS}, but got {self.precision}!")
+
+        if self.precision != 'float32' and self.backend != 'torch':
+            raise ValueError("Only the 'torch' backend supports 'bfloat16' precision!")
+
+        OUTPUT_BACKENDS = ['numpy', 'torch']
+        if self.output_backend not in OUTPUT_BACKENDS:
+            raise ValueError(f"Output backend must be in {OUTPUT_BACKENDS}, but got {self.output_backend}!")
 
     def _load_data(self):
         """Loads necessary data. """
         data_dir = Path(__file__).parents[1] / 'data'
 
         if self.dense:
-            self.dense_template = np.load(data_dir / 'texture_data_256.npy',
-                                          allow_pickle=True, encoding='latin1').item()           
+            dense_template = self.cfg.get('dense_template_path', data_dir / 'texture_data_256.npy')
+            self.dense_template = np.load(dense_template, allow_pickle=True, encoding='latin1').item()
             self.fixed_uv_dis = np.load(data_dir / 'fixed_displacement_256.npy')
             self.fixed_uv_dis = torch.tensor(self.fixed_uv_dis).float().to(self.device)
 
+            # Coarse faces, barycentric coordinates and UV pixels of the dense vertices
+            # (see `_upsample`)
+            valid = self.dense_template['valid_pixel_ids']
+            pix_idx = (self.dense_template['y_coords'][valid].astype(int) * 256 +
+                       self.dense_template['x_coords'][valid].astype(int))
+            self._dense_upsample = (
+                torch.as_tensor(self.dense_template['valid_pixel_3d_faces'].astype(np.int64), device=self.device),
+                torch.as_tensor(self.dense_template['valid_pixel_b_coords'], dtype=torch.float32, device=self.device),
+                torch.as_tensor(pix_idx, device=self.device),
+            )
+
         _, uvcoords, faces, uvfaces = load_obj(data_dir / 'head_template.obj')
         self.faces = faces.to(self.device)
         self.uvcoords = uvcoords
         self.uvfaces = uvfaces
 
+        # The UV layout is fixed, so rasterize it only once
+        self.uv_table = UVRasterTable(uvcoords, uvfaces, faces, size=256, device=self.device)
+
+        if self.dense:
+            mask = cv2.imread(str(data_dir / 'uv_face_eye_mask.png'))[:, :, 0] / 255.
+            mask = cv2.resize(mask, (256, 256), interpolation=cv2.INTER_NEAREST)
+            self.uv_face_eye_mask = torch.tensor(mask[None, None]).float().to(self.device)
+            self.dense_faces = torch.tensor(generate_triangles(256, 256)).to(self.device)
+
     def _create_submodels(self):
         """ Creates all EMOCA encoding and decoding submodels. To summarize:
         - `E_flame`: predicts (coarse) FLAME parameters given an image
@@ -113,13 +224,37 @@ class DecaReconModel(FlameReconModel):
         self.n_param = sum([n for n in self.param_dict.values()])
 
         # encoders
-        self.E_flame = ResnetEncoder(outsize=self.n_param).to(self.device)
+        encoders = {'E_flame': self.n_param}
 
         if self.dense:
-            self.E_detail = ResnetEncoder(outsize=128).to(self.device)
+            encoders['E_detail'] = 128
 
         if 'emoca' in self.name:
-            self.E_expression = ResnetEncoder(self.param_dict["n_exp"]).to(self.device)
+            encoders['E_expression'] = self.param_dict["n_exp"]
+
+        # The checkpoint is only loaded when needed (i.e., not when all submodels are
+        # cached already)
+        self._checkpoint = None
+        f_ckpt = self.cfg[self.name.split('-')[0] + '_path']
+
+        self._encoder_sizes = encoders
+        for key in encoders:
+            def create(key=key):
+                return self._create_encoder(key)
+
+            if self.fold_bn:
+                # Fold batch norm layers into the convolutions (shared by all models
+                # that use the same encoder and memory format)
+                encoder = load_folded(create, f_ckpt, key, self.device, self._memory_format)
+            else:
+                encoder = self._to_memory_format(create())
+
+            setattr(self, key, encoder)
+
+        self._encoder_keys = list(encoders)
+        self._encoder_executor = None
+        if self.encoder_mode == 'stacked' and len(encoders) > 1:
+            self.E_stacked = StackedEncoders([getattr(self, key) for key in encoders])
 
         # decoders
         self.D_flame = FLAME(self.cfg['flame_path'], n_shape=100, n_exp=50).to(self.device)
@@ -132,37 +267,43 @@ class DecaReconModel(FlameReconModel):
                 out_scale=0.01,
                 sample_mode="bilinear",
             ).to(self.device)
+            self._load_weights(self.D_detail, 'D_detail')
 
-        # Load weights from checkpoint and apply to models
-        checkpoint = torch.load(self.cfg[self.name.split('-')[0] + '_path'])
+        if self.albedo:
+            if 'tex_path' not in self.cfg:
+                raise ValueError("Decoding the albedo needs the FLAME texture model, but "
+                                 "`tex_path` is not set in the config!")
 
-        self.E_flame.load_state_dict(checkpoint["E_flame"])
+            self.D_flame_tex = FLAMETex(self.cfg['tex_path'], n_tex=self.param_dict['n_tex'],
+                                        size=self.albedo_size).to(self.device)
 
-        if self.dense:
-            self.E_detail.load_state_dict(checkpoint["E_detail"])
-            self.D_detail.load_state_dict(checkpoint["D_detail"])
-            self.E_detail.eval()
-            self.D_detail.eval()
-        
-        if 'emoca' in self.name:
-            self.E_expression.load_state_dict(checkpoint["E_expression"])    
-            # for some reason E_exp should be explicitly cast to cuda
-            self.E_expression.to(self.device)
-            self.E_expression.eval()
+        # Free the memory used by the checkpoint
+        self._checkpoint = None
+
+    def _create_encoder(self, key):
+        """ Creates an encoder with its original (not folded) weights. """
+        encoder = ResnetEncoder(outsize=self._encoder_sizes[key]).to(self.device)
+        return self._load_weights(encoder, key)
 
-        # Set everything to 'eval' (inference) mode
-        self.E_flame.eval()
-        torch.set_grad_enabled(False)  # apparently speeds up forward pass, too
+    def _load_weights(self, model, key):
+        """ Loads the weights of a submodel from the checkpoint and sets it to 'eval'
+        (inference) mode; note that we don't disable gradients globally, as
+        `reconstruct` runs in (scoped) inference mode. """
+        if self._checkpoint is None:
+            f_ckpt = self.cfg[self.name.split('-')[0] + '_path']
+            self._checkpoint = torch.load(f_ckpt, map_location=self.device)
+
+        model.load_state_dict(self._checkpoint[key])
+        return model.eval()
 
     def _encode(self, image):
         """ "Encodes" the image into FLAME parameters, i.e., predict FLAME
-        parameters for the given image. Note that, at the moment, it only
-        works for a single image, not a batch of images.
+        parameters for the given (batch of) image(s).
 
         Parameters
         ----------
         image : torch.Tensor
-            A Tensor with shape 1 (batch size) x 3 (color ch.) x 244 (w) x 244 (h)
+            A Tensor with shape B (batch size) x 3 (color ch.) x 224 (w) x 224 (h)
 
         Returns
         -------
@@ -171,16 +312,15 @@ class DecaReconModel(FlameReconModel):
             for the decoding stage.
         """
 
-        if self.img_size is None:
-            # If img_size was not set upon initialization, assume no cropping
-            # and use the size of the current image
-            self.img_size = tuple(image.shape[2:])
-
         # Encode image into FLAME parameters, then decompose parameters
         # into a dict with parameter names (shape, tex, exp, etc) as keys
         # and the estimated parameters as values
-        enc_params = self.E_flame(image)
-        enc_dict = self._decompose_params(enc_params, self.param_dict)
+        if self.backend != 'torch':
+            with stage(f'E_{self.backend}', self.device):
+                return self._encoder_graph(image)
+
+        enc_out = self._run_encoders(image)
+        enc_dict = self._decompose_params(enc_out['E_flame'], self.param_dict)
 
         # Note to self:
         # enc_dict['cam'] contains [batch_size, x_trans, y_trans, zoom] (in mm?)
@@ -192,16 +332,89 @@ class DecaReconModel(FlameReconModel):
 
         # Encode image into detail parameters
         if self.dense:
-            detail_params = self.E_detail(image)
-            enc_dict['detail'] = detail_params
+            enc_dict['detail'] = enc_out['E_detail']
 
         # Replace "DECA" expression parameters with EMOCA-specific
         # expression parameters
         if 'emoca' in self.name:
-            enc_dict["exp"] = self.E_expression(image)
+            enc_dict["exp"] = enc_out['E_expression']
 
         return enc_dict
 
+    def _run_encoders(self, image):
+        """ Runs all encoders on the same image(s) (according to ``encoder_mode``)
+        and returns a dictionary with the output per encoder. """
+        keys = self._encoder_keys
+        image = self._to_memory_format(image)
+
+        if getattr(self, 'E_stacked', None) is not None:
+            with stage('E_stacked', self.device), self._autocast():
+                return dict(zip(keys, [out.float() for out in self.E_stacked(image)]))
+
+        def run(key):
+            # Autocast is thread-local, so is entered here (not around the threads)
+            with stage(key, self.device), self._autocast():
+                return getattr(self, key)(image).float()
+
+        if self.encoder_mode != 'threaded' or len(keys) == 1:
+            return {key: run(key) for key in keys}
+
+        if self._encoder_executor is None:
+            self._encoder_executor = ThreadPoolExecutor(max_workers=len(keys))
+
+        # Inference mode and the active profiler (context) are thread-local, so need
+        # to be passed on to the threads explicitly
+        inference = torch.is_inference_mode_enabled()
+
+        def run_in_thread(ctx, key):
+            with torch.inference_mode(inference):
+                return ctx.run(run, key)
+
+        futures = {key: self._encoder_executor.submit(run_in_thread, contextvars.copy_context(), key)
+                   for key in keys}
+        return {key: future.result() for key, future in futures.items()}
+
+    def __getstate__(self):
+        # The thread pool cannot be pickled (e.g., when sending the model to a
+        # spawned worker process), so is recreated when needed
+        state = self.__dict__.copy()
+        state['_encoder_executor'] = None
+        return state
+
+    def _crop_kwargs(self, crops):
+        return {'tform': crops['tform'], 'img_size': crops['img_size']}
+
+    def _dummy_kwargs(self, batch_size):
+        # Avoid warnings about the missing crop matrix and image size
+        return {'tform': np.tile(np.eye(3), (batch_size, 1, 1)),
+                'img_size': np.tile(self._crop_img_size, (batch_size, 1))}
+
+    def _quantize_encoders(self, images, batch_size=16):
+        """ Quantizes the encoders (see ``FlameReconModel.quantize``); note that the
+        quantized encoders cannot be stacked, so are always run separately. """
+        # Folded encoders cannot be quantized (batch norm layers are folded during
+        # quantization anyway), so we start from the original encoders
+        quantized = {}
+        for key in self._encoder_keys:
+            encoder = self._create_encoder(key) if self.fold_bn else getattr(self, key)
+            quantized[key] = quantize_static(encoder, images, batch_size)
+
+        # Free the memory used by the checkpoint
+        self._checkpoint = None
+        if getattr(self, 'E_stacked', None) is not None:
+            quantized['E_stacked'] = None
+
+        return quantized
+
+    def _decode_flame(self, enc_dict):
+        """ Decodes the (coarse) FLAME vertices (in model space). """
+        v, _ = self.D_flame(
+            shape_params=enc_dict["shape"],
+            expression_params=enc_dict["exp"],
+            pose_params=enc_dict["pose"],
+        )
+        return v
+
     def _decompose_params(self, parameters, num_dict):
         """Convert a flattened parameter vector to a dictionary of parameters
         code_dict.keys() = ['shape', 'tex', 'exp', 'pose', 'cam', 'light']."""
@@ -218,62 +431,171 @@ class DecaReconModel(FlameReconModel):
 
         return enc_dict
 
-    def _decode(self, enc_dict):
+    def _decode(self, enc_dict, tform=None, img_size=None):
         """Decodes the face attributes (vertices, landmarks, texture, detail map)
         from the encoded parameters.
 
         Parameters
         ----------
-        orig_size : tuple
-            Tuple containing the original image size (height, width), i.e.,
-            before cropping; needed to transform and render the mesh in the
-            original image space
+        enc_dict : dict
+            A dictionary with the encoded parameters (output from ``_encode``)
+        tform : np.ndarray
+            Either a 3x3 or a B x 3 x 3 array with the cropping matrix (or matrices);
+            if ``None``, it is assumed that the image is not cropped
+        img_size : tuple, np.ndarray
+            Original (before cropping) image size (width, height) or a B x 2 array
+            with image sizes; if ``None``, the size of the cropped image is used
 
         Returns
         -------
         dec_dict : dict
-            A dictionary with the results from the decoding stage
+            A dictionary with the results from the decoding stage, i.e., the vertices
+            (``"v"``, B x V x 3), local-to-world matrices (``"mat"``, B x 4 x 4) and,
+            if ``albedo`` is set, the albedo maps (``"albedo"``, B x 3 x H x W)
+        """
 
-        Raises
-        ------
-        ValueError
-            If `tform` parameter is not `None` and `orig_size` is `None`. In other
-            words, if `tform` is supplied, `orig_size` should be supplied as well
+        dec = self._decode_meshes(enc_dict)
+        if self.output_backend == 'torch':
+            dec_dict = self._decode_torch(dec, enc_dict['cam'], tform, img_size)
+        else:
+            dec_dict = self._decode_numpy(dec, enc_dict['cam'], tform, img_size)
 
-        """
+        if self.albedo:
+            with stage('D_flame_tex', self.device):
+                tex = enc_dict['tex'].to(self.device, torch.float32)
+                albedo = self.D_flame_tex(tex).clamp(0, 1)
+                dec_dict['albedo'] = albedo if self.output_backend == 'torch' else albedo.cpu().numpy()
+
+        return dec_dict
+
+    def _decode_numpy(self, dec, cam, tform=None, img_size=None):
+        """ Upsamples (for dense models) the decoded meshes and transforms them to world
+        space as (float64) numpy arrays (see ``_decode``). """
+        v = dec['v']
 
-        # "Decode" vertices (`v`) from the predicted shape/exp/pose parameter
-        v, R = self.D_flame(
-            shape_params=enc_dict["shape"],
-            expression_params=enc_dict["exp"],
-            pose_params=enc_dict["pose"],
-        )
-        
         if self.dense:
-            input_detail = torch.cat([enc_dict['pose'][:, 3:], enc_dict['exp'], enc_dict['detail']], dim=1)
-            uv_z = self.D_detail(input_detail)
-            
-            normals = vertex_normals(v, self.faces.expand(1, -1, -1))
-            #uv_detail_normals = self._disp2normal(uv_z, v, normals)
-            disp_map = uv_z + self.fixed_uv_dis[None, None, :, :]
-            v = upsample_mesh(v.cpu().numpy().squeeze(),
-                              normals.cpu().numpy().squeeze(),
-                              disp_map.cpu().numpy().squeeze(),
-                              self.dense_template)
+            with stage('upsample', self.device):
+                normals = vertex_normals(v, self.faces.expand(v.shape[0], -1, -1))
+                disp_map = dec['uv_z'] + self.fixed_uv_dis[None, None, :, :]
+                v = upsample_mesh(v.cpu().numpy(),
+                                  normals.cpu().numpy(),
+                                  disp_map.cpu().numpy()[:, 0],
+                                  self.dense_template)
         else:
-            v = v.cpu().numpy().squeeze()
+            v = v.cpu().numpy()
 
         # Note that `v` is in world space, but pose (global rotation only)
         # is already applied
-        cam = enc_dict["cam"].cpu().numpy().squeeze()  # 'camera' params
+        cam = cam.cpu().numpy()  # 'camera' params
 
         # Now, let's define all the transformations of `v`
         # First, rotation has already been applied, which is stored in `R`
-        R = R.cpu().numpy().squeeze()  # global rotation matrix
+        R = dec['R'].cpu().numpy()  # global rotation matrix
+
+        with stage('world_transform'):
+            mat = self._create_world_matrix(cam, tform, img_size)
+
+            # Change to homogenous coordinates and apply transformation
+            v = np.concatenate([v, np.ones((*v.shape[:2], 1))], axis=2) @ mat.transpose(0, 2, 1)
+            v = v[..., :3]  # trim off 4th dim
+
+            # To complete the full transformation matrix, we need to also
+            # add the rotation (which was already applied to the data by the
+            # FLAME model)
+            mat = mat @ R
+
+        return {"v": v, "mat": mat}
+
+    def _decode_torch(self, dec, cam, tform=None, img_size=None):
+        """ Upsamples (for dense models) the decoded meshes and transforms them to world
+        space as (float32) tensors on the model's device (see ``_decode``); only the
+        (small) crop matrices are created on the host. """
+        v = dec['v'].to(self.device)
+        cam = cam.to(self.device, torch.float32)
+        R = dec['R'].to(self.device)
+
+        if self.dense:
+            with stage('upsample', self.device):
+                normals = vertex_normals(v, self.faces.expand(v.shape[0], -1, -1))
+                disp_map = dec['uv_z'].to(self.device) + self.fixed_uv_dis[None, None, :, :]
+                v = self._upsample(v, normals, disp_map[:, 0])
+
+        with stage('world_transform', self.device):
+            # Same as `_create_world_matrix`, but the scale and translation (from the
+            # estimated 'camera' parameters) are applied on the device
+            batch_size = cam.shape[0]
+            T = torch.eye(4, device=self.device).repeat(batch_size, 1, 1)
+            T[:, :2, 3] = cam[:, 1:]
+            S = torch.eye(4, device=self.device).repeat(batch_size, 1, 1)
+            S[:, [0, 1, 2], [0, 1, 2]] = cam[:, [0]]
+
+            crop_mat = self._crop_to_world_matrix(batch_size, tform, img_size)
+            mat = torch.as_tensor(crop_mat, dtype=torch.float32, device=self.device) @ S @ T
+
+            v = v @ mat[:, :3, :3].transpose(1, 2) + mat[:, None, :3, 3]
+            mat = mat @ R
+
+        return {"v": v, "mat": mat}
 
-        # Actually, R is per vertex (not sure why) but doesn't really differ
-        # across vertices, so let's average
-        R = R.mean(axis=0)
+    def _upsample(self, v, normals, disp_map):
+        """ Upsamples the coarse meshes to the dense mesh in torch (the same as
+        ``flame.utils.upsample_mesh``). """
+        faces, b_coords, pix_idx = self._dense_upsample
+        points = (v[:, faces] * b_coords[..., None]).sum(dim=2)
+        normals = F.normalize((normals[:, faces] * b_coords[..., None]).sum(dim=2), dim=-1)
+        displacements = disp_map.reshape(disp_map.shape[0], -1)[:, pix_idx]
+        return points + displacements[..., None] * normals
+
+    def _decode_meshes(self, enc_dict):
+        """ Runs the decoders, i.e., decodes the (coarse) vertices (``"v"``) and global
+        rotation matrices (``"R"``) and, for dense models, the detail displacement
+        maps (``"uv_z"``) from the encoded parameters. """
+        if self.backend != 'torch':
+            inputs = [enc_dict['shape'], enc_dict['exp'], enc_dict['pose']]
+            if self.dense:
+                inputs.append(enc_dict['detail'])
+
+            with stage(f'D_{self.backend}', self.device):
+                return self._decoder_graph(*inputs)
+
+        # "Decode" vertices (`v`) from the predicted shape/exp/pose parameter
+        with stage('D_flame', self.device):
+            v, R = self.D_flame(
+                shape_params=enc_dict["shape"],
+                expression_params=enc_dict["exp"],
+                pose_params=enc_dict["pose"],
+            )
+
+        # R is per vertex (not sure why) but doesn't really differ across
+        # vertices, so let's average
+        dec = {'v': v, 'R': R.mean(dim=1)}
+
+        if self.dense:
+            with stage('D_detail', self.device):
+                input_detail = torch.cat([enc_dict['pose'][:, 3:], enc_dict['exp'], enc_dict['detail']], dim=1)
+                dec['uv_z'] = self.D_detail(input_detail)
+
+        return dec
+
+    def _create_world_matrix(self, cam, tform=None, img_size=None):
+        """ Creates the (batch of) 4x4 matrices that map the vertices from the
+        (cropped) model space to the world space of the original image.
+
+        Parameters
+        ----------
+        cam : np.ndarray
+            A B x 3 array with the estimated 'camera' parameters (scale, tx, ty)
+        tform : np.ndarray
+            Either a 3x3 or a B x 3 x 3 array with the cropping matrix
+        img_size : tuple, np.ndarray
+            Either a (width, height) tuple or a B x 2 array with image sizes
+
+        Returns
+        -------
+        mat : np.ndarray
+            A B x 4 x 4 array with affine matrices
+        """
+        batch_size = cam.shape[0]
 
         # Now, translation. We are going to do something weird. EMOCA (and
         # DECA) estimate translation (and scale) parameters *of the camera*,
@@ -281,21 +603,57 @@ class DecaReconModel(FlameReconModel):
         # w.r.t. the model, not the other way around (but it is technically equivalent).
         # Because we have a fixed camera and a (possibly) moving face, we actually
         # apply translation (and scale) to the model, not the camera.
-        tx, ty = cam[1:]
-        T = np.array([[1, 0, 0, tx], [0, 1, 0, ty], [0, 0, 1, 0], [0, 0, 0, 1]])
+        T = np.tile(np.eye(4), (batch_size, 1, 1))
+        T[:, :2, 3] = cam[:, 1:]
 
         # The same issue applies to the 'scale' parameter
         # which we'll apply to the model, too
-        sc = cam[0]
-        S = np.array([[sc, 0, 0, 0], [0, sc, 0, 0], [0, 0, sc, 0], [0, 0, 0, 1]])
+        S = np.tile(np.eye(4), (batch_size, 1, 1))
+        S[:, [0, 1, 2], [0, 1, 2]] = cam[:, [0]]
+
+        pose = S @ T
+        return self._crop_to_world_matrix(batch_size, tform, img_size) @ pose
+
+    def _crop_to_world_matrix(self, batch_size, tform=None, img_size=None):
+        """ Creates the (batch of) 4x4 matrices that map the vertices from the (cropped)
+        model space, after scaling and translation (see ``_create_world_matrix``), to the
+        world space of the original image.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of matrices
+        tform : np.ndarray
+            Either a 3x3 or a B x 3 x 3 array with the cropping matrix
+        img_size : tuple, np.ndarray
+            Either a (width, height) tuple or a B x 2 array with image sizes
 
-        if self.tform is None:
+        Returns
+        -------
+        mat : np.ndarray
+            A B x 4 x 4 array with affine matrices
+        """
+        if tform is None:
             if not self._warned_about_tform:
-                logger.warning("Attribute `tform` is not set, so cannot render in the "
-                               "original image space, only in cropped image space!")
+                logger.warning("Crop matrix (`tform`) is not given, so cannot render in "
+                               "the original image space, only in cropped image space!")
                 self._warned_about_tform = True
 
-            self.tform = np.eye(3)
+            tform = np.eye(3)
+
+        tform = np.broadcast_to(np.asarray(tform, dtype=np.float64), (batch_size, 3, 3))
+
+        if img_size is None:
+            if not self._warned_about_img_size:
+                logger.warning("Image size (`img_size`) not given; beware, cannot render "
+                               "recon on top of original image (only on cropped image)")
+                self._warned_about_img_size = True
+
+            # If img_size is not given, assume no cropping and use the size
+            # of the cropped image
+            img_size = self._crop_img_size
+
+        img_size = np.broadcast_to(np.asarray(img_size), (batch_size, 2))
 
         # Now we have to do something funky. EMOCA/DECA works on cropped images. This is a problem when
         # we want to quantify motion across frames of a video because a face might move a lot (e.g.,
@@ -311,57 +669,72 @@ class DecaReconModel(FlameReconModel):
         # and one for the 'backward' transform (full image raster space -> world)
         OP = create_ortho_matrix(*self._crop_img_size)  # forward (world -> cropped NDC)
         VP = create_viewport_matrix(*self._crop_img_size)  # forward (cropped NDC -> cropped raster)
-        CP = crop_matrix_to_3d(self.tform)  # crop matrix
-        VP_ = create_viewport_matrix(*self.img_size)  # backward (full NDC -> full raster)
-        OP_ = create_ortho_matrix(*self.img_size)  # backward (full NDC -> world)
+        CP = np.stack([crop_matrix_to_3d(t) for t in tform])  # crop matrices
+        VP_ = np.stack([create_viewport_matrix(*sz) for sz in img_size])  # backward (full NDC -> full raster)
+        OP_ = np.stack([create_ortho_matrix(*sz) for sz in img_size])  # backward (full NDC -> world)
 
         # Let's define the *full* transformation chain into a single 4x4 matrix
         # (Order of transformations is from right to left)
         # Again, I can't believe this actually works
-        pose = S @ T
         forward = np.linalg.inv(CP) @ VP @ OP
         backward = np.linalg.inv((VP_ @ OP_))
-        mat = backward @ forward @ pose
+        return backward @ forward
+
+    def _world2uv(self, attr):
+        """ Maps vertex attributes (B x V x C) to UV space (B x C x 256 x 256) with the
+        precomputed UV rasterization table (see ``flame.uv.UVRasterTable``). """
+        return self.uv_table.world2uv(attr)
+
+    def _disp2normal(self, uv_z, v, normals):
+        """ Computes the normals (B x 3 x 256 x 256) of the detailed surface in UV space
+        from the (coarse) vertices and normals and the detail displacement maps. """
+        batch_size = uv_z.shape[0]
+        uv_coarse_vertices = self._world2uv(v)
+        uv_coarse_normals = self._world2uv(normals)
+
+        uv_z = uv_z * self.uv_face_eye_mask
+        uv_detail_vertices = uv_coarse_vertices + uv_z * uv_coarse_normals + \
+                             self.fixed_uv_dis[None, None, :, :] * uv_coarse_normals
+
+        dense_vertices = uv_detail_vertices.permute(0, 2, 3, 1).reshape([batch_size, -1, 3])
+        uv_detail_normals = vertex_normals(dense_vertices, self.dense_faces.expand(batch_size, -1, -1))
+        uv_detail_normals = uv_detail_normals.reshape([batch_size, uv_coarse_vertices.shape[2],
+                                                       uv_coarse_vertices.shape[3], 3])
+        uv_detail_normals = uv_detail_normals.permute(0, 3, 1, 2)
+        uv_detail_normals = uv_detail_normals * self.uv_face_eye_mask + \
+                            uv_coarse_normals * (1. - self.uv_face_eye_mask)
+        return uv_detail_normals
+
+    @torch.inference_mode()
+    def uv_detail_normals(self, image):
+        """ Estimates the normals of the detailed surface in UV space (dense models only).
 
-        # Change to homogenous coordinates and apply transformation
-        v = np.c_[v, np.ones(v.shape[0])] @ mat.T
-        v = v[:, :3]  # trim off 4th dim
+        Parameters
+        ----------
+        image : torch.Tensor
+            A B x 3 x 224 x 224 tensor with cropped images
 
-        # To complete the full transformation matrix, we need to also
-        # add the rotation (which was already applied to the data by the
-        # FLAME model)
-        mat = mat @ R
+        Returns
+        -------
+        uv_detail_normals : torch.Tensor
+            A B x 3 x 256 x 256 tensor with the normals in UV space (on the model's device)
 
-        # tex = self.D_flame_tex(enc_dict['tex'])
-        return {"v": v, "mat": mat}
+        Raises
+        ------
+        ValueError
+            If the model is not a dense model
+        """
+        if not self.dense:
+            raise ValueError("Detail normals are only available for dense models!")
 
-    def _world2uv(self, attr, fv):
-        batch_size = attr.shape[0]
-        uv_attr = self.uv_rasterizer(self.uvcoords.expand(batch_size, -1, -1),
-                                     self.uvfaces.expand(batch_size, -1, -1),
-                                     fv)[:, :3]
-        return uv_attr.detach()
+        with stage('preprocess', self.device):
+            image = self._check_input(image, expected_wh=self._crop_img_size)
 
-    # def _disp2normal(self, uv_z, v, faces, normals):
-    
-    #     batch_size = uv_z.shape[0]
-    #     fv = face_vertices(v, faces.expand(batch_size, -1, -1))
-    #     uv_coarse_vertices = self._world2uv(v, fv)
-    #     uv_coarse_normals = self._world2uv(normals, fv)
-        
-    #     uv_z = uv_z * self.uv_face_eye_mask
-    #     uv_detail_vertices = uv_coarse_vertices + uv_z * uv_coarse_normals + \
-    #                          self.fixed_uv_dis[None,None,:,:] * \
-    #                          uv_coarse_normals.detach()
-
-    #     dense_vertices = uv_detail_vertices.permute(0,2,3,1).reshape([batch_size, -1, 3])
-    #     uv_detail_normals = vertex_normals(dense_vertices, self.render.dense_faces.expand(batch_size, -1, -1))
-    #     uv_detail_normals = uv_detail_normals.reshape([batch_size, uv_coarse_vertices.shape[2],
-    #                                                    uv_coarse_vertices.shape[3], 3])
-    #     uv_detail_normals = uv_detail_normals.permute(0,3,1,2)
-    #     uv_detail_normals = uv_detail_normals * self.uv_face_eye_mask + \
-    #                         uv_coarse_normals * (1. - self.uv_face_eye_mask)
-    #     return uv_detail_normals
+        dec = self._decode_meshes(self._encode_cached(image))
+        with stage('detail_normals', self.device):
+            v = dec['v']
+            normals = vertex_normals(v, self.faces.expand(v.shape[0], -1, -1))
+            return self._disp2normal(dec['uv_z'], v, normals)
 
     def get_faces(self):
         if self.dense:
@@ -371,6 +744,53 @@ class DecaReconModel(FlameReconModel):
             faces = self.faces.cpu().detach().numpy().squeeze()
             return faces
 
+    @torch.inference_mode()
+    def reconstruct(self, image, tform=None, img_size=None):
+        """ Performs reconstruction of a batch of faces without using (or changing)
+        any per-call state stored on the model object, which makes it safe to call
+        from multiple threads at the same time. Runs in (scoped) inference mode.
+
+        Parameters
+        ----------
+        image : torch.Tensor
+            A 4D (B x 3 x 224 x 224) ``torch.Tensor`` representing a batch of RGB
+            images; a 3D tensor is interpreted as a single image
+        tform : np.ndarray
+            Either a 3x3 or a B x 3 x 3 array with the cropping matrix (or matrices),
+            e.g., the ``"tform"`` output of the crop model's ``crop`` method
+        img_size : tuple, np.ndarray
+            Original (before cropping) image size (width, height) or a B x 2 array
+            with image sizes, e.g., the ``"img_size"`` output of the crop model's
+            ``crop`` method
+
+        Returns
+        -------
+        out : dict
+            A dictionary with two keys: ``"v"``, the reconstructed vertices (a
+            B x V x 3 array) and ``"mat"``, a B x 4 x 4 array representing the
+            local-to-world matrices; if the model was created with ``albedo=True``,
+            it also contains the albedo maps (``"albedo"``, a B x 3 x H x W array
+            with RGB values between 0 and 1); if ``output_backend='torch'``, these
+            are tensors on the model's device
+
+        Examples
+        --------
+        >>> from flame.data import get_example_img
+        >>> from flame.crop import FanCropModel
+        >>> crop_model = FanCropModel(device='cpu')
+        >>> crop = crop_model.crop(get_example_img())
+        >>> recon_model = DecaReconModel(name='emoca-coarse', device='cpu')
+        >>> out = recon_model.reconstruct(crop['img_crop'], crop['tform'], crop['img_size'])
+        >>> out['v'].shape
+        (1, 5023, 3)
+        """
+        with stage('preprocess', self.device):
+            image = self._check_input(image, expected_wh=(224, 224))
+
+        enc_dict = self._encode_cached(image)
+        dec_dict = self._decode(enc_dict, tform=tform, img_size=img_size)
+        return dec_dict
+
     def __call__(self, image):
         """ Performs reconstruction of the face as a list of landmarks (vertices).
 
@@ -392,7 +812,8 @@ class DecaReconModel(FlameReconModel):
         -----
         Before calling ``__call__``, you *must* set the ``tform`` attribute to the
         estimated cropping matrix (see example below). This is necessary to encode the
-        relative position and scale of the bounding box into the reconstructed vertices.    
+        relative position and scale of the bounding box into the reconstructed vertices.
+        Use the ``reconstruct`` method to pass the cropping matrix per call instead.
         
         Examples
         --------
@@ -413,10 +834,12 @@ class DecaReconModel(FlameReconModel):
         (4, 4)
         """
 
-        image = self._check_input(image, expected_wh=(224, 224))
-        enc_dict = self._encode(image)
-        dec_dict = self._decode(enc_dict)
-        return dec_dict
+        out = self.reconstruct(image, tform=self.tform, img_size=self.img_size)
+        if out['v'].shape[0] == 1:
+            # Remove singleton batch dimension
+            out = {k: v[0] for k, v in out.items()}
+
+        return out
 
     def close(self):
-        pass
\ No newline at end of file
+        pass
@@ -150,7 +150,7 @@ class FLAME(nn.Module):
             betas = torch.cat([shape_params, expression_params], dim=1)
     
         if pose_params is None:
-            pose_params = torch.zeros((batch_size, 6)).to(shape_params.device)
+            pose_params = shape_params.new_zeros((batch_size, 6))
     
         full_pose = torch.cat(
             [
@@ -163,16 +163,19 @@ class FLAME(nn.Module):
         )
         template_vertices = self.v_template.unsqueeze(0).expand(batch_size, -1, -1)
 
-        vertices, T, _ = lbs(
-            betas,
-            full_pose,
-            template_vertices,
-            self.shapedirs,
-            self.posedirs,
-            self.J_regressor,
-            self.parents,
-            self.lbs_weights,
-        )
+        # Make sure the (precision-sensitive) skinning is not run in a lower precision
+        # when called inside an autocast context
+        with torch.autocast(betas.device.type, enabled=False):
+            vertices, T, _ = lbs(
+                betas,
+                full_pose,
+                template_vertices,
+                self.shapedirs,
+                self.posedirs,
+                self.J_regressor,
+                self.parents,
+                self.lbs_weights,
+            )
 
         return vertices, T
 
@@ -185,27 +188,37 @@ class FLAMETex(nn.Module):
     https://github.com/TimoBolkart/BFM_to_FLAME
     """
 
-    def __init__(self, model_path, n_tex):
+    def __init__(self, model_path, n_tex, size=256):
         super(FLAMETex, self).__init__()
+        self.size = size
         tex_space = np.load(model_path)
         texture_mean = tex_space["MU"].reshape(1, -1)
-        texture_basis = tex_space["PC"].reshape(-1, 199)  # 199 comp
-
-        texture_mean = torch.from_numpy(texture_mean).float()[None, ...]
-        texture_basis = torch.from_numpy(texture_basis[:, :n_tex]).float()[None, ...]
+        texture_basis = tex_space["PC"]  # 199 comp
+        texture_basis = texture_basis.reshape(-1, texture_basis.shape[-1])[:, :n_tex]
+
+        # Nearest neighbor resizing (and reordering the channels) is linear, so can be
+        # applied to the mean and basis once instead of to each decoded texture; the
+        # basis is stored as an n_tex x (3 x size x size) matrix, so decoding is a
+        # single matrix multiplication
+        texture_mean = self._to_output_space(torch.from_numpy(texture_mean).float())
+        texture_basis = self._to_output_space(torch.from_numpy(texture_basis.T.copy()).float())
         self.register_buffer("texture_mean", texture_mean)
         self.register_buffer("texture_basis", texture_basis)
 
+    def _to_output_space(self, textures):
+        """ Maps (flattened) 512 x 512 BGR textures to (flattened) 3 x size x size RGB
+        textures. """
+        textures = textures.reshape(-1, 512, 512, 3).permute(0, 3, 1, 2)
+        textures = F.interpolate(textures, [self.size, self.size])
+        return textures[:, [2, 1, 0], :, :].reshape(textures.shape[0], -1).contiguous()
+
     def forward(self, texcode):
         """
         texcode: [batchsize, n_tex]
-        texture: [bz, 3, 256, 256], range: 0-1
+        texture: [bz, 3, size, size], range: 0-1
         """
-        texture = self.texture_mean + (self.texture_basis * texcode[:, None, :]).sum(-1)
-        texture = texture.reshape(texcode.shape[0], 512, 512, 3).permute(0, 3, 1, 2)
-        texture = F.interpolate(texture, [256, 256])
-        texture = texture[:, [2, 1, 0], :, :]
-        return texture
+        texture = torch.addmm(self.texture_mean, texcode, self.texture_basis)
+        return texture.reshape(texcode.shape[0], 3, self.size, self.size)
 
 
 def to_tensor(array, dtype=torch.float32):
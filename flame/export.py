@@ -0,0 +1,320 @@
+""" Module to export the reconstruction models to ONNX and TorchScript and to run the
+exported graphs (with onnxruntime and torch, respectively). Each model is exported
+as two graphs: an encoder graph, which maps
+a batch of (cropped) images to the FLAME (and detail) parameters, and a decoder graph,
+which maps these parameters to the (coarse) vertices (including the ``lbs`` and
+``batch_rodrigues`` operations of the FLAME decoder) and, for dense models, the
+detail displacement maps.
+
+Examples
+--------
+Export the graphs explicitly:
+
+>>> from flame import DecaReconModel
+>>> from flame.export import export_onnx
+>>> model = DecaReconModel('emoca-coarse', device='cpu')  # doctest: +SKIP
+>>> paths = export_onnx(model, './emoca_coarse_onnx')  # doctest: +SKIP
+
+Or let the model export (and cache) the graphs and run them with onnxruntime:
+
+>>> model = DecaReconModel('emoca-coarse', device='cpu', backend='onnx')  # doctest: +SKIP
+"""
+
+import os
+import torch
+import shutil
+import threading
+import hashlib
+import warnings
+import torch.nn.functional as F
+from torch import nn
+from pathlib import Path
+
+from .utils import get_logger, get_cache_dir
+
+logger = get_logger()
+
+
+class DecaEncoderGraph(nn.Module):
+    """ Encoder graph of a ``DecaReconModel``: image -> FLAME (and detail) parameters. """
+    def __init__(self, model):
+        super().__init__()
+        self.encoders = nn.ModuleDict({key: getattr(model, key) for key in model._encoder_keys})
+        self.param_dict = model.param_dict
+        self.decompose = model._decompose_params
+        self.input_names = ['image']
+        self.output_names = [key[2:] for key in self.param_dict]  # trim off n_
+        if 'E_detail' in self.encoders:
+            self.output_names.append('detail')
+
+    def forward(self, image):
+        enc_dict = self.decompose(self.encoders['E_flame'](image), self.param_dict)
+
+        if 'E_detail' in self.encoders:
+            enc_dict['detail'] = self.encoders['E_detail'](image)
+
+        if 'E_expression' in self.encoders:
+            enc_dict['exp'] = self.encoders['E_expression'](image)
+
+        return tuple(enc_dict[key] for key in self.output_names)
+
+
+class DecaDecoderGraph(nn.Module):
+    """ Decoder graph of a ``DecaReconModel``: FLAME (and detail) parameters ->
+    vertices, global rotation (and displacement maps). """
+    def __init__(self, model):
+        super().__init__()
+        self.D_flame = model.D_flame
+        self.D_detail = model.D_detail if model.dense else None
+        self.input_names = ['shape', 'exp', 'pose'] + (['detail'] if model.dense else [])
+        self.output_names = ['v', 'R'] + (['uv_z'] if model.dense else [])
+
+    def forward(self, shape, exp, pose, detail=None):
+        v, R = self.D_flame(shape_params=shape, expression_params=exp, pose_params=pose)
+        if self.D_detail is None:
+            return v, R.mean(dim=1)
+
+        uv_z = self.D_detail(torch.cat([pose[:, 3:], exp, detail], dim=1))
+        return v, R.mean(dim=1), uv_z
+
+
+class MicaEncoderGraph(nn.Module):
+    """ Encoder graph of a ``MicaReconModel``: image -> FLAME shape parameters. """
+    def __init__(self, model):
+        super().__init__()
+        self.E_arcface = model.E_arcface
+        self.E_flame = model.E_flame
+        self.input_names = ['image']
+        self.output_names = ['shape']
+
+    def forward(self, image):
+        return self.E_flame(F.normalize(self.E_arcface(image)))
+
+
+class MicaDecoderGraph(nn.Module):
+    """ Decoder graph of a ``MicaReconModel``: FLAME shape parameters -> vertices. """
+    def __init__(self, model):
+        super().__init__()
+        self.D_flame = model.D_flame
+        self.input_names = ['shape']
+        self.output_names = ['v']
+
+    def forward(self, shape):
+        v, _ = self.D_flame(shape)
+        return v
+
+
+def _get_graphs(model):
+    """ Returns the encoder and decoder graph (modules) of a reconstruction model. """
+    if model.__class__.__name__ == 'MicaReconModel':
+        return MicaEncoderGraph(model), MicaDecoderGraph(model)
+
+    return DecaEncoderGraph(model), DecaDecoderGraph(model)
+
+
+def export_onnx(model, out_dir, opset=17):
+    """ Exports a (torch) reconstruction model to an encoder and decoder ONNX graph,
+    both with a dynamic batch dimension.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model (with the 'torch' backend); should not be quantized
+    out_dir : str, Path
+        Output directory (created if it does not exist)
+    opset : int
+        ONNX opset version
+
+    Returns
+    -------
+    paths : dict
+        Dictionary with the paths to the ``"encoder"`` and ``"decoder"`` graphs
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    encoder, decoder = _get_graphs(model)
+    w, h = model._crop_img_size
+    image = torch.rand(2, 3, h, w, device=model.device)
+
+    with torch.no_grad():
+        enc = encoder(image)
+        enc = enc if isinstance(enc, tuple) else (enc,)
+        dec_inputs = tuple(enc[encoder.output_names.index(name)] for name in decoder.input_names)
+
+    paths = {}
+    for graph, inputs, name in [(encoder, (image,), 'encoder'), (decoder, dec_inputs, 'decoder')]:
+        paths[name] = out_dir / f'{name}.onnx'
+        dynamic_axes = {n: {0: 'batch'} for n in graph.input_names + graph.output_names}
+
+        with warnings.catch_warnings(), torch.no_grad():
+            # Silence (many) tracer warnings about converting tensors to Python values
+            # (e.g., the FLAME kinematic tree), which are constant anyway
+            warnings.simplefilter('ignore')
+            torch.onnx.export(graph.eval(), inputs, str(paths[name]), input_names=graph.input_names,
+                              output_names=graph.output_names, dynamic_axes=dynamic_axes,
+                              opset_version=opset, dynamo=False)
+
+    return paths
+
+
+class TracedGraph:
+    """ Runs an encoder or decoder graph as a frozen TorchScript module, which is traced
+    (and optimized for inference) once for each batch size it is called with; tracing
+    is relatively slow, so use ``warmup`` (of the reconstruction model) to trace the
+    graph for the expected batch size(s) in advance.
+
+    Parameters
+    ----------
+    graph : nn.Module
+        Encoder or decoder graph (e.g., ``DecaEncoderGraph``)
+    """
+    def __init__(self, graph):
+        self.graph = graph.eval()
+        self.output_names = graph.output_names
+        self._traced = {}
+        self._lock = threading.Lock()
+
+    @property
+    def batch_sizes(self):
+        """ The batch sizes for which the graph has been traced. """
+        return sorted(self._traced)
+
+    def _trace(self, inputs):
+        logger.info(f"Tracing {self.graph.__class__.__name__} for batch size {inputs[0].shape[0]}")
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            traced = torch.jit.trace(self.graph, inputs, check_trace=False)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    def __call__(self, *inputs):
+        """ Runs the graph and returns a dictionary with the outputs. """
+        batch_size = inputs[0].shape[0]
+        if batch_size not in self._traced:
+            # Make sure that the graph is only traced once (if called from multiple threads)
+            with self._lock:
+                if batch_size not in self._traced:
+                    self._traced[batch_size] = self._trace(inputs)
+
+        outputs = self._traced[batch_size](*inputs)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        return dict(zip(self.output_names, outputs))
+
+    def __getstate__(self):
+        # TorchScript modules and locks cannot be pickled, so the graph is traced again
+        # when needed (e.g., in a spawned worker process)
+        return {'graph': self.graph, 'output_names': self.output_names}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._traced = {}
+        self._lock = threading.Lock()
+
+
+class OnnxGraph:
+    """ Runs an (exported) ONNX graph with onnxruntime on CPU, with torch tensors as
+    inputs and outputs.
+
+    Parameters
+    ----------
+    f_onnx : str, Path
+        Path to the ONNX graph
+    n_threads : int, tuple
+        Number of intra-op threads or a tuple with the number of intra-op and inter-op
+        threads; if 0 or ``None``, onnxruntime chooses the number of threads; if the
+        number of inter-op threads is larger than 1, independent operations (e.g.,
+        the different encoders) are run in parallel
+    """
+    def __init__(self, f_onnx, n_threads=None):
+        self.f_onnx = Path(f_onnx)
+        self.n_threads = n_threads
+        self._create_session()
+
+    def _create_session(self):
+        import onnxruntime as ort
+
+        intra, inter = self.n_threads if isinstance(self.n_threads, (tuple, list)) else (self.n_threads, None)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = intra or 0
+        opts.inter_op_num_threads = inter or 0
+        if inter is not None and inter > 1:
+            opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.session = ort.InferenceSession(str(self.f_onnx), opts, providers=['CPUExecutionProvider'])
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+        self.output_names = [out.name for out in self.session.get_outputs()]
+
+    def __call__(self, *inputs):
+        """ Runs the graph and returns a dictionary with the outputs (as tensors). """
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = self.session.run(None, feed)
+        return {name: torch.from_numpy(out) for name, out in zip(self.output_names, outputs)}
+
+    def __getstate__(self):
+        # Sessions cannot be pickled, so are recreated (e.g., in a spawned worker process)
+        return {'f_onnx': self.f_onnx, 'n_threads': self.n_threads}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_session()
+
+
+def load_traced_graphs(model):
+    """ Creates the encoder and decoder graphs of a model as ``TracedGraph`` objects.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model (with all torch submodels loaded)
+
+    Returns
+    -------
+    encoder, decoder : TracedGraph
+        The encoder and decoder graphs
+    """
+    encoder, decoder = _get_graphs(model)
+    return TracedGraph(encoder), TracedGraph(decoder)
+
+
+def _cache_key(model):
+    """ Creates a key that identifies the exported graphs of a model, which changes
+    when any of the data (files) or relevant settings of the model change. """
+    items = [model.__class__.__name__, getattr(model, 'name', ''), str(model.fold_bn), torch.__version__]
+    for path in sorted(str(p) for p in model.cfg.values()):
+        if os.path.isfile(path):
+            items.append(f'{path}:{os.path.getmtime(path)}')
+
+    return hashlib.sha1('|'.join(items).encode()).hexdigest()[:16]
+
+
+def load_onnx_graphs(model, n_threads=None):
+    """ Loads the encoder and decoder graphs of a model with onnxruntime; the graphs
+    are exported (and cached, see ``flame.utils.get_cache_dir``) if necessary.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model (with all torch submodels loaded)
+    n_threads : int, tuple
+        Number of onnxruntime threads (see ``OnnxGraph``)
+
+    Returns
+    -------
+    encoder, decoder : OnnxGraph
+        The encoder and decoder graphs
+    """
+    out_dir = get_cache_dir() / 'onnx' / f"{getattr(model, 'name', 'mica')}-{_cache_key(model)}"
+    if not out_dir.is_dir():
+        logger.info(f"Exporting ONNX graphs to {out_dir}")
+        # Export to a temporary directory first, so that an interrupted export (or
+        # another process exporting at the same time) cannot leave incomplete graphs
+        tmp_dir = out_dir.with_name(f'{out_dir.name}.{os.getpid()}.tmp')
+        export_onnx(model, tmp_dir)
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # Already exported by another process
+            shutil.rmtree(tmp_dir)
+
+    return OnnxGraph(out_dir / 'encoder.onnx', n_threads), OnnxGraph(out_dir / 'decoder.onnx', n_threads)
@@ -0,0 +1,124 @@
+""" Module with an identity-locked reconstruction model for videos of a single person,
+which estimates the identity (FLAME shape) once with MICA and per frame only the
+expression, pose and camera parameters with DECA/EMOCA. """
+
+import copy
+import torch
+
+from .core import FlameReconModel
+from .decoders import FLAME
+from .lbs import blend_shapes
+from .profiling import stage
+
+
+class IdentityLockedReconModel(FlameReconModel):
+    """ Reconstructs (a video of) a single person with a fixed identity: the FLAME shape
+    is estimated once by ``MicaReconModel`` (from one or more keyframes, see
+    ``set_identity``) and is "baked" into the template of the FLAME decoder, so per frame
+    only the DECA/EMOCA encoders and the expression and pose part of FLAME are run.
+    This is cheaper than running both models per frame and gives the same identity
+    across frames.
+
+    Parameters
+    ----------
+    name : str
+        Name of the DECA-like model that estimates the expression, pose and camera
+        parameters ('deca-coarse', 'deca-dense', 'emoca-coarse', or 'emoca-dense')
+    device : str
+        Either 'cuda' (uses GPU) or 'cpu'
+    **kwargs
+        Extra arguments for ``DecaReconModel`` (e.g., ``fold_bn``, ``encoder_mode`` or
+        ``precision``); only the 'torch' backend is supported
+
+    Notes
+    -----
+    The DECA shape parameters are discarded, so the (MICA) identity may differ slightly
+    in size from the face that the camera parameters were estimated for.
+
+    Examples
+    --------
+    >>> model = IdentityLockedReconModel('emoca-coarse', device='cpu')  # doctest: +SKIP
+    >>> model.set_identity(mica_crops)  # e.g., InsightFaceCropModel crops of keyframes  # doctest: +SKIP
+    >>> out = model.reconstruct(deca_crops, tform, img_size)  # doctest: +SKIP
+    """
+    def __init__(self, name='emoca-coarse', device='cuda', **kwargs):
+        from . import DecaReconModel, MicaReconModel
+
+        if kwargs.get('backend', 'torch') != 'torch':
+            raise ValueError("The identity-locked model only supports the 'torch' backend!")
+
+        self.name = name
+        self.device = device
+        self.deca = DecaReconModel(name, device=device, **kwargs)
+        self.mica = MicaReconModel(device=device, fold_bn=kwargs.get('fold_bn', True))
+        self._crop_img_size = self.deca._crop_img_size
+        self.shape = None
+
+        # FLAME decoder without shape components (the shape is in its template)
+        self._flame_exp = FLAME(self.deca.cfg['flame_path'], n_shape=0, n_exp=50).to(device).eval()
+
+    def _crop_kwargs(self, crops):
+        return self.deca._crop_kwargs(crops)
+
+    def _dummy_kwargs(self, batch_size):
+        return self.deca._dummy_kwargs(batch_size)
+
+    @torch.inference_mode()
+    def set_identity(self, image):
+        """ Estimates the identity (shape) from one or more (key)frames, which is used
+        for all subsequent reconstructions.
+
+        Parameters
+        ----------
+        image : torch.Tensor
+            A B x 3 x 112 x 112 tensor with MICA crops (e.g., from
+            ``InsightFaceCropModel`` or ``CombinedCropModel``) of the same person; the
+            shape estimates of multiple images are averaged
+
+        Returns
+        -------
+        shape : torch.Tensor
+            A 1 x 300 tensor with the (average) MICA shape parameters
+        """
+        with stage('preprocess', self.device):
+            image = self.mica._check_input(image, expected_wh=self.mica._crop_img_size)
+
+        shape = self.mica._encode(image).mean(dim=0, keepdim=True)
+
+        # Apply the identity to the template once (the same as the shape part of `lbs`)
+        D_mica = self.mica.D_flame
+        v_template = D_mica.v_template + blend_shapes(shape, D_mica.shapedirs)[0]
+
+        D_flame = copy.deepcopy(self._flame_exp)
+        D_flame.v_template = v_template.clone()
+
+        # Swap the decoder at once, such that concurrent calls use either the old or new
+        # identity (and not a mix)
+        self.deca.D_flame = D_flame
+        self.shape = shape
+        return shape
+
+    @torch.inference_mode()
+    def reconstruct(self, image, tform=None, img_size=None):
+        """ Reconstructs a batch of (DECA/EMOCA) crops with the identity set by
+        ``set_identity``; the arguments and outputs are the same as
+        ``DecaReconModel.reconstruct``.
+
+        Raises
+        ------
+        ValueError
+            If the identity has not been set yet
+        """
+        if self.shape is None:
+            raise ValueError("Set the identity (with `set_identity`) before reconstructing!")
+
+        with stage('preprocess', self.device):
+            image = self.deca._check_input(image, expected_wh=self._crop_img_size)
+
+        enc_dict = self.deca._encode_cached(image)
+        # The identity is part of the FLAME template already
+        enc_dict['shape'] = enc_dict['shape'][:, :0]
+        return self.deca._decode(enc_dict, tform=tform, img_size=img_size)
+
+    def get_faces(self):
+        return self.deca.get_faces()
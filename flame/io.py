@@ -0,0 +1,192 @@
+""" Module with functionality to read frames from image directories and video files
+and to store (per-frame) reconstruction results in a chunked output directory with a
+progress manifest, such that interrupted jobs can be resumed. """
+
+import os
+import json
+import numpy as np
+from pathlib import Path
+from skimage.io import imread
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+class FrameReader:
+    """ Reads frames (as RGB numpy arrays) from either a directory with images
+    (sorted by filename) or a video file.
+
+    Parameters
+    ----------
+    path : str, Path
+        Path to a directory with images or to a video file
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+        if self.path.is_dir():
+            self.files = sorted(f for f in self.path.iterdir()
+                                if f.suffix.lower() in IMG_EXTENSIONS)
+            self.n_frames = len(self.files)
+        elif self.path.is_file():
+            import cv2
+            self.files = None
+            cap = cv2.VideoCapture(str(self.path))
+            if not cap.isOpened():
+                raise ValueError(f"Could not open video {self.path}!")
+
+            self.n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            self.fps = cap.get(cv2.CAP_PROP_FPS)
+            cap.release()
+        else:
+            raise ValueError(f"{self.path} is neither a directory nor a (video) file!")
+
+    @property
+    def is_video(self):
+        return self.files is None
+
+    def __len__(self):
+        return self.n_frames
+
+    def iter_frames(self, start=0, stop=None):
+        """ Yields (frame index, frame) tuples for the frames from ``start`` up to
+        (but not including) ``stop``; for videos, the reader seeks to ``start``
+        directly instead of decoding all preceding frames. """
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+
+        if not self.is_video:
+            for idx in range(start, stop):
+                yield idx, np.array(imread(self.files[idx]))[..., :3]
+            return
+
+        import cv2
+        cap = cv2.VideoCapture(str(self.path))
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        try:
+            for idx in range(start, stop):
+                success, frame = cap.read()
+                if not success:
+                    break
+
+                yield idx, frame[:, :, ::-1]  # BGR -> RGB
+        finally:
+            cap.release()
+
+
+class ChunkedStore:
+    """ Output store that saves results in chunks (``chunk_000000.npz``, etc.) of
+    ``chunk_size`` frames and keeps track of finished chunks in ``manifest.json``.
+
+    Parameters
+    ----------
+    directory : str, Path
+        Output directory (created if it does not exist)
+    n_frames : int
+        Total number of frames
+    chunk_size : int
+        Number of frames per chunk
+    meta : dict
+        Extra (JSON-serializable) metadata, e.g., the source and model name;
+        when resuming, this should match the metadata in the existing manifest
+
+    Notes
+    -----
+    If ``n_frames`` is ``None``, an existing store is opened (e.g., to load the
+    results or to write chunks from a worker process) without checking or updating
+    its manifest.
+
+    Raises
+    ------
+    ValueError
+        If the directory already contains a manifest with different settings
+    """
+    def __init__(self, directory, n_frames=None, chunk_size=256, meta=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._f_manifest = self.directory / 'manifest.json'
+
+        settings = {'n_frames': n_frames, 'chunk_size': chunk_size, 'meta': meta or {}}
+        if self._f_manifest.is_file():
+            with open(self._f_manifest, 'r') as f_in:
+                self.manifest = json.load(f_in)
+
+            if n_frames is not None:
+                for key, value in settings.items():
+                    if self.manifest[key] != value:
+                        raise ValueError(f"Existing output in {self.directory} was created "
+                                         f"with {key}={self.manifest[key]}, not {value}!")
+        else:
+            if n_frames is None:
+                raise ValueError(f"No manifest found in {self.directory}!")
+
+            self.manifest = {**settings, 'done': []}
+            self._save_manifest()
+
+        self.n_frames = self.manifest['n_frames']
+        self.chunk_size = self.manifest['chunk_size']
+
+        if n_frames is not None:
+            # Chunks are written atomically, so chunk files that are not (yet) listed
+            # in the manifest (e.g., written by a worker process right before an
+            # interruption) are complete as well
+            written = [int(f.stem.split('_')[1]) for f in self.directory.glob('chunk_*.npz')
+                       if not f.name.endswith('.tmp.npz')]
+            if set(written) - set(self.manifest['done']):
+                self.mark_done(written)
+
+    @property
+    def n_chunks(self):
+        return int(np.ceil(self.n_frames / self.chunk_size))
+
+    def chunk_range(self, idx):
+        """ Returns the (start, stop) frame indices of chunk ``idx``. """
+        start = idx * self.chunk_size
+        return start, min(start + self.chunk_size, self.n_frames)
+
+    def is_done(self, idx):
+        return idx in self.manifest['done']
+
+    def todo(self):
+        """ Returns the indices of the chunks that still need to be processed. """
+        return [idx for idx in range(self.n_chunks) if not self.is_done(idx)]
+
+    def _save_manifest(self):
+        # Write to a temporary file first, so that an interruption cannot leave
+        # a corrupted manifest behind
+        f_tmp = self._f_manifest.with_suffix('.tmp')
+        with open(f_tmp, 'w') as f_out:
+            json.dump(self.manifest, f_out, indent=2)
+
+        os.replace(f_tmp, self._f_manifest)
+
+    def write_chunk(self, idx, **arrays):
+        """ Writes the arrays of chunk ``idx`` without updating the manifest, which
+        is safe to do from multiple (worker) processes at the same time. """
+        f_chunk = self.directory / f'chunk_{idx:06d}.npz'
+        f_tmp = self.directory / f'chunk_{idx:06d}.tmp.npz'
+        np.savez(f_tmp, **arrays)
+        os.replace(f_tmp, f_chunk)
+
+    def mark_done(self, idx):
+        """ Marks one or more chunks as done in the manifest. """
+        self.manifest['done'] = sorted(set(self.manifest['done']) | set(np.atleast_1d(idx).tolist()))
+        self._save_manifest()
+
+    def write(self, idx, **arrays):
+        """ Writes the arrays of chunk ``idx`` and marks it as done. """
+        self.write_chunk(idx, **arrays)
+        self.mark_done(idx)
+
+    def read(self, idx):
+        """ Reads the arrays of chunk ``idx``. """
+        with np.load(self.directory / f'chunk_{idx:06d}.npz') as data:
+            return dict(data)
+
+    def load(self):
+        """ Loads and concatenates all (finished) chunks, in order. """
+        chunks = [self.read(idx) for idx in range(self.n_chunks) if self.is_done(idx)]
+        if not chunks:
+            return {}
+
+        return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
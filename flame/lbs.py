@@ -65,17 +65,26 @@ def lbs(
         matrices. The default value is True. If False, then the pose tensor
         should already contain rotation matrices and have a size of
         Bx(J + 1)x9
-    dtype: torch.dtype, optional
 
     Returns
     -------
     verts: torch.tensor BxVx3
         The vertices of the mesh after applying the shape and pose
-        displacements.
+        displacements, in float32 (or float64, for float64 inputs)
     joints: torch.tensor BxJx3
         The joints of the model
+
+    Notes
+    -----
+    Inputs with a lower precision (e.g., bfloat16 parameters from encoders run
+    under autocast) are promoted to float32 first, as the blend shapes, joint
+    regression and skinning are long sums (over thousands of vertices) that lose
+    too much precision otherwise.
     """
-    dtype = torch.float32
+    dtype = torch.promote_types(v_template.dtype, torch.float32)
+    betas, pose, v_template = betas.to(dtype), pose.to(dtype), v_template.to(dtype)
+    shapedirs, posedirs = shapedirs.to(dtype), posedirs.to(dtype)
+    J_regressor, lbs_weights = J_regressor.to(dtype), lbs_weights.to(dtype)
 
     batch_size = max(betas.shape[0], pose.shape[0])
     device = betas.device
@@ -159,9 +168,10 @@ def batch_rodrigues(rot_vecs, epsilon=1e-8):
     Returns
     -------
     R: torch.tensor Nx3x3
-        The rotation matrices for the given axis-angle parameters
+        The rotation matrices for the given axis-angle parameters (with the same
+        dtype as ``rot_vecs``)
     """
-    dtype = torch.float32
+    dtype = rot_vecs.dtype
 
     batch_size = rot_vecs.shape[0]
     device = rot_vecs.device
@@ -211,8 +221,6 @@ def batch_rigid_transform(rot_mats, joints, parents):
         Locations of joints
     parents : torch.tensor BxN
         The kinematic tree of each object
-    dtype : torch.dtype, optional:
-        The data type of the created tensors, the default is torch.float32
 
     Returns
     -------
@@ -222,7 +230,6 @@ def batch_rigid_transform(rot_mats, joints, parents):
         The relative (with respect to the root joint) rigid transformations
         for all the joints
     """
-    dtype = torch.float32
     joints = torch.unsqueeze(joints, dim=-1)
 
     rel_joints = joints.clone()
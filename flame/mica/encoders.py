@@ -1,4 +1,5 @@
 import os
+import contextlib
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -114,6 +115,14 @@ class IResNet(nn.Module):
                 if isinstance(m, IBasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
 
+    def _autocast(self, x):
+        # Runs in float16 (on GPU) or bfloat16 (on CPU) if fp16 is set; otherwise, any
+        # enclosing autocast context (e.g., of the reconstruction model) is left as is
+        if self.fp16:
+            return torch.autocast(x.device.type)
+
+        return contextlib.nullcontext()
+
     def _make_layer(self, block, planes, blocks, stride=1, dilate=False):
         downsample = None
         previous_dilation = self.dilation
@@ -141,7 +150,7 @@ class IResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        with torch.cuda.amp.autocast(self.fp16):
+        with self._autocast(x):
             x = self.conv1(x)
             x = self.bn1(x)
             x = self.prelu(x)
@@ -174,7 +183,7 @@ class Arcface(IResNet):
         return x
 
     def forward_arcface(self, x):
-        with torch.cuda.amp.autocast(self.fp16):
+        with self._autocast(x):
             ### FROZEN ###
             with torch.no_grad():
                 x = self.conv1(x)
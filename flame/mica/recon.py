@@ -5,40 +5,112 @@ from collections import OrderedDict
 
 from ..core import FlameReconModel
 from ..decoders import FLAME
+from ..profiling import stage
+from ..export import load_onnx_graphs, load_traced_graphs
+from ..optimize import load_folded, quantize_static, quantize_dynamic
 from .encoders import MappingNetwork, Arcface
 
 
 class MicaReconModel(FlameReconModel):
+    """ A 3D face reconstruction model (MICA) that estimates the FLAME shape (identity)
+    parameters from a cropped (112 x 112) image.
 
+    Parameters
+    ----------
+    device : str
+        Either 'cuda' (uses GPU) or 'cpu'
+    fold_bn : bool
+        Whether to fold the batch norm layers of the Arcface encoder into its
+        convolutions (see ``flame.optimize.fold_batchnorm``), which speeds up inference
+    backend : str
+        Either 'torch', 'jit', or 'onnx'; 'jit' traces the encoders and decoder into
+        (frozen) TorchScript graphs, once per batch size (see ``warmup``); 'onnx' exports
+        them to ONNX graphs (once, see ``flame.export``) and runs these with onnxruntime
+        (on CPU only)
+    onnx_threads : int, tuple
+        Number of intra-op threads or a tuple with the number of intra-op and inter-op
+        threads used by onnxruntime (only used if ``backend='onnx'``)
+    precision : str
+        Either 'float32' or 'bfloat16'; the latter runs the Arcface encoder with
+        bfloat16 autocast and the channels last memory format (see
+        ``DecaReconModel``; only used if ``backend='torch'``)
+    output_backend : str
+        Either 'numpy' or 'torch'; the latter returns the outputs of ``reconstruct`` as
+        (float32) tensors on the model's device (see ``DecaReconModel``)
+    """
     # May have some speed benefits
     torch.backends.cudnn.benchmark = True
 
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', fold_bn=True, backend='torch', onnx_threads=None,
+                 precision='float32', output_backend='numpy'):
         self.device = device
+        self.fold_bn = fold_bn
+        self.backend = backend
+        self.precision = precision
+        self.output_backend = output_backend
+        self._crop_img_size = (112, 112)
+        self._crop_norm = (127.5, 127.5)  # (mean, scale) of crops (see InsightFaceCropModel)
         self._load_cfg()  # method inherited from parent
+        self._check()
         self._create_submodels()
         self._load_submodels()
 
+        if self.backend == 'jit':
+            self._encoder_graph, self._decoder_graph = load_traced_graphs(self)
+        elif self.backend == 'onnx':
+            self._encoder_graph, self._decoder_graph = load_onnx_graphs(self, onnx_threads)
+
+            # The (torch) encoders are not needed anymore, so free their memory
+            self.E_arcface, self.E_flame = None, None
+
+        self._update_cache_namespace()
+
+    def _check(self):
+        """ Does some checks of the parameters. """
+        BACKENDS = ['torch', 'jit', 'onnx']
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Backend must be in {BACKENDS}, but got {self.backend}!")
+
+        if self.backend == 'onnx' and self.device != 'cpu':
+            raise ValueError("The 'onnx' backend only supports device 'cpu'!")
+
+        PRECISIONS = ['float32', 'bfloat16']
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Precision must be in {PRECISIONS}, but got {self.precision}!")
+
+        if self.precision != 'float32' and self.backend != 'torch':
+            raise ValueError("Only the 'torch' backend supports 'bfloat16' precision!")
+
+        OUTPUT_BACKENDS = ['numpy', 'torch']
+        if self.output_backend not in OUTPUT_BACKENDS:
+            raise ValueError(f"Output backend must be in {OUTPUT_BACKENDS}, but got {self.output_backend}!")
+
     def _create_submodels(self):
-        """ Loads the submodels associated with MICA. To summarizes:
+        """ Loads the submodels associated with MICA (except `E_arcface`, which is
+        created when loading its weights). To summarizes:
         - `E_arcface`: predicts a 512-D embedding for a (cropped, 112x112) image
         - `E_flame`: predicts (coarse) FLAME parameters given a 512-D embedding
         - `D_flame`: outputs a ("coarse") mesh given shape FLAME parameters
         """
-        self.E_arcface = Arcface().to(self.device)
-        self.E_arcface.eval()
         self.E_flame = MappingNetwork(512, 300, 300).to(self.device)
         self.E_flame.eval()
         self.D_flame = FLAME(self.cfg['flame_path'], n_shape=300, n_exp=0).to(self.device)
         self.D_flame.eval()
-        torch.set_grad_enabled(False)  # apparently speeds up forward pass, too
 
     def _load_submodels(self):
         """ Loads the weights for the Arcface submodel as well as the MappingNetwork
         that predicts FLAME shape parameters from the Arcface output. """
-        checkpoint = torch.load(self.cfg['mica_path'])
-        self.E_arcface.load_state_dict(checkpoint['arcface'])
-        
+        checkpoint = torch.load(self.cfg['mica_path'], map_location=self.device)
+
+        if self.fold_bn:
+            # Fold batch norm layers into the convolutions (and share the folded
+            # model with other MICA models with the same memory format)
+            self.E_arcface = load_folded(lambda: self._load_arcface(checkpoint),
+                                         self.cfg['mica_path'], 'arcface', self.device,
+                                         self._memory_format)
+        else:
+            self.E_arcface = self._to_memory_format(self._load_arcface(checkpoint))
+
         # The original weights also included the data for the FLAME model (template
         # vertices, faces, etc), which we don't need here, because we use a common
         # FLAME decoder model (in decoders.py)
@@ -51,22 +123,93 @@ class MicaReconModel(FlameReconModel):
         
         self.E_flame.load_state_dict(new_checkpoint)
 
+    def _load_arcface(self, checkpoint=None):
+        """ Creates the Arcface submodel and loads its (original) weights. """
+        if checkpoint is None:
+            checkpoint = torch.load(self.cfg['mica_path'], map_location=self.device)
+
+        model = Arcface().to(self.device)
+        model.load_state_dict(checkpoint['arcface'])
+        return model.eval()
+
+    def _quantize_encoders(self, images, batch_size=16):
+        """ Quantizes the encoders (see ``FlameReconModel.quantize``). """
+        # A folded Arcface model cannot be quantized (batch norm layers are folded
+        # during quantization anyway), so we start from the original model
+        arcface = self._load_arcface() if self.fold_bn else self.E_arcface
+        return {
+            'E_arcface': quantize_static(arcface, images, batch_size),
+            'E_flame': quantize_dynamic(self.E_flame),
+        }
+
+    def _decode_flame(self, code):
+        """ Decodes the FLAME vertices (in model space). """
+        v, _ = self.D_flame(code)
+        return v
+
     def _encode(self, image):
-        image = self._check_input(image, expected_wh=(112, 112))        
-        out_af = self.E_arcface(image)  # output of arcface
-        out_af = F.normalize(out_af)
-        return self.E_flame(out_af)
+        if self.backend != 'torch':
+            with stage(f'E_{self.backend}', self.device):
+                return self._encoder_graph(image)['shape']
+
+        with stage('E_arcface', self.device), self._autocast():
+            out_af = self.E_arcface(self._to_memory_format(image))  # output of arcface
+            out_af = F.normalize(out_af.float())
+
+        with stage('E_flame', self.device):
+            return self.E_flame(out_af)
 
     def _decode(self, code):
 
-        v, _ = self.D_flame(code)
-        v = v.squeeze().detach().cpu()
-        out = {'v': v, 'mat': np.eye(4)}
+        if self.backend != 'torch':
+            with stage(f'D_{self.backend}', self.device):
+                v = self._decoder_graph(code)['v']
+        else:
+            with stage('D_flame', self.device):
+                v, _ = self.D_flame(code)
+
+        if self.output_backend == 'torch':
+            v = v.to(self.device)
+            mat = torch.eye(4, device=self.device).repeat(v.shape[0], 1, 1)
+        else:
+            v = v.detach().cpu().numpy()
+            mat = np.tile(np.eye(4), (v.shape[0], 1, 1))
+
+        out = {'v': v, 'mat': mat}
 
         return out
 
-    def __call__(self, image):
-        image = self._check_input(image, expected_wh=(112, 112))
-        enc_dict = self._encode(image)
+    @torch.inference_mode()
+    def reconstruct(self, image):
+        """ Performs reconstruction of a batch of (112 x 112) faces without using
+        any per-call state stored on the model object (so it is safe to call from
+        multiple threads at the same time). Runs in (scoped) inference mode.
+
+        Parameters
+        ----------
+        image : torch.Tensor
+            A 4D (B x 3 x 112 x 112) ``torch.Tensor`` representing a batch of
+            cropped images; a 3D tensor is interpreted as a single image
+
+        Returns
+        -------
+        out : dict
+            A dictionary with two keys: ``"v"``, the reconstructed vertices (a
+            B x 5023 x 3 array) and ``"mat"``, a B x 4 x 4 array with (identity)
+            local-to-world matrices (tensors on the model's device if
+            ``output_backend='torch'``)
+        """
+        with stage('preprocess', self.device):
+            image = self._check_input(image, expected_wh=(112, 112))
+
+        enc_dict = self._encode_cached(image)
         dec_dict = self._decode(enc_dict)
-        return dec_dict
\ No newline at end of file
+        return dec_dict
+
+    def __call__(self, image):
+        out = self.reconstruct(image)
+        if out['v'].shape[0] == 1:
+            # Remove singleton batch dimension
+            out = {k: v[0] for k, v in out.items()}
+
+        return out
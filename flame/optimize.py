@@ -0,0 +1,322 @@
+""" Module with (load-time) optimizations of the inference-only encoders, such as
+folding the batch normalization layers of the ResNet (``ResnetEncoder``) and IResNet
+(``Arcface``) backbones into the adjacent convolution (and linear) layers (such that
+these do not have to be run as separate operations), stacking multiple encoders
+with the same architecture into a single, vectorized module, and (int8) quantization
+of the encoders for CPU inference.
+
+Examples
+--------
+>>> from flame.deca.encoders import ResnetEncoder
+>>> from flame.optimize import fold_batchnorm
+>>> encoder = fold_batchnorm(ResnetEncoder(outsize=236).eval())
+"""
+
+import copy
+import torch
+import weakref
+from torch import nn
+import torch.nn.functional as F
+from pathlib import Path
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+# Folded modules, which are shared by all reconstruction models that load the same
+# submodel (from the same checkpoint) on the same device, for as long as any model
+# uses them
+_folded_cache = weakref.WeakValueDictionary()
+
+
+def _bn_scale_shift(bn):
+    """ Returns the per-channel scale and shift of a batch norm layer in eval mode. """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale.detach(), shift.detach()
+
+
+class PreNormConv2d(nn.Conv2d):
+    """ A convolution that is preceded by a batch norm layer (as in ``IBasicBlock``),
+    with the batch norm folded into the convolution.
+
+    The batch norm scale is folded into the weights, but the shift cannot simply be
+    folded into the bias, because the zero padding of the convolution is applied
+    *after* the batch norm (so the padded border is not shifted). Instead, the shift
+    is applied as a bias map, which is constant except at the borders; this map only
+    depends on the spatial size of the input and is cached per size.
+
+    Parameters
+    ----------
+    conv : nn.Conv2d
+        The convolution (with or without bias)
+    bn : nn.BatchNorm2d
+        The batch norm layer (in eval mode) that precedes the convolution
+    """
+    def __init__(self, conv, bn):
+        if conv.groups != 1 or conv.padding_mode != 'zeros':
+            raise ValueError("Can only fold batch norm into (non-grouped) convolutions "
+                             "with zero padding!")
+
+        super().__init__(conv.in_channels, conv.out_channels, conv.kernel_size,
+                         stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                         bias=True, device=conv.weight.device, dtype=conv.weight.dtype)
+
+        scale, shift = _bn_scale_shift(bn)
+        weight = conv.weight.detach()
+        with torch.no_grad():
+            self.weight.copy_(weight * scale[None, :, None, None])
+            if conv.bias is None:
+                self.bias.zero_()
+            else:
+                self.bias.copy_(conv.bias)
+
+        # The shift summed over input channels, per kernel location (out x 1 x kh x kw);
+        # convolving a map of ones with this kernel yields the bias map
+        self.register_buffer('shift_kernel', (weight * shift[None, :, None, None]).sum(dim=1, keepdim=True))
+        self._bias_maps = {}
+        self.train(conv.training)
+
+    def _bias_map(self, x):
+        key = (tuple(x.shape[2:]), x.device, x.dtype)
+        if key not in self._bias_maps:
+            # Make sure that the cached map is a normal tensor (not an inference tensor)
+            with torch.inference_mode(False), torch.no_grad():
+                ones = torch.ones((1, 1) + key[0], device=x.device, dtype=self.shift_kernel.dtype)
+                bias_map = F.conv2d(ones, self.shift_kernel, None, self.stride, self.padding,
+                                    self.dilation)
+                self._bias_maps[key] = bias_map.to(x.dtype)
+
+        return self._bias_maps[key]
+
+    def forward(self, x):
+        out = super().forward(x)
+        return out + self._bias_map(x).to(out.dtype)
+
+
+def _fold_pre_linear(linear, bn):
+    """ Folds a batch norm layer that precedes a (flattened) linear layer into it. """
+    scale, shift = _bn_scale_shift(bn)
+    # Each channel corresponds to a contiguous block of (flattened) input features
+    n_rep = linear.in_features // scale.numel()
+    scale, shift = scale.repeat_interleave(n_rep), shift.repeat_interleave(n_rep)
+
+    folded = nn.Linear(linear.in_features, linear.out_features, device=linear.weight.device,
+                       dtype=linear.weight.dtype)
+    with torch.no_grad():
+        bias = linear.weight @ shift
+        if linear.bias is not None:
+            bias += linear.bias
+
+        folded.weight.copy_(linear.weight * scale[None, :])
+        folded.bias.copy_(bias)
+
+    return folded.train(linear.training)
+
+
+def fold_batchnorm(model):
+    """ Folds all batch norm layers of a ``ResnetEncoder`` (or ``ResNet``) or ``Arcface``
+    (or ``IResNet``) model into the adjacent convolution/linear layers, which are
+    replaced by folded versions (and the batch norm layers by ``nn.Identity``).
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model (in eval mode!) to optimize, which is modified in place
+
+    Returns
+    -------
+    model : nn.Module
+        The optimized model; note that its ``state_dict`` is not compatible with
+        the original model anymore
+
+    Raises
+    ------
+    ValueError
+        If the model is not in eval mode
+    """
+    # Imported here to avoid circular imports (the reconstruction models use this module)
+    from .deca.encoders import ResNet, Bottleneck, BasicBlock
+    from .mica.encoders import IResNet, IBasicBlock
+
+    if model.training:
+        raise ValueError("Can only fold batch norm layers of models in eval mode!")
+
+    for module in list(model.modules()):
+        if isinstance(module, (ResNet, IResNet)):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+            module.bn1 = nn.Identity()
+
+        if isinstance(module, IResNet):
+            # The final batch norm precedes the (flattened) fully-connected layer (the
+            # dropout in between does nothing at inference), which in turn precedes
+            # the (1D) feature batch norm
+            module.fc = _fold_pre_linear(module.fc, module.bn2)
+            module.fc = fuse_linear_bn_eval(module.fc, module.features)
+            module.bn2, module.features = nn.Identity(), nn.Identity()
+        elif isinstance(module, (Bottleneck, BasicBlock)):
+            convs = ['conv1', 'conv2', 'conv3'] if isinstance(module, Bottleneck) else ['conv1', 'conv2']
+            for i, conv in enumerate(convs, start=1):
+                setattr(module, conv, fuse_conv_bn_eval(getattr(module, conv), getattr(module, f'bn{i}')))
+                setattr(module, f'bn{i}', nn.Identity())
+        elif isinstance(module, IBasicBlock):
+            # bn1 -> conv1 -> bn2 -> prelu -> conv2 -> bn3
+            conv1 = fuse_conv_bn_eval(module.conv1, module.bn2)
+            module.conv1 = PreNormConv2d(conv1, module.bn1)
+            module.conv2 = fuse_conv_bn_eval(module.conv2, module.bn3)
+            module.bn1, module.bn2, module.bn3 = nn.Identity(), nn.Identity(), nn.Identity()
+
+        if getattr(module, 'downsample', None) is not None:
+            conv, bn = module.downsample
+            module.downsample = fuse_conv_bn_eval(conv, bn)
+
+    return model
+
+
+def load_folded(create, f_ckpt, key, device, memory_format=torch.contiguous_format):
+    """ Returns a (cached) folded submodel, so that multiple reconstruction models
+    that use the same submodel (e.g., 'emoca-coarse' and 'emoca-dense') share a single
+    copy of it, which is only loaded and folded once. Models with a different memory
+    format get their own copy, so the cached models should not be modified.
+
+    Parameters
+    ----------
+    create : callable
+        Function without arguments that returns the submodel with its (original)
+        weights loaded; only called if the submodel is not cached yet
+    f_ckpt : str, Path
+        Path to the checkpoint with the submodel's weights
+    key : str
+        Name of the submodel (e.g., 'E_flame')
+    device : str
+        Device of the submodel
+    memory_format : torch.memory_format
+        Memory format of the submodel's weights (e.g., ``torch.channels_last``)
+
+    Returns
+    -------
+    model : nn.Module
+        The folded submodel (in eval mode)
+    """
+    f_ckpt = Path(f_ckpt).resolve()
+    cache_key = (str(f_ckpt), f_ckpt.stat().st_mtime, key, str(device), str(memory_format))
+
+    model = _folded_cache.get(cache_key)
+    if model is None:
+        model = fold_batchnorm(create().eval())
+        if memory_format != torch.contiguous_format:
+            model = model.to(memory_format=memory_format)
+
+        _folded_cache[cache_key] = model
+
+    return model
+
+
+class StackedEncoders(nn.Module):
+    """ Runs multiple ``ResnetEncoder`` models (with different weights) on the same
+    input as a single module, by stacking the weights of their (identical) ResNet
+    backbones and vectorizing the backbone over the stacked weights (with
+    ``torch.vmap``); the (different) output layers are run separately.
+
+    This turns many small operations into fewer, larger operations, which makes better
+    use of the available cores at small batch sizes (where a single encoder cannot).
+
+    Parameters
+    ----------
+    encoders : list
+        List of ``ResnetEncoder`` models (in eval mode), which should either all or
+        none be folded (see ``fold_batchnorm``)
+
+    Notes
+    -----
+    The stacked weights are a copy of the original weights, so this needs extra
+    memory (as long as the original encoders are kept as well).
+    """
+    def __init__(self, encoders):
+        from torch.func import stack_module_state
+
+        super().__init__()
+        params, buffers = stack_module_state([enc.encoder for enc in encoders])
+        self._names = list(params) + list(buffers)
+        for name, tensor in {**params, **buffers}.items():
+            # Buffer names cannot contain dots
+            self.register_buffer(name.replace('.', '__'), tensor.detach())
+
+        self.heads = nn.ModuleList([enc.layers for enc in encoders])
+        self.last_ops = [enc.last_op for enc in encoders]
+
+        # Backbone "skeleton" (without data) used for the functional calls; stored in a
+        # list so that it is not registered as a submodule
+        self._backbone = [copy.deepcopy(encoders[0].encoder).to('meta')]
+
+    def forward(self, x):
+        """ Returns a list with the outputs of each encoder. """
+        from torch.func import functional_call
+
+        tensors = {name: getattr(self, name.replace('.', '__')) for name in self._names}
+
+        def run_backbone(tensors, x):
+            return functional_call(self._backbone[0], tensors, (x,))
+
+        # Stacked features: n_encoders x B x 2048
+        features = torch.vmap(run_backbone, in_dims=(0, None))(tensors, x)
+
+        outs = []
+        for feat, head, last_op in zip(features, self.heads, self.last_ops):
+            out = head(feat)
+            outs.append(last_op(out) if last_op else out)
+
+        return outs
+
+
+def quantize_static(model, images, batch_size=16):
+    """ Quantizes a model (to int8) with post-training static quantization (using
+    FX graph mode quantization), which quantizes both weights and activations; the
+    activation ranges are calibrated by running the model on the given images.
+    Conv-BN pairs are fused automatically, so the model should *not* be folded
+    (see ``fold_batchnorm``) beforehand. The quantized model only runs on CPU.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model (in eval mode) to quantize; is not modified
+    images : torch.Tensor
+        A B x 3 x H x W tensor with (preprocessed) calibration images, which should be
+        representative of the images the model will be used for
+    batch_size : int
+        Batch size used for calibration
+
+    Returns
+    -------
+    model : torch.fx.GraphModule
+        The quantized model
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(copy.deepcopy(model).cpu().eval(), qconfig_mapping,
+                          example_inputs=(images[:1].cpu(),))
+
+    # Run calibration (i.e., record activation ranges)
+    with torch.inference_mode():
+        for start in range(0, images.shape[0], batch_size):
+            prepared(images[start:start + batch_size].cpu())
+
+    return convert_fx(prepared)
+
+
+def quantize_dynamic(model):
+    """ Quantizes the linear layers of a model (to int8) with dynamic quantization,
+    i.e., the weights are quantized ahead of time and the activations on the fly,
+    which does not need calibration. The quantized model only runs on CPU.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model (in eval mode) to quantize; is not modified
+
+    Returns
+    -------
+    model : nn.Module
+        The quantized model
+    """
+    from torch.ao.quantization import quantize_dynamic as _quantize_dynamic
+    return _quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
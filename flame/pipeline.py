@@ -0,0 +1,404 @@
+""" Module with a batch reconstruction pipeline, which crops and reconstructs frames
+from image directories or videos and stores the results in a (resumable) chunked
+output store. """
+
+import cv2
+import time
+import torch
+import numpy as np
+from itertools import islice
+
+from .io import FrameReader, ChunkedStore
+from .crop import FALLBACKS
+from .cache import source_key
+from .texture import TextureExtractor, average_store_textures
+from .utils import get_logger
+
+logger = get_logger()
+
+# Pipeline used by the current worker process (set by `_init_worker`)
+_worker_pipeline = None
+
+
+def load_models(name, device='cuda', backend='torch'):
+    """ Loads the crop model and reconstruction model associated with a particular
+    reconstruction model name.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reconstruction model ('mica', 'deca-coarse', 'deca-dense',
+        'emoca-coarse', or 'emoca-dense')
+    device : str
+        Either 'cuda' (uses GPU) or 'cpu'
+    backend : str
+        Backend of the reconstruction model ('torch', 'jit', or 'onnx')
+
+    Returns
+    -------
+    crop_model, recon_model
+        The initialized crop and reconstruction model
+    """
+    from .crop import FanCropModel, InsightFaceCropModel
+    from . import DecaReconModel, MicaReconModel
+
+    if name == 'mica':
+        return InsightFaceCropModel(device=device), MicaReconModel(device=device, backend=backend)
+
+    return FanCropModel(device=device), DecaReconModel(name, device=device, backend=backend)
+
+
+class ReconPipeline:
+    """ Crops and reconstructs frames in batches.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reconstruction model ('mica', 'deca-coarse', 'deca-dense',
+        'emoca-coarse', or 'emoca-dense')
+    device : str
+        Either 'cuda' (uses GPU) or 'cpu'
+    batch_size : int
+        Number of (cropped) images reconstructed at once
+    backend : str
+        Backend of the reconstruction model ('torch', 'jit', or 'onnx')
+    crop_cache : CropCache
+        If not ``None``, a cache of crop parameters (see ``flame.cache.CropCache``),
+        which is used when the source of the frames is known (see ``process``)
+    max_reuse : int
+        Maximum number of consecutive frames without a detected face for which the face
+        location of an earlier frame is reused (see ``BaseModel.crop_tracked``)
+    extract_texture : bool
+        Whether to also extract the texture (in UV space) of each frame (see
+        ``flame.texture.TextureExtractor``); not available for MICA
+    """
+    def __init__(self, name='emoca-coarse', device='cuda', batch_size=8, backend='torch',
+                 crop_cache=None, max_reuse=5, extract_texture=False):
+        self.name = name
+        self.device = device
+        self.batch_size = batch_size
+        self.crop_cache = crop_cache
+        self.max_reuse = max_reuse
+        self.crop_model, self.recon_model = load_models(name, device, backend)
+
+        self.texture_extractor = None
+        if extract_texture:
+            self.texture_extractor = TextureExtractor.from_model(self.recon_model)
+
+        # (frame index, crop output) of the last processed frame, to track faces
+        # across consecutive calls of `process`
+        self._last_crop = (None, None)
+
+    @property
+    def n_verts(self):
+        """ Number of vertices of the reconstructed meshes. """
+        if getattr(self.recon_model, 'dense', False):
+            return self.recon_model.dense_template['valid_pixel_3d_faces'].shape[0]
+
+        return self.recon_model.D_flame.v_template.shape[0]
+
+    def _reconstruct(self, crops):
+        """ Reconstructs a list of crop results in batches. """
+        outs = []
+        for start in range(0, len(crops), self.batch_size):
+            batch = crops[start:start + self.batch_size]
+            img_crop = torch.cat([crop['img_crop'] for crop in batch])
+            if self.name == 'mica':
+                outs.append(self.recon_model.reconstruct(img_crop))
+            else:
+                tform = np.concatenate([crop['tform'] for crop in batch])
+                img_size = np.concatenate([crop['img_size'] for crop in batch])
+                outs.append(self.recon_model.reconstruct(img_crop, tform, img_size))
+
+        return {key: np.concatenate([out[key] for out in outs]) for key in outs[0]}
+
+    def _process_batch(self, crops, images):
+        """ Reconstructs a batch of crops and, optionally, extracts the textures from the
+        corresponding images. """
+        recon = self._reconstruct(crops)
+        if self.texture_extractor is not None:
+            img_size = np.concatenate([crop['img_size'] for crop in crops])
+            textures, masks = self.texture_extractor.extract(images, recon['v'], img_size)
+            textures = (textures.permute(0, 2, 3, 1) * 255).round().byte()
+            recon['texture'] = textures.cpu().numpy()
+            recon['texture_mask'] = masks.cpu().numpy()
+
+        return recon
+
+    def process(self, frames, source=None):
+        """ Crops and reconstructs a sequence of frames.
+
+        Parameters
+        ----------
+        frames : iterable
+            Iterable of (frame index, RGB image) tuples, e.g., from
+            ``FrameReader.iter_frames``
+        source : str
+            Key of the source of the frames (see ``flame.cache.source_key``), which is
+            needed to use the ``crop_cache``
+
+        Returns
+        -------
+        out : dict
+            Dictionary with the frame indices (``"frame_idx"``), vertices (``"v"``),
+            world matrices (``"mat"``), crop matrices (``"tform"``), original image
+            sizes (``"img_size"``), landmarks (``"lm"``) and crop boxes (``"bbox"``, see
+            ``flame.qc.QCRenderer``) in the original images, whether a face was detected (``"detected"``) and
+            how (``"fallback"``, the index in ``flame.crop.FALLBACKS`` or -1 if no face
+            was found); the outputs of frames without a detected face are NaN (or zero);
+            if ``extract_texture`` is enabled, it also contains the textures
+            (``"texture"``, N x 256 x 256 x 3, uint8) and which texels are visible
+            (``"texture_mask"``)
+
+        Notes
+        -----
+        Consecutive frames are cropped with ``crop_tracked``, so frames in which the
+        face is not detected fall back on the face location of the previous frame.
+        The frames are reconstructed as soon as a batch of faces is found, so only the
+        images of a single batch are kept in memory (for texture extraction).
+        """
+        use_cache = self.crop_cache is not None and source is not None
+        frame_idx, crops = [], []
+        last_idx, prev = self._last_crop
+        recons, batch = [], []  # (positions of the crops, reconstruction) and pending batch
+        for idx, img in frames:
+            frame_idx.append(idx)
+            # Only track the face across consecutive frames
+            prev = prev if last_idx is not None and idx == last_idx + 1 else None
+            try:
+                if use_cache:
+                    crop = self.crop_cache.crop(self.crop_model, img, source, idx, track=True,
+                                                prev=prev, max_reuse=self.max_reuse)
+                else:
+                    crop = self.crop_model.crop_tracked(img, prev, self.max_reuse)
+            except ValueError:
+                logger.warning(f"No face detected in frame {idx}!")
+                crop = None
+
+            crops.append(crop)
+            last_idx, prev = idx, crop
+
+            if crop is not None:
+                batch.append((len(crops) - 1, img))
+                if len(batch) == self.batch_size:
+                    recons.append(self._flush(batch, crops))
+                    batch = []
+
+        if batch:
+            recons.append(self._flush(batch, crops))
+
+        self._last_crop = (last_idx, prev)
+        if use_cache:
+            self.crop_cache.commit()
+
+        n = len(frame_idx)
+        out = {
+            'frame_idx': np.array(frame_idx, dtype=np.int64),
+            'v': np.full((n, self.n_verts, 3), np.nan, dtype=np.float32),
+            'mat': np.full((n, 4, 4), np.nan),
+            'tform': np.full((n, 3, 3), np.nan),
+            'img_size': np.zeros((n, 2), dtype=np.int64),
+            'lm': np.full((n, self.crop_model.n_lm, 2), np.nan, dtype=np.float32),
+            'bbox': np.full((n, 4, 2), np.nan, dtype=np.float32),
+            'detected': np.array([crop is not None for crop in crops]),
+            'fallback': np.array([-1 if crop is None else FALLBACKS.index(crop['fallback'])
+                                  for crop in crops], dtype=np.int8),
+        }
+
+        n_fallback = int((out['fallback'] > 0).sum())
+        if n_fallback > 0:
+            logger.info(f"Used a detection fallback for {n_fallback} of {n} frames")
+
+        if self.texture_extractor is not None:
+            size = self.recon_model.uv_table.size
+            out['texture'] = np.zeros((n, size, size, 3), dtype=np.uint8)
+            out['texture_mask'] = np.zeros((n, size, size), dtype=bool)
+
+        for pos, recon in recons:
+            for key, value in recon.items():
+                out[key][pos] = value
+
+            out['tform'][pos] = np.concatenate([crops[i]['tform'] for i in pos])
+            out['img_size'][pos] = np.concatenate([crops[i]['img_size'] for i in pos])
+            out['lm'][pos] = np.concatenate([crops[i]['lm'] for i in pos])
+            out['bbox'][pos] = np.concatenate([crops[i]['bbox'] for i in pos])
+
+        return out
+
+    def _flush(self, batch, crops):
+        """ Processes a batch of (position, image) tuples of frames with a face. """
+        pos = [i for i, _ in batch]
+        recon = self._process_batch([crops[i] for i in pos], [img for _, img in batch])
+        return pos, recon
+
+    def run(self, source, out_dir, chunk_size=256, n_workers=1, n_threads=None):
+        """ Reconstructs all frames from an image directory or video and stores the
+        results in a chunked output store. If the output directory already contains
+        (partial) results from an earlier run, only the unfinished chunks are
+        processed.
+
+        Parameters
+        ----------
+        source : str, Path
+            Path to an image directory or video file
+        out_dir : str, Path
+            Path to the output directory
+        chunk_size : int
+            Number of frames per output chunk
+        n_workers : int
+            Number of worker processes; if larger than 1, the (unfinished) frames are
+            split into ``n_workers`` segments of contiguous frames which are decoded
+            (by seeking to the start of the segment), cropped, and reconstructed in
+            parallel (see ``run_segments``; CPU only)
+        n_threads : int
+            Number of torch threads per worker (only used if ``n_workers > 1``);
+            if ``None``, the available cores are divided over the workers
+
+        Returns
+        -------
+        store : ChunkedStore
+            The output store
+        """
+        reader = FrameReader(source)
+        meta = {'source': str(reader.path.resolve()), 'name': self.name}
+        source = source_key(reader.path)
+        store = ChunkedStore(out_dir, len(reader), chunk_size, meta)
+
+        todo = store.todo()
+        if len(todo) < store.n_chunks:
+            logger.info(f"Resuming: {store.n_chunks - len(todo)} of {store.n_chunks} "
+                        "chunks already done")
+
+        if n_workers > 1:
+            self.run_segments(reader, store, todo, n_workers, n_threads)
+            self._save_texture(store)
+            return store
+
+        n_total, t_total = 0, 0.
+        for idx in todo:
+            t_start = time.time()
+            start, stop = store.chunk_range(idx)
+            out = self.process(reader.iter_frames(start, stop), source)
+            store.write(idx, **out)
+
+            t_chunk = time.time() - t_start
+            n_total, t_total = n_total + len(out['frame_idx']), t_total + t_chunk
+            logger.info(f"Chunk {idx + 1}/{store.n_chunks}: {len(out['frame_idx'])} frames "
+                        f"({len(out['frame_idx']) / t_chunk:.2f} fps)")
+
+        if n_total > 0:
+            logger.info(f"Processed {n_total} frames in {t_total:.1f} sec. "
+                        f"({n_total / t_total:.2f} fps)")
+
+        self._save_texture(store)
+        return store
+
+    def _save_texture(self, store):
+        """ Saves the average texture of all (finished) frames in the store. """
+        if self.texture_extractor is None:
+            return
+
+        texture, count = average_store_textures(store)
+        if texture is not None:
+            f_out = store.directory / 'texture.png'
+            cv2.imwrite(str(f_out), (texture.permute(1, 2, 0).numpy()[:, :, ::-1] * 255).round().astype(np.uint8))
+            logger.info(f"Saved the average texture to {f_out}")
+
+    def run_segments(self, reader, store, chunks, n_workers, n_threads=None):
+        """ Processes the given chunks in parallel by splitting them into segments of
+        contiguous frames, one per worker process. Each worker seeks to the start of
+        its segment (instead of decoding the video from the start) and writes its
+        chunks to the store directly; together, the chunks form a single, ordered
+        output.
+
+        The workers are forked from the current process, so they share the (already
+        loaded) model weights as copy-on-write pages. Because CUDA cannot be used in
+        forked processes, this only works for pipelines on CPU.
+
+        Parameters
+        ----------
+        reader : FrameReader
+            Reader of the source frames
+        store : ChunkedStore
+            The output store
+        chunks : list
+            Indices of the chunks to process
+        n_workers : int
+            Number of worker processes
+        n_threads : int
+            Number of torch threads per worker; if ``None``, the available cores are
+            divided over the workers
+
+        Raises
+        ------
+        ValueError
+            If the pipeline does not run on CPU
+        """
+        if self.device != 'cpu':
+            raise ValueError("Multiple workers are only supported on CPU, not on "
+                             f"'{self.device}'; use n_workers=1 instead!")
+
+        if not chunks:
+            return
+
+        if n_threads is None:
+            n_threads = max(1, torch.get_num_threads() // n_workers)
+
+        segments = _split_segments(chunks, n_workers)
+        args = [(str(reader.path), str(store.directory), segment) for segment in segments]
+
+        t_start, n_total = time.time(), 0
+        ctx = torch.multiprocessing.get_context('fork')
+        with ctx.Pool(min(n_workers, len(segments)), initializer=_init_worker,
+                      initargs=(self, n_threads)) as pool:
+            for segment, n_frames in pool.imap_unordered(_process_segment, args):
+                store.mark_done(segment)
+                n_total += n_frames
+                logger.info(f"Segment with chunks {segment[0] + 1}-{segment[-1] + 1} "
+                            f"(of {store.n_chunks}) done ({n_frames} frames)")
+
+        t_total = time.time() - t_start
+        logger.info(f"Processed {n_total} frames in {t_total:.1f} sec. "
+                    f"({n_total / t_total:.2f} fps)")
+
+
+def _split_segments(chunks, n_segments):
+    """ Splits a sorted list of chunk indices into (at least) ``n_segments``
+    segments of consecutive chunks. """
+    segments = []
+    for part in np.array_split(np.asarray(chunks), min(n_segments, len(chunks))):
+        # Also split on gaps (i.e., chunks that are already done)
+        breaks = np.flatnonzero(np.diff(part) > 1) + 1
+        segments.extend(seg.tolist() for seg in np.split(part, breaks))
+
+    return segments
+
+
+def _init_worker(pipeline, n_threads):
+    """ Initializes a worker process with the (inherited) pipeline. """
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+    pipeline.recon_model.set_num_threads(n_threads)
+
+
+def _process_segment(args):
+    """ Processes a segment of consecutive chunks in a worker process. """
+    source, out_dir, segment = args
+    reader = FrameReader(source)
+    store = ChunkedStore(out_dir)
+
+    # Seek to the start of the segment once and then decode sequentially
+    start, stop = store.chunk_range(segment[0])[0], store.chunk_range(segment[-1])[1]
+    frames = reader.iter_frames(start, stop)
+
+    # Do not track faces across segments (which are not contiguous)
+    _worker_pipeline._last_crop = (None, None)
+
+    n_frames = 0
+    for idx in segment:
+        c_start, c_stop = store.chunk_range(idx)
+        out = _worker_pipeline.process(islice(frames, c_stop - c_start), source_key(source))
+        store.write_chunk(idx, **out)
+        n_frames += len(out['frame_idx'])
+
+    return segment, n_frames
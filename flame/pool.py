@@ -0,0 +1,169 @@
+""" Module with a process pool to run reconstruction models on many CPU cores.
+The model weights are loaded only once (in the main process) and moved to shared
+memory, such that all worker processes use the same copy of the weights. """
+
+import os
+import torch
+import numpy as np
+
+from .utils import get_logger
+
+logger = get_logger()
+
+# Model used by the current worker process (set by `_init_worker`)
+_worker_model = None
+
+
+def _init_worker(model, n_threads, cores_per_worker, counter):
+    """ Initializes a worker process by setting the (shared) model, the number of
+    torch threads and, optionally, the CPU cores the worker is allowed to run on. """
+    global _worker_model
+    _worker_model = model
+    torch.set_num_threads(n_threads)
+
+    if cores_per_worker is not None:
+        with counter.get_lock():
+            idx = counter.value
+            counter.value += 1
+
+        cores = cores_per_worker[idx % len(cores_per_worker)]
+        os.sched_setaffinity(0, cores)
+
+
+def _worker_reconstruct(args):
+    """ Reconstructs a single batch in a worker process. """
+    image, kwargs = args
+    return _worker_model.reconstruct(image, **kwargs)
+
+
+class ReconPool:
+    """ A pool of worker processes that reconstructs batches of (cropped) images in
+    parallel on the CPU, using a single copy of the model weights.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reconstruction model ('mica', 'deca-coarse', 'deca-dense',
+        'emoca-coarse', or 'emoca-dense')
+    n_workers : int
+        Number of worker processes; if ``None``, the number of available cores
+        divided by ``n_threads`` is used
+    n_threads : int
+        Number of (intra-op) torch threads per worker
+    pin_cores : bool
+        Whether to pin each worker to its own set of ``n_threads`` cores (Linux only)
+    batch_size : int
+        Number of images per batch sent to a worker
+    start_method : str
+        Either 'fork' (workers inherit the weights as copy-on-write pages) or 'spawn'
+        (weights are passed through shared memory)
+
+    Examples
+    --------
+    >>> with ReconPool('emoca-coarse', n_workers=4, n_threads=2) as pool:  # doctest: +SKIP
+    ...     out = pool.reconstruct(imgs, tform=tforms, img_size=(640, 480))
+    """
+    def __init__(self, name='emoca-coarse', n_workers=None, n_threads=1, pin_cores=False,
+                 batch_size=8, start_method='fork'):
+        self.name = name
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+        self._load_model()
+
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+        n_cores = len(cores) if cores is not None else os.cpu_count()
+        if n_workers is None:
+            n_workers = max(1, n_cores // n_threads)
+
+        self.n_workers = n_workers
+
+        cores_per_worker = None
+        if pin_cores:
+            if cores is None:
+                raise ValueError("Pinning cores is not supported on this platform!")
+
+            if n_workers * n_threads > n_cores:
+                logger.warning(f"Cannot pin {n_workers} workers x {n_threads} threads to "
+                               f"{n_cores} cores; some workers will share cores")
+
+            cores_per_worker = [
+                {cores[(i * n_threads + j) % n_cores] for j in range(n_threads)}
+                for i in range(n_workers)
+            ]
+
+        ctx = torch.multiprocessing.get_context(start_method)
+        counter = ctx.Value('i', 0)
+        self._pool = ctx.Pool(n_workers, initializer=_init_worker,
+                              initargs=(self.model, n_threads, cores_per_worker, counter))
+
+    def _load_model(self):
+        """ Loads the model (on CPU) and moves its weights to shared memory. """
+        from . import DecaReconModel, MicaReconModel
+
+        if self.name == 'mica':
+            self.model = MicaReconModel(device='cpu')
+        else:
+            self.model = DecaReconModel(self.name, device='cpu')
+
+        self.model.share_memory()
+
+    def _iter_batches(self, images, tform=None, img_size=None):
+        """ Splits the inputs into batches (and per-batch keyword arguments). """
+        n_img = images.shape[0]
+        for start in range(0, n_img, self.batch_size):
+            stop = min(start + self.batch_size, n_img)
+            kwargs = {}
+            if tform is not None:
+                tform_ = np.asarray(tform)
+                kwargs['tform'] = tform_[start:stop] if tform_.ndim == 3 else tform_
+
+            if img_size is not None:
+                img_size_ = np.asarray(img_size)
+                kwargs['img_size'] = img_size_[start:stop] if img_size_.ndim == 2 else img_size_
+
+            yield images[start:stop], kwargs
+
+    def imap(self, images, tform=None, img_size=None):
+        """ Reconstructs the images in batches (in parallel) and yields the results
+        per batch, in order.
+
+        Parameters
+        ----------
+        images : torch.Tensor, np.ndarray
+            A N x 3 x H x W tensor (or array) with cropped images
+        tform : np.ndarray
+            A 3 x 3 or N x 3 x 3 array with crop matrices (ignored for MICA)
+        img_size : tuple, np.ndarray
+            The original image size (width, height) or a N x 2 array with sizes
+            (ignored for MICA)
+
+        Yields
+        ------
+        out : dict
+            The output of the model's ``reconstruct`` method for a single batch
+        """
+        if not torch.is_tensor(images):
+            images = torch.as_tensor(images)
+
+        if self.name == 'mica':
+            tform, img_size = None, None
+
+        batches = self._iter_batches(images, tform, img_size)
+        yield from self._pool.imap(_worker_reconstruct, batches)
+
+    def reconstruct(self, images, tform=None, img_size=None):
+        """ Reconstructs the images in batches (in parallel) and returns the
+        concatenated results (see ``imap`` for the parameters). """
+        outs = list(self.imap(images, tform, img_size))
+        return {key: np.concatenate([out[key] for out in outs]) for key in outs[0]}
+
+    def close(self):
+        """ Shuts down the worker processes. """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
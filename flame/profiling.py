@@ -0,0 +1,215 @@
+""" Module with (opt-in) instrumentation of the different stages of the cropping and
+reconstruction models. The models mark their stages (e.g., 'detection', 'E_flame',
+'upsample') with the ``stage`` context manager, which does nothing unless a
+``Profiler`` is active.
+
+Examples
+--------
+>>> from flame.profiling import Profiler
+>>> with Profiler(memory=True) as prof:  # doctest: +SKIP
+...     crop = crop_model.crop(img)
+...     out = recon_model.reconstruct(crop['img_crop'], crop['tform'], crop['img_size'])
+>>> print(prof.report())  # doctest: +SKIP
+"""
+
+import os
+import time
+import torch
+import threading
+import contextvars
+import numpy as np
+from collections import defaultdict
+from contextlib import contextmanager
+
+# The active profiler; note that each thread has its own context, so a profiler
+# only records the stages run in the thread in which it was started
+_active_profiler = contextvars.ContextVar('flame_profiler', default=None)
+
+
+@contextmanager
+def stage(name, device=None):
+    """ Marks a stage of the pipeline, which is timed by the active profiler (if any).
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    device : str
+        Device the stage runs on; if 'cuda', the device is synchronized before and
+        after the stage for accurate timing
+    """
+    profiler = _active_profiler.get()
+    if profiler is None:
+        yield
+    else:
+        with profiler.record(name, device):
+            yield
+
+
+def _resident_memory():
+    """ Returns the current resident memory of the process (in bytes), or ``None`` if
+    it cannot be determined (i.e., on platforms without ``/proc``). """
+    try:
+        with open('/proc/self/statm', 'r') as f_in:
+            return int(f_in.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Profiler:
+    """ Records the wall time (and, optionally, peak memory) of each stage run while
+    the profiler is active (i.e., within its ``with`` block).
+
+    Parameters
+    ----------
+    memory : bool
+        Whether to record the memory per stage; for CUDA stages, this is the peak
+        allocated CUDA memory during the stage (including nested stages); for CPU
+        stages, this is the increase in resident memory of the process during the
+        stage (Linux only), as the peak memory of a single stage is not available
+    callback : callable
+        Function called after each stage as ``callback(name, seconds, memory)``,
+        where ``memory`` is in bytes (or ``None`` if ``memory=False``)
+    trace : str, Path
+        If not ``None``, also runs the torch profiler and exports a (Chrome) trace,
+        in which the stages are labelled, to this path
+
+    Attributes
+    ----------
+    times : dict
+        Dictionary with, for each stage, a list of durations (in seconds)
+    memory : dict
+        Dictionary with, for each stage, a list of peak memory values (in bytes)
+    """
+    def __init__(self, memory=False, callback=None, trace=None):
+        self.record_memory = memory
+        self.callbacks = [] if callback is None else [callback]
+        self.trace = trace
+        self.times = defaultdict(list)
+        self.memory = defaultdict(list)
+        self._token = None
+        self._torch_profiler = None
+        # Running CUDA peaks of the (nested) active stages, per thread
+        self._cuda_peaks = threading.local()
+
+    def add_callback(self, callback):
+        """ Adds a function that is called after each stage (see ``callback``). """
+        self.callbacks.append(callback)
+
+    def __enter__(self):
+        self._token = _active_profiler.set(self)
+        if self.trace is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+            self._torch_profiler = torch.profiler.profile(activities=activities)
+            self._torch_profiler.__enter__()
+
+        return self
+
+    def __exit__(self, *args):
+        _active_profiler.reset(self._token)
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(*args)
+            self._torch_profiler.export_chrome_trace(str(self.trace))
+            self._torch_profiler = None
+
+    def _cuda_peak_stack(self):
+        """ Returns the running CUDA peaks of the (nested) active stages of the current
+        thread; resetting the CUDA peak stats (at the start of a stage) would otherwise
+        lose the peak of the enclosing stage(s) so far. """
+        if not hasattr(self._cuda_peaks, 'stack'):
+            self._cuda_peaks.stack = []
+
+        return self._cuda_peaks.stack
+
+    @contextmanager
+    def record(self, name, device=None):
+        """ Records the duration (and memory) of a single stage. """
+        cuda = device is not None and 'cuda' in str(device) and torch.cuda.is_available()
+        peaks, rss_start = self._cuda_peak_stack(), None
+        if cuda:
+            torch.cuda.synchronize()
+            if self.record_memory:
+                if peaks:
+                    peaks[-1] = max(peaks[-1], torch.cuda.max_memory_allocated())
+
+                torch.cuda.reset_peak_memory_stats()
+                peaks.append(0)
+        elif self.record_memory:
+            rss_start = _resident_memory()
+
+        t_start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        except BaseException:
+            if cuda and self.record_memory:
+                peaks.pop()
+            raise
+
+        if cuda:
+            torch.cuda.synchronize()
+
+        duration = time.perf_counter() - t_start
+        self.times[name].append(duration)
+
+        mem = None
+        if self.record_memory:
+            if cuda:
+                mem = max(peaks.pop(), torch.cuda.max_memory_allocated())
+                if peaks:
+                    peaks[-1] = max(peaks[-1], mem)
+            elif rss_start is not None:
+                mem = _resident_memory() - rss_start
+
+            if mem is not None:
+                self.memory[name].append(mem)
+
+        for callback in self.callbacks:
+            callback(name, duration, mem)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """ Aggregates the recorded stages.
+
+        Parameters
+        ----------
+        percentiles : tuple
+            Percentiles of the durations to compute
+
+        Returns
+        -------
+        summary : dict
+            Dictionary with, for each stage, the number of calls (``"n"``), the total
+            and mean duration (``"total_ms"``, ``"mean_ms"``), the requested percentiles
+            (e.g., ``"p50_ms"``) and, if recorded, the maximum memory of all calls
+            (``"peak_mb"``, see ``memory``)
+        """
+        summary = {}
+        for name, times in self.times.items():
+            times = np.array(times) * 1000
+            summary[name] = {'n': len(times), 'total_ms': times.sum(), 'mean_ms': times.mean()}
+            for p in percentiles:
+                summary[name][f'p{p}_ms'] = np.percentile(times, p)
+
+            if self.memory[name]:
+                summary[name]['peak_mb'] = max(self.memory[name]) / 1024 ** 2
+
+        return summary
+
+    def report(self, percentiles=(50, 90, 99)):
+        """ Returns the summary (see ``summary``) as a formatted table. """
+        summary = self.summary(percentiles)
+        if not summary:
+            return "No stages recorded"
+
+        cols = list(next(iter(summary.values())).keys())
+        width = max(len(name) for name in summary) + 2
+        lines = ["stage".ljust(width) + "".join(f"{col:>11}" for col in cols)]
+        for name, stats in summary.items():
+            values = "".join(f"{stats.get(col, np.nan):>11.2f}" if col != 'n' else f"{stats[col]:>11d}"
+                             for col in cols)
+            lines.append(name.ljust(width) + values)
+
+        return "\n".join(lines)
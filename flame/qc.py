@@ -0,0 +1,267 @@
+""" Module to create quality control (QC) visualizations, which overlay the reconstructed
+meshes, landmarks and crop boxes onto the original frames. The overlays are rendered for
+batches of frames at once (with the torch rasterizer, see ``flame.renderer.rasterize``)
+and written to a video stream directly.
+
+Examples
+--------
+To render the results of ``flame recon`` (see ``flame.pipeline.ReconPipeline``):
+
+>>> from flame.qc import render_qc_video
+>>> render_qc_video('my_video_recon', 'my_video_qc.mp4', scale=0.5)  # doctest: +SKIP
+"""
+
+import cv2
+import torch
+import numpy as np
+from pathlib import Path
+from itertools import islice
+
+from .core import load_config
+from .profiling import stage
+from .io import FrameReader, ChunkedStore
+from .renderer import rasterize, world_to_raster
+from .utils import get_logger, face_vertices, vertex_normals, load_obj
+
+logger = get_logger()
+
+
+def load_faces(name):
+    """ Loads the faces (F x 3) of the meshes reconstructed by a model.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reconstruction model ('mica', 'deca-coarse', 'deca-dense',
+        'emoca-coarse', or 'emoca-dense')
+
+    Returns
+    -------
+    faces : np.ndarray
+        An F x 3 array with vertex indices
+    """
+    data_dir = Path(__file__).parent / 'data'
+    if 'dense' in name:
+        f_template = load_config().get('dense_template_path', data_dir / 'texture_data_256.npy')
+        template = np.load(f_template, allow_pickle=True, encoding='latin1').item()
+        return np.asarray(template['f'], dtype=np.int64)
+
+    _, _, faces, _ = load_obj(data_dir / 'head_template.obj')
+    return faces[0].numpy().astype(np.int64)
+
+
+class QCRenderer:
+    """ Overlays reconstructed meshes, landmarks and crop boxes onto batches of frames.
+
+    Each mesh is only rasterized within its bounding box (in the original frame), so the
+    cost of rendering depends on the size of the face rather than the size of the frame.
+
+    Parameters
+    ----------
+    faces : np.ndarray, torch.Tensor
+        An F x 3 array with the faces of the meshes (see ``load_faces``); if ``None``,
+        only the landmarks and crop boxes are drawn
+    device : str
+        Either 'cuda' or 'cpu'
+    scale : float
+        Factor by which the frames (and overlays) are resized, e.g., 0.5 renders at half
+        the resolution, which is considerably faster for long, high resolution videos
+    alpha : float
+        Opacity of the meshes
+    mesh_color, lm_color, box_color : tuple
+        RGB colors of the meshes, landmarks and crop boxes
+    lm_radius : int
+        Radius of the landmarks in pixels
+
+    Examples
+    --------
+    >>> renderer = QCRenderer(faces=None, device='cpu')
+    >>> frames = np.zeros((2, 100, 120, 3), dtype=np.uint8)
+    >>> bbox = np.tile([[[10, 10], [10, 50], [50, 10], [50, 50]]], (2, 1, 1))
+    >>> renderer.render(frames, bbox=bbox).shape
+    (2, 100, 120, 3)
+    """
+    def __init__(self, faces, device='cpu', scale=1., alpha=0.6, mesh_color=(170, 190, 255),
+                 lm_color=(0, 255, 0), box_color=(255, 0, 0), lm_radius=2):
+        self.faces = None
+        if faces is not None:
+            self.faces = torch.as_tensor(np.asarray(faces)).long().reshape(-1, 3).to(device)
+
+        self.device = device
+        self.scale = scale
+        self.alpha = alpha
+        self.mesh_color = torch.tensor(mesh_color, dtype=torch.float32, device=device)
+        self.lm_color = lm_color
+        self.box_color = box_color
+        self.lm_radius = lm_radius
+
+    def _to_output(self, points):
+        """ Maps pixel coordinates of the original frames to those of the (resized)
+        output frames (pixel centers are at integer coordinates). """
+        return (points + 0.5) * self.scale - 0.5
+
+    def _render_meshes(self, frames, v, img_size):
+        """ Renders (shaded) meshes onto a B x H x W x 3 float tensor with (resized)
+        frames, in place, given the original frame size (width, height). """
+        batch_size, h_out, w_out = frames.shape[:3]
+        v_raster = world_to_raster(v, np.tile(img_size, (batch_size, 1)))
+        v_raster = torch.cat([self._to_output(v_raster[..., :2]), v_raster[..., 2:]], dim=-1)
+
+        # Only rasterize the bounding box (within the frame) around each mesh; the
+        # rasterizer treats smaller (positive) depths as closer
+        size = torch.tensor([w_out, h_out], dtype=v.dtype, device=self.device)
+        xy_min = v_raster[..., :2].amin(dim=1).floor().clamp(min=0)
+        xy_max = torch.minimum(v_raster[..., :2].amax(dim=1).ceil(), size - 1)
+        extent = (xy_max - xy_min).amax(dim=0).long().clamp(min=0) + 1
+        depth = v_raster[..., 2].amax(dim=1, keepdim=True) - v_raster[..., 2] + 1
+        v_box = torch.cat([v_raster[..., :2] - xy_min[:, None, :], depth[..., None]], dim=-1)
+
+        faces = self.faces.expand(batch_size, -1, -1)
+        _, pix_to_face, bary = rasterize(face_vertices(v_box, faces), int(extent[1]), int(extent[0]))
+
+        # Lambertian shading with a light at the camera (interpolated vertex normals)
+        normals = vertex_normals(v, faces)
+        nz = face_vertices(normals, faces)[..., 2]  # B x F x 3
+        mask = pix_to_face > -1
+        b_idx = torch.arange(batch_size, device=self.device)[:, None, None]
+        shade = (nz[b_idx, pix_to_face.long().clamp(min=0)] * bary).sum(dim=-1).clamp(0, 1)
+        color = self.mesh_color * (0.3 + 0.7 * shade[..., None])
+
+        # Blend the boxes into the frames (which may be cut off at the right and bottom)
+        for i, (x0, y0) in enumerate(xy_min.long().tolist()):
+            h, w = min(mask.shape[1], h_out - y0), min(mask.shape[2], w_out - x0)
+            if h <= 0 or w <= 0:
+                continue
+
+            region = frames[i, y0:y0 + h, x0:x0 + w]
+            m = mask[i, :h, :w, None]
+            blended = (1 - self.alpha) * region + self.alpha * color[i, :h, :w]
+            frames[i, y0:y0 + h, x0:x0 + w] = torch.where(m, blended, region)
+
+    def render(self, frames, v=None, lm=None, bbox=None):
+        """ Renders the overlays onto a batch of frames.
+
+        Parameters
+        ----------
+        frames : list, np.ndarray
+            B RGB frames (height x width x 3, uint8) of the same size
+        v : np.ndarray, torch.Tensor
+            A B x V x 3 array with the reconstructed (world space) vertices; frames
+            without a reconstruction (i.e., NaN vertices) are skipped
+        lm : np.ndarray
+            A B x K x 2 array with landmarks (in pixels; NaN for frames without a face)
+        bbox : np.ndarray
+            A B x 4 x 2 array with the corners of the crop boxes (in pixels; NaN for
+            frames without a face), as returned by the crop models
+
+        Returns
+        -------
+        frames : np.ndarray
+            A B x H x W x 3 array (uint8) with the rendered frames (where H and W are
+            the height and width of the frames times ``scale``)
+        """
+        frames = np.stack(frames)
+        h, w = frames.shape[1:3]
+        if self.scale != 1:
+            size = (round(w * self.scale), round(h * self.scale))
+            frames = np.stack([cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames])
+
+        if v is not None and self.faces is not None:
+            v = torch.as_tensor(v, dtype=torch.float32, device=self.device)
+            valid = torch.nonzero(~v.isnan().any(dim=2).any(dim=1)).squeeze(1)
+            if len(valid) > 0:
+                with stage('qc_mesh', self.device):
+                    frames_t = torch.as_tensor(frames[valid.cpu().numpy()], device=self.device).float()
+                    self._render_meshes(frames_t, v[valid], (w, h))
+                    frames[valid.cpu().numpy()] = frames_t.round().byte().cpu().numpy()
+
+        with stage('qc_draw'):
+            for i, frame in enumerate(frames):
+                if bbox is not None and not np.isnan(bbox[i]).any():
+                    # Corners are ordered top left, bottom left, top right, bottom right
+                    corners = self._to_output(np.asarray(bbox[i])[[0, 1, 3, 2]])
+                    cv2.polylines(frame, [corners.round().astype(np.int32)], True, self.box_color,
+                                  thickness=max(1, round(2 * self.scale)))
+
+                if lm is not None:
+                    for x, y in self._to_output(np.asarray(lm[i])):
+                        if not (np.isnan(x) or np.isnan(y)):
+                            cv2.circle(frame, (round(x), round(y)), self.lm_radius, self.lm_color, -1)
+
+        return frames
+
+
+def render_qc_video(out_dir, f_out, source=None, batch_size=32, device='cpu', fps=None,
+                    **kwargs):
+    """ Renders a QC video of the results of a reconstruction pipeline (see
+    ``flame.pipeline.ReconPipeline.run``), i.e., the original frames with the
+    reconstructed meshes, landmarks and crop boxes. Frames of unfinished chunks (and
+    frames without a face) are written without overlays.
+
+    Parameters
+    ----------
+    out_dir : str, Path
+        Output directory of the reconstruction pipeline
+    f_out : str, Path
+        Path of the output video (e.g., an mp4 file)
+    source : str, Path
+        Path to the image directory or video file that was reconstructed; if ``None``,
+        the source stored in the manifest of the output directory is used
+    batch_size : int
+        Number of frames rendered at once
+    device : str
+        Either 'cuda' or 'cpu'
+    fps : float
+        Frame rate of the output video; if ``None``, the frame rate of the source video
+        (or 30, for image directories)
+    **kwargs
+        Extra arguments for the ``QCRenderer`` (e.g., ``scale``)
+
+    Returns
+    -------
+    n_frames : int
+        The number of frames written
+    """
+    store = ChunkedStore(out_dir)
+    meta = store.manifest['meta']
+    reader = FrameReader(source or meta['source'])
+    if len(reader) != store.n_frames:
+        raise ValueError(f"The source has {len(reader)} frames, but the results in {out_dir} "
+                         f"have {store.n_frames} frames!")
+
+    if fps is None:
+        fps = reader.fps if reader.is_video else 30.
+
+    renderer = QCRenderer(load_faces(meta['name']), device, **kwargs)
+    frames = reader.iter_frames()
+    writer, n_frames = None, 0
+    try:
+        for idx in range(store.n_chunks):
+            start, stop = store.chunk_range(idx)
+            chunk = store.read(idx) if store.is_done(idx) else {}
+            for b_start in range(0, stop - start, batch_size):
+                batch = [img for _, img in islice(frames, min(batch_size, stop - start - b_start))]
+                if not batch:
+                    break
+
+                sl = slice(b_start, b_start + len(batch))
+                out = renderer.render(batch, *[chunk[key][sl] if key in chunk else None
+                                               for key in ('v', 'lm', 'bbox')])
+
+                if writer is None:
+                    h, w = out.shape[1:3]
+                    writer = cv2.VideoWriter(str(f_out), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    if not writer.isOpened():
+                        raise ValueError(f"Could not open {f_out} for writing!")
+
+                with stage('qc_write'):
+                    for frame in out:
+                        writer.write(np.ascontiguousarray(frame[:, :, ::-1]))  # RGB -> BGR
+
+                n_frames += len(out)
+    finally:
+        if writer is not None:
+            writer.release()
+
+    logger.info(f"Wrote {n_frames} frames to {f_out}")
+    return n_frames
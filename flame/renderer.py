@@ -1,60 +1,247 @@
 import torch
+import numpy as np
 from torch import nn
 
 from .utils import face_vertices
+from .transforms import create_ortho_matrix, create_viewport_matrix
+
+
+def _barycentric(p, p0, p1, p2):
+    """ Computes the barycentric weights (N x 3) of points ``p`` (N x 2) in triangles
+    ``p0``, ``p1``, ``p2`` (each N x 2) in the same way as the CUDA rasterizer
+    (including the zero weights of degenerate triangles). """
+    v0, v1, v2 = p2 - p0, p1 - p0, p - p0
+    dot00, dot01, dot02 = (v0 * v0).sum(-1), (v0 * v1).sum(-1), (v0 * v2).sum(-1)
+    dot11, dot12 = (v1 * v1).sum(-1), (v1 * v2).sum(-1)
+
+    denom = dot00 * dot11 - dot01 * dot01
+    inv_denom = torch.where(denom == 0, torch.zeros_like(denom), 1 / denom)
+    u = (dot11 * dot02 - dot01 * dot12) * inv_denom
+    v = (dot00 * dot12 - dot01 * dot02) * inv_denom
+    return torch.stack([1 - u - v, v, u], dim=-1)
+
+
+def rasterize(f_vs, h, w, max_candidates=2 ** 22):
+    """ Rasterizes batches of triangles with (vectorized) torch operations, which works
+    on any device (unlike the ``rasterize_cuda`` extension) and gives the same buffers as
+    the CUDA rasterizer (up to the order of triangles with exactly the same depth at a
+    pixel, for which the lowest triangle index is picked).
+
+    Instead of looping over the triangles, the triangles are binned by the size of their
+    (pixel) bounding box, and all pixels in the bounding boxes of the triangles of a bin
+    are tested at once.
+
+    Parameters
+    ----------
+    f_vs : torch.Tensor
+        A B x F x 3 x 3 tensor with the (x, y, z) coordinates of the vertices of each
+        triangle, with x and y in pixel coordinates
+    h : int
+        Height of the image (in pixels)
+    w : int
+        Width of the image (in pixels)
+    max_candidates : int
+        Maximum number of (triangle, pixel) pairs that are tested at once, which limits
+        the memory use
+
+    Returns
+    -------
+    depth_buffer : torch.Tensor
+        A B x H x W tensor with the depth of the closest triangle (1e6 if none)
+    triangle_buffer : torch.Tensor
+        A B x H x W (int32) tensor with the index of the closest triangle (-1 if none)
+    baryw_buffer : torch.Tensor
+        A B x H x W x 3 tensor with the barycentric weights of the pixel in the closest
+        triangle (zeros if none)
+    """
+    bz, n_tri = f_vs.shape[:2]
+    device = f_vs.device
+    f_vs = f_vs.reshape(bz * n_tri, 3, 3)
+
+    xy = f_vs[..., :2]
+    x_min = xy[..., 0].min(dim=1)[0].ceil().clamp(min=0)
+    x_max = xy[..., 0].max(dim=1)[0].floor().clamp(max=w - 1)
+    y_min = xy[..., 1].min(dim=1)[0].ceil().clamp(min=0)
+    y_max = xy[..., 1].max(dim=1)[0].floor().clamp(max=h - 1)
+
+    # Skip triangles that do not cover any pixel (center)
+    keep = torch.nonzero((x_max >= x_min) & (y_max >= y_min)).squeeze(1)
+    x_min, y_min = x_min[keep].long(), y_min[keep].long()
+    box_w = x_max[keep].long() - x_min + 1
+    box_h = y_max[keep].long() - y_min + 1
+
+    # Bin the triangles by their bounding box size (rounded up to a power of two, except
+    # for small boxes, for which rounding up would waste most of the tested pixels), such
+    # that the pixels of the triangles of each bin fit in a box of the same size
+    def bin_size(size):
+        pow2 = 2 ** torch.ceil(torch.log2(size.double())).long()
+        return torch.where(size <= 16, size, pow2)
+
+    bin_idx = bin_size(box_w) * 2 ** 32 + bin_size(box_h)
+
+    depth = torch.full((bz * h * w,), 1e6, dtype=f_vs.dtype, device=device)
+    cand_pix, cand_tri, cand_z = [], [], []
+    for b_idx in torch.unique(bin_idx).tolist():
+        in_bin = torch.nonzero(bin_idx == b_idx).squeeze(1)
+        bw, bh = b_idx // 2 ** 32, b_idx % 2 ** 32
+        dy, dx = torch.meshgrid(torch.arange(bh, device=device),
+                                torch.arange(bw, device=device), indexing='ij')
+        dx, dy = dx.reshape(-1), dy.reshape(-1)
+
+        chunk_size = max(max_candidates // (bw * bh), 1)
+        for start in range(0, in_bin.numel(), chunk_size):
+            idx = in_bin[start:start + chunk_size]
+            px = x_min[idx, None] + dx
+            py = y_min[idx, None] + dy
+            valid = (dx < box_w[idx, None]) & (dy < box_h[idx, None])
+
+            tri = keep[idx, None].expand_as(px)[valid]
+            px, py = px[valid], py[valid]
+            face = f_vs[tri]
+            p = torch.stack([px, py], dim=-1).to(f_vs.dtype)
+            bary = _barycentric(p, face[:, 0, :2], face[:, 1, :2], face[:, 2, :2])
+
+            inside = (bary[:, 2] >= 0) & (bary[:, 1] >= 0) & (bary[:, 0] > 0)
+            tri, px, py, bary, face = tri[inside], px[inside], py[inside], bary[inside], face[inside]
+
+            # Perspective correct depth, as in the CUDA rasterizer
+            z = 1. / (bary / face[:, :, 2]).sum(dim=-1)
+            pix = (tri // n_tri) * h * w + py * w + px
+            depth.scatter_reduce_(0, pix, z, reduce='amin')
+            cand_pix.append(pix)
+            cand_tri.append(tri)
+            cand_z.append(z)
+
+    triangle = torch.full((bz * h * w,), bz * n_tri, dtype=torch.long, device=device)
+    if cand_pix:
+        pix, tri, z = torch.cat(cand_pix), torch.cat(cand_tri), torch.cat(cand_z)
+        closest = z == depth[pix]
+        triangle.scatter_reduce_(0, pix[closest], tri[closest], reduce='amin')
+
+    # Recompute the barycentric weights of the closest triangle per pixel
+    covered = torch.nonzero(triangle < bz * n_tri).squeeze(1)
+    baryw = torch.zeros((bz * h * w, 3), dtype=f_vs.dtype, device=device)
+    face = f_vs[triangle[covered]]
+    p = torch.stack([covered % w, (covered // w) % h], dim=-1).to(f_vs.dtype)
+    baryw[covered] = _barycentric(p, face[:, 0, :2], face[:, 1, :2], face[:, 2, :2])
+
+    triangle = torch.where(triangle < bz * n_tri, triangle % n_tri, -1).int()
+    return depth.view(bz, h, w), triangle.view(bz, h, w), baryw.view(bz, h, w, 3)
+
+
+def ndc_to_pixel(v, h, w):
+    """ Maps vertices (B x V x 3) from normalized device coordinates to the pixel
+    coordinates (and scaled depth) expected by the rasterizers. """
+    v = v.clone().float()
+    
+    v[..., :2] = -v[..., :2]
+    v[..., 0] = v[..., 0] * w/2 + w/2
+    v[..., 1] = v[..., 1] * h/2 + h/2
+    v[..., 0] = w - 1 - v[..., 0]
+    v[..., 1] = h - 1 - v[..., 1]
+    v[..., 0] = -1 + (2 * v[..., 0] + 1) / w
+    v[..., 1] = -1 + (2 * v[..., 1] + 1) / h
+
+    v[..., 0] = v[..., 0] * w/2 + w/2 
+    v[..., 1] = v[..., 1] * h/2 + h/2 
+    v[..., 2] = v[..., 2] * w/2
+    return v
+
+
+def world_to_raster(v, img_size):
+    """ Projects world space vertices to the raster space of the original images, with
+    the same (orthographic projection and viewport) matrices as used to create the world
+    matrices of the reconstruction models.
+
+    Parameters
+    ----------
+    v : torch.Tensor
+        A B x V x 3 tensor with world space vertices
+    img_size : np.ndarray
+        A B x 2 array with the image sizes (width, height)
+
+    Returns
+    -------
+    v_raster : torch.Tensor
+        A B x V x 3 tensor with the x and y coordinates in pixels and the world space z
+        coordinates (i.e., larger values are closer to the camera)
+    """
+    mats = np.stack([create_viewport_matrix(*sz) @ create_ortho_matrix(*sz) for sz in img_size])
+    mats = torch.as_tensor(mats, dtype=v.dtype, device=v.device)
+    v_raster = v @ mats[:, :3, :3].transpose(1, 2) + mats[:, None, :3, 3]
+    return torch.cat([v_raster[..., :2], v[..., 2:]], dim=-1)
 
 
 class CudaRenderer(nn.Module):
     """ A cuda-based renderer, adapted from the DECA implementation by YadiraF
-    (https://github.com/YadiraF/DECA/blob/master/decalib/utils/renderer.py). """
-    def __init__(self, height, width=None, device='cuda'):
+    (https://github.com/YadiraF/DECA/blob/master/decalib/utils/renderer.py).
+
+    Parameters
+    ----------
+    height : int
+        Height of the rendered image
+    width : int
+        Width of the rendered image (same as ``height`` if ``None``)
+    device : str
+        Either 'cuda' or 'cpu'
+    backend : str
+        Rasterizer to use: 'cuda' (the ``rasterize_cuda`` extension, which needs a GPU),
+        'torch' (see ``rasterize``), or ``None`` (the extension if on GPU and installed,
+        'torch' otherwise)
+    """
+    def __init__(self, height, width=None, device='cuda', backend=None):
         """ use fixed raster_settings for rendering faces. """
         super().__init__()
         
-        self.h = height
-        self.w = width if width is not None else height
+        self.height = height
+        self.width = width if width is not None else height
         self.device = device
 
+        if backend is None:
+            backend = 'torch'
+            if device.startswith('cuda'):
+                try:
+                    import rasterize_cuda  # noqa: F401
+                    backend = 'cuda'
+                except ImportError:
+                    pass
+
+        if backend not in ('cuda', 'torch'):
+            raise ValueError(f"Unknown rasterizer backend '{backend}'; choose 'cuda' or 'torch'")
+
+        self.backend = backend
+
     def forward(self, v, f, attrs=None):
         
         h, w = self.height, self.width
         device = self.device
         bz = v.shape[0]
 
-        depth_buffer = torch.zeros([bz, h, w]).float().to(device) + 1e6
-        triangle_buffer = torch.zeros([bz, h, w]).int().to(device) - 1
-        baryw_buffer = torch.zeros([bz, h, w, 3]).float().to(device)
+        f_vs = face_vertices(ndc_to_pixel(v, h, w), f)
 
-        v = v.clone().float()
-        
-        v[..., :2] = -v[..., :2]
-        v[..., 0] = v[..., 0] * w/2 + w/2
-        v[..., 1] = v[..., 1] * h/2 + h/2
-        v[..., 0] = w - 1 - v[..., 0]
-        v[..., 1] = h - 1 - v[..., 1]
-        v[..., 0] = -1 + (2 * v[..., 0] + 1) / w
-        v[..., 1] = -1 + (2 * v[..., 1] + 1) / h
-
-        v = v.clone().float()
-        v[..., 0] = v[..., 0] * w/2 + w/2 
-        v[..., 1] = v[..., 1] * h/2 + h/2 
-        v[..., 2] = v[..., 2] * w/2
-        f_vs = face_vertices(v, f)
-
-        # Import here instead of toplevel, so the rasterize_cuda does not necessarily
-        # have to be installed
-        from rasterize_cuda import rasterize
-        rasterize(f_vs, depth_buffer, triangle_buffer, baryw_buffer, h, w)
+        if self.backend == 'cuda':
+            depth_buffer = torch.zeros([bz, h, w]).float().to(device) + 1e6
+            triangle_buffer = torch.zeros([bz, h, w]).int().to(device) - 1
+            baryw_buffer = torch.zeros([bz, h, w, 3]).float().to(device)
+
+            # Import here instead of toplevel, so the rasterize_cuda does not necessarily
+            # have to be installed
+            from rasterize_cuda import rasterize as rasterize_cuda
+            rasterize_cuda(f_vs, depth_buffer, triangle_buffer, baryw_buffer, h, w)
+        else:
+            depth_buffer, triangle_buffer, baryw_buffer = rasterize(f_vs, h, w)
 
         pix_to_face = triangle_buffer[:, :, :, None].long()
         bary_coords = baryw_buffer[:, :, :, None, :]
         vismask = (pix_to_face > -1).float()
         D = attrs.shape[-1]
+        n_faces = attrs.shape[1]
         attrs = attrs.clone()
         attrs = attrs.view(attrs.shape[0] * attrs.shape[1], 3, attrs.shape[-1])
         N, H, W, K, _ = bary_coords.shape
         mask = pix_to_face == -1
-        pix_to_face = pix_to_face.clone()
+        # The face indices are per mesh, but the attributes of all meshes are flattened
+        pix_to_face = pix_to_face + (torch.arange(N, device=device) * n_faces)[:, None, None, None]
         pix_to_face[mask] = 0
         idx = pix_to_face.view(N * H * W * K, 1, 1).expand(N * H * W * K, 3, D)
         pixel_face_vals = attrs.gather(0, idx).view(N, H, W, K, 3, D)
@@ -67,22 +254,32 @@ class CudaRenderer(nn.Module):
     
 
 class PytorchRenderer(nn.Module):
+    """ A ``pytorch3d``-based (Phong shaded) renderer.
 
-    from pytorch3d.io import load_obj
-    from pytorch3d.structures import Meshes
-    from pytorch3d.renderer import look_at_view_transform, FoVPerspectiveCameras
-    from pytorch3d.renderer import RasterizationSettings, MeshRenderer, MeshRasterizer
-    from pytorch3d.renderer import DirectionalLights, SoftPhongShader, TexturesVertex
-
-    def __init__(self, obj_filename):
+    Parameters
+    ----------
+    obj_filename : str
+        Path to an obj file with the (template) mesh, of which the faces are used
+    device : str
+        Device to render on (e.g., 'cuda:0' or 'cpu')
+    """
+    def __init__(self, obj_filename, device='cuda:0'):
         super().__init__()
 
+        # Import here instead of toplevel, so pytorch3d does not necessarily have to be
+        # installed
+        from pytorch3d.io import load_obj
+        from pytorch3d.renderer import look_at_view_transform, FoVPerspectiveCameras
+        from pytorch3d.renderer import RasterizationSettings, MeshRenderer, MeshRasterizer
+        from pytorch3d.renderer import DirectionalLights, SoftPhongShader
+
+        self.device = device
         verts, faces, aux = load_obj(obj_filename)
-        faces = faces.verts_idx[None, ...].cuda()
+        faces = faces.verts_idx[None, ...].to(device)
         self.register_buffer('faces', faces)
 
         R, T = look_at_view_transform(2.7, 10.0, 10.0)
-        self.cameras = FoVPerspectiveCameras(device='cuda:0', R=R, T=T, fov=6)
+        self.cameras = FoVPerspectiveCameras(device=device, R=R, T=T, fov=6)
         raster_settings = RasterizationSettings(
             image_size=512,
             blur_radius=0.0,
@@ -91,7 +288,7 @@ class PytorchRenderer(nn.Module):
         )
 
         lights = DirectionalLights(
-            device='cuda:0',
+            device=device,
             direction=((0, 0, 1),),
             ambient_color=((0.4, 0.4, 0.4),),
             diffuse_color=((0.35, 0.35, 0.35),),
@@ -99,10 +296,13 @@ class PytorchRenderer(nn.Module):
 
         self.renderer = MeshRenderer(
             rasterizer=MeshRasterizer(cameras=self.cameras, raster_settings=raster_settings),
-            shader=SoftPhongShader(device='cuda:0', cameras=self.cameras, lights=lights)
+            shader=SoftPhongShader(device=device, cameras=self.cameras, lights=lights)
         )
 
     def render_mesh(self, vertices, faces=None, verts_rgb=None):
+        from pytorch3d.structures import Meshes
+        from pytorch3d.renderer import TexturesVertex
+
         B, N, V = vertices.shape
         if faces is None:
             faces = self.faces.repeat(B, 1, 1)
@@ -111,10 +311,10 @@ class PytorchRenderer(nn.Module):
 
         if verts_rgb is None:
             verts_rgb = torch.ones_like(vertices)
-        textures = TexturesVertex(verts_features=verts_rgb.cuda())
+        textures = TexturesVertex(verts_features=verts_rgb.to(self.device))
         meshes = Meshes(verts=vertices, faces=faces, textures=textures)
 
         rendering = self.renderer(meshes).permute(0, 3, 1, 2)
         color = rendering[:, 0:3, ...]
 
-        return color
\ No newline at end of file
+        return color
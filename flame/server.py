@@ -0,0 +1,307 @@
+""" Module with a small (asyncio-based) HTTP server that performs reconstruction of
+images sent by (possibly many) clients. Incoming requests are collected into dynamic
+micro-batches, such that the encoders are run on several images at once, which
+is much more efficient than running the model once per request.
+
+The server exposes two endpoints:
+
+* ``GET /health``, which returns ``{"status": "ok"}``
+* ``POST /reconstruct``, which expects the (encoded, e.g. jpg or png) image as the
+  request body and returns a JSON object with the reconstructed vertices (``"v"``) and
+  local-to-world matrix (``"mat"``), or the estimated parameters (if the server is
+  started with ``output='params'``)
+"""
+
+import json
+import torch
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import get_logger
+from .pipeline import load_models
+
+logger = get_logger()
+
+
+class RequestTooLarge(ValueError):
+    """ Raised when the body of a request exceeds the maximum size of the server. """
+    pass
+
+
+class MicroBatcher:
+    """ Collects single requests into micro-batches, which are processed by a
+    (blocking) function in a separate thread.
+
+    Parameters
+    ----------
+    fn : callable
+        Function that takes a list of inputs and returns a list of outputs (of the
+        same length); outputs that are exceptions are raised for the corresponding
+        request only
+    max_batch_size : int
+        Maximum number of requests in a single batch
+    max_wait : float
+        Maximum time (in seconds) to wait for more requests after the first request
+        of a batch has arrived
+    """
+    def __init__(self, fn, max_batch_size=8, max_wait=0.01):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = asyncio.Queue()
+        # Batches are processed one at a time, in a single thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, item):
+        """ Submits a single item and waits for its result. """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        """ Waits for the first request and then for at most ``max_wait`` seconds
+        (or until ``max_batch_size`` requests have arrived) for more requests. """
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self):
+        """ Processes batches until cancelled. """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items, futures = zip(*batch)
+            try:
+                results = await loop.run_in_executor(self._executor, self.fn, list(items))
+            except Exception as e:
+                results = [e] * len(items)
+
+            for future, result in zip(futures, results):
+                if future.cancelled():
+                    continue
+
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class ReconServer:
+    """ Server that loads a crop model and a reconstruction model once and uses them
+    to reconstruct images sent by clients.
+
+    Parameters
+    ----------
+    name : str
+        Name of the reconstruction model ('mica', 'deca-coarse', 'deca-dense',
+        'emoca-coarse', or 'emoca-dense')
+    device : str
+        Either 'cuda' (uses GPU) or 'cpu'
+    max_batch_size : int
+        Maximum number of images in a single batch
+    max_wait : float
+        Maximum time (in seconds) to wait for more images to fill a batch
+    output : str
+        Either 'mesh' (return vertices and world matrices) or 'params' (return the
+        estimated parameters)
+    n_crop_threads : int
+        Number of threads used for cropping (which is done per image)
+    backend : str
+        Backend of the reconstruction model ('torch', 'jit', or 'onnx')
+    max_body_size : int
+        Maximum size (in bytes) of the body of a request; larger requests are
+        rejected (413), without reading their body
+    """
+    def __init__(self, name='emoca-coarse', device='cuda', max_batch_size=8, max_wait=0.01,
+                 output='mesh', n_crop_threads=4, backend='torch', max_body_size=16 * 2 ** 20):
+        self.name = name
+        self.device = device
+        self.output = output
+        self.backend = backend
+        self.max_body_size = max_body_size
+        self._load_models()
+        # Make sure that the first requests do not pay for one-time costs (e.g., tracing)
+        self.recon_model.warmup(sorted({1, max_batch_size}))
+        self.batcher = MicroBatcher(self._reconstruct, max_batch_size, max_wait)
+        self._crop_executor = ThreadPoolExecutor(max_workers=n_crop_threads)
+
+    def _load_models(self):
+        """ Loads the crop and reconstruction models (once). """
+        self.crop_model, self.recon_model = load_models(self.name, self.device, self.backend)
+
+    def _crop(self, data):
+        """ Decodes the image (bytes) and crops it; note that `crop` does not store
+        anything on the crop model, so this can be run in multiple threads. """
+        import cv2
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Could not decode image!")
+
+        return self.crop_model.crop(img[:, :, ::-1])  # BGR -> RGB
+
+    def _reconstruct(self, crops):
+        """ Reconstructs a batch of cropped images and returns a list with a result
+        (dictionary) per image. """
+        img_crop = torch.cat([crop['img_crop'] for crop in crops])
+
+        if self.output == 'params':
+            with torch.inference_mode():
+                img_crop = self.recon_model._check_input(img_crop, tuple(img_crop.shape[2:]))
+                enc = self.recon_model._encode_cached(img_crop)
+
+            if torch.is_tensor(enc):
+                # MICA only returns the shape parameters
+                enc = {'shape': enc}
+
+            enc = {k: v.cpu().numpy() for k, v in enc.items()}
+            return [{k: v[i].tolist() for k, v in enc.items()} for i in range(len(crops))]
+
+        if self.name == 'mica':
+            out = self.recon_model.reconstruct(img_crop)
+        else:
+            tform = np.concatenate([crop['tform'] for crop in crops])
+            img_size = np.concatenate([crop['img_size'] for crop in crops])
+            out = self.recon_model.reconstruct(img_crop, tform=tform, img_size=img_size)
+
+        return [{'v': out['v'][i].tolist(), 'mat': out['mat'][i].tolist()}
+                for i in range(len(crops))]
+
+    async def handle(self, reader, writer):
+        """ Handles a single (keep-alive) HTTP connection. """
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                status, response = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, response, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ValueError as e:
+            # Malformed (or too large) request; the rest of the stream cannot be
+            # trusted either
+            status = 413 if isinstance(e, RequestTooLarge) else 400
+            self._write_response(writer, status, {'error': str(e)}, keep_alive=False)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        """ Routes a request to the right endpoint and returns the status
+        and (JSON-serializable) response. """
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+
+        if method != 'POST' or path != '/reconstruct':
+            return 404, {'error': f"Unknown endpoint {method} {path}"}
+
+        loop = asyncio.get_running_loop()
+        try:
+            crop = await loop.run_in_executor(self._crop_executor, self._crop, body)
+            return 200, await self.batcher.submit(crop)
+        except ValueError as e:
+            return 422, {'error': str(e)}
+        except Exception as e:
+            logger.exception("Reconstruction failed!")
+            return 500, {'error': str(e)}
+
+    async def _read_request(self, reader):
+        """ Reads a single HTTP request; returns ``None`` if the connection is closed
+        and raises a ``ValueError`` if the request is malformed (or a
+        ``RequestTooLarge`` error if its body is too large). """
+        line = await reader.readline()
+        if not line:
+            return None
+
+        parts = line.decode('latin1').split(' ', 2)
+        if len(parts) != 3:
+            raise ValueError(f"Malformed request line: {line.strip()!r}")
+
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            if b':' not in line:
+                raise ValueError(f"Malformed header: {line.strip()!r}")
+
+            key, value = line.decode('latin1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        n_bytes = headers.get('content-length', '0')
+        if not n_bytes.isdigit():
+            raise ValueError(f"Invalid Content-Length: {n_bytes!r}")
+
+        n_bytes = int(n_bytes)
+        if n_bytes > self.max_body_size:
+            raise RequestTooLarge(f"Request body of {n_bytes} bytes exceeds the maximum "
+                                  f"of {self.max_body_size} bytes!")
+
+        body = await reader.readexactly(n_bytes) if n_bytes else b''
+        return method, path.split('?')[0], headers, body
+
+    @staticmethod
+    def _write_response(writer, status, response, keep_alive=True):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                   422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+        body = json.dumps(response).encode()
+        head = (f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin1') + body)
+
+    async def start(self, host='127.0.0.1', port=8000, socket=None):
+        """ Starts the server (on a TCP port or, if ``socket`` is given, on a Unix
+        socket) and runs until cancelled. """
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket)
+            logger.info(f"Serving '{self.name}' on unix socket {socket}")
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            logger.info(f"Serving '{self.name}' on http://{host}:{port}")
+
+        batch_task = asyncio.create_task(self.batcher.run())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+def serve(name='emoca-coarse', device='cuda', host='127.0.0.1', port=8000, socket=None,
+          max_batch_size=8, max_wait=0.01, output='mesh', n_crop_threads=4, backend='torch',
+          max_body_size=16 * 2 ** 20):
+    """ Starts a reconstruction server (see ``ReconServer``) and blocks until
+    interrupted. """
+    server = ReconServer(name, device, max_batch_size, max_wait, output, n_crop_threads, backend,
+                         max_body_size)
+    try:
+        asyncio.run(server.start(host, port, socket))
+    except KeyboardInterrupt:
+        logger.info("Shutting down server")
@@ -0,0 +1,219 @@
+""" Module to extract (per frame) textures from the original images into the FLAME UV
+map, given the reconstructed meshes, and to average them (over all frames of a
+reconstructed video).
+
+Examples
+--------
+>>> from flame import DecaReconModel
+>>> from flame.texture import TextureExtractor
+>>> recon_model = DecaReconModel('emoca-coarse', device='cpu')  # doctest: +SKIP
+>>> extractor = TextureExtractor.from_model(recon_model)  # doctest: +SKIP
+>>> out = recon_model.reconstruct(crop['img_crop'], crop['tform'], crop['img_size'])  # doctest: +SKIP
+>>> tex, mask = extractor.extract([img], out['v'], crop['img_size'])  # doctest: +SKIP
+"""
+
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+from .profiling import stage
+from .renderer import rasterize, world_to_raster
+from .utils import face_vertices, vertex_normals
+
+
+class TextureExtractor:
+    """ Samples the original images into UV space (the "texture"), given the
+    reconstructed (world space) vertices, and determines which texels are visible.
+
+    The vertices are projected into the images with the same (orthographic projection
+    and viewport) matrices as used to create the world matrices of the reconstruction
+    models, so the texture extraction does not need the crop matrices or camera
+    parameters.
+
+    Parameters
+    ----------
+    faces : torch.Tensor
+        An F x 3 tensor with the faces of the reconstructed meshes (used for the
+        visibility test)
+    to_uv : callable
+        Function that maps vertex attributes (B x V x C) to UV space (B x C x H x W),
+        e.g., ``flame.uv.UVRasterTable.world2uv``
+    device : str
+        Either 'cuda' or 'cpu'
+    depth_tol : float
+        Tolerance of the depth test, as a fraction of the depth range of the mesh
+    """
+    def __init__(self, faces, to_uv, device='cuda', depth_tol=0.02):
+        self.faces = torch.as_tensor(faces).long().reshape(-1, 3).to(device)
+        self.to_uv = to_uv
+        self.device = device
+        self.depth_tol = depth_tol
+
+    @classmethod
+    def from_model(cls, recon_model, **kwargs):
+        """ Creates an extractor for the outputs of a (DECA-like) reconstruction model.
+
+        Parameters
+        ----------
+        recon_model : DecaReconModel
+            The reconstruction model
+        **kwargs
+            Extra arguments for the extractor (e.g., ``depth_tol``)
+
+        Returns
+        -------
+        extractor : TextureExtractor
+            The texture extractor
+
+        Raises
+        ------
+        ValueError
+            If the model does not reconstruct meshes in the original image space
+            (i.e., MICA)
+        """
+        if not hasattr(recon_model, 'uv_table'):
+            raise ValueError("Texture extraction needs a DECA-like model (with meshes in "
+                             "image space and a UV layout)!")
+
+        if not recon_model.dense:
+            return cls(recon_model.faces, recon_model.uv_table.world2uv, recon_model.device, **kwargs)
+
+        # The vertices of the dense mesh are the texels of the UV map
+        template = recon_model.dense_template
+        size = recon_model.uv_table.size
+        texel_idx = torch.tensor(template['y_coords'][template['valid_pixel_ids']].astype(int) * size +
+                                 template['x_coords'][template['valid_pixel_ids']].astype(int))
+
+        def to_uv(attr):
+            uv_attr = attr.new_zeros(attr.shape[0], size * size, attr.shape[2])
+            uv_attr[:, texel_idx.to(attr.device)] = attr
+            return uv_attr.permute(0, 2, 1).reshape(attr.shape[0], attr.shape[2], size, size)
+
+        return cls(template['f'], to_uv, recon_model.device, **kwargs)
+
+    def _project(self, v, img_size):
+        """ Projects world space vertices to raster space (see
+        ``flame.renderer.world_to_raster``). """
+        return world_to_raster(v, img_size)
+
+    def _visible_depth(self, v_raster, img_size):
+        """ Rasterizes the meshes (only within the part of the image covered by the
+        bounding box around the projected vertices) and returns the depth buffers and
+        the offsets of the boxes. """
+        img_size = torch.as_tensor(img_size, dtype=v_raster.dtype, device=self.device)
+        xy_min = torch.maximum(v_raster[..., :2].amin(dim=1).floor(), torch.zeros_like(img_size))
+        xy_max = torch.minimum(v_raster[..., :2].amax(dim=1).ceil(), img_size - 1)
+        extent = (xy_max - xy_min).amax(dim=0).long().clamp(min=0) + 1
+
+        # The rasterizer treats smaller (positive) depths as closer
+        depth = v_raster[..., 2].amax(dim=1, keepdim=True) - v_raster[..., 2] + 1
+        v_box = torch.cat([v_raster[..., :2] - xy_min[:, None, :], depth[..., None]], dim=-1)
+        f_vs = face_vertices(v_box, self.faces.expand(v_box.shape[0], -1, -1))
+        depth_buffer, _, _ = rasterize(f_vs, int(extent[1]), int(extent[0]))
+        return depth_buffer, xy_min, depth
+
+    @torch.inference_mode()
+    def extract(self, images, v, img_size):
+        """ Extracts the textures of a batch of frames.
+
+        Parameters
+        ----------
+        images : list
+            List of B RGB images (numpy arrays, height x width x 3, uint8)
+        v : np.ndarray, torch.Tensor
+            A B x V x 3 array with the reconstructed vertices (in world space)
+        img_size : np.ndarray
+            A B x 2 array with the image sizes (width, height)
+
+        Returns
+        -------
+        textures : torch.Tensor
+            A B x 3 x H x W tensor with the textures (between 0 and 1)
+        masks : torch.Tensor
+            A B x H x W boolean tensor indicating which texels are visible
+        """
+        v = torch.as_tensor(v, dtype=torch.float32, device=self.device)
+        batch_size = v.shape[0]
+
+        with stage('texture_visibility', self.device):
+            img_size = np.asarray(img_size)
+            v_raster = self._project(v, img_size)
+            depth_buffer, xy_min, depth = self._visible_depth(v_raster, img_size)
+            normals = vertex_normals(v, self.faces.expand(batch_size, -1, -1))
+
+            # Position (x, y), depth and normal (z) of each texel
+            uv = self.to_uv(torch.cat([v_raster[..., :2], depth[..., None], normals[..., 2:]], dim=-1))
+            uv_xy, uv_depth, uv_nz = uv[:, :2], uv[:, 2], uv[:, 3]
+
+            # Depth test at the (nearest) pixel of each texel
+            _, h, w = depth_buffer.shape
+            px = (uv_xy[:, 0] - xy_min[:, 0, None, None]).round().long()
+            py = (uv_xy[:, 1] - xy_min[:, 1, None, None]).round().long()
+            in_box = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+            b_idx = torch.arange(batch_size, device=self.device)[:, None, None]
+            tol = self.depth_tol * (depth.amax(dim=1) - depth.amin(dim=1))[:, None, None]
+            visible = uv_depth <= depth_buffer[b_idx, py.clamp(0, h - 1), px.clamp(0, w - 1)] + tol
+
+            # Texels outside the image cannot be sampled, texels outside the UV layout
+            # have zero depth, and texels facing away from the camera are not reliable
+            # (even when not occluded)
+            size = torch.as_tensor(img_size, device=self.device)[:, :, None, None]
+            in_img = (uv_xy >= 0).all(dim=1) & (uv_xy <= size - 1).all(dim=1)
+            masks = visible & in_box & in_img & (uv_depth > 0) & (uv_nz > 0)
+
+        with stage('texture_sample', self.device):
+            textures = []
+            for i, img in enumerate(images):
+                img = torch.as_tensor(np.ascontiguousarray(img), device=self.device)
+                img = img.permute(2, 0, 1)[None].float() / 255.
+                h_img, w_img = img.shape[2:]
+                # Pixel centers are at integer coordinates (see `create_viewport_matrix`)
+                grid = torch.stack([uv_xy[i, 0] / (w_img - 1), uv_xy[i, 1] / (h_img - 1)], dim=-1)
+                textures.append(F.grid_sample(img, grid[None] * 2 - 1, align_corners=True))
+
+            textures = torch.cat(textures) * masks[:, None]
+
+        return textures, masks
+
+
+def average_store_textures(store):
+    """ Averages the (per frame) textures of all finished chunks of an output store (see
+    ``flame.pipeline.ReconPipeline``), one chunk at a time, such that each texel is only
+    averaged over the frames in which it was visible.
+
+    Parameters
+    ----------
+    store : ChunkedStore
+        The output store
+
+    Returns
+    -------
+    texture : torch.Tensor
+        The average texture (3 x H x W; zeros for texels that were never visible), or
+        ``None`` if the store does not contain textures
+    count : torch.Tensor
+        The number of frames in which each texel was visible (H x W), or ``None``
+    """
+    tex_sum, count = None, None
+    for idx in range(store.n_chunks):
+        if not store.is_done(idx):
+            continue
+
+        chunk = store.read(idx)
+        if 'texture' not in chunk:
+            return None, None
+
+        # Textures are stored as (masked) H x W x 3 uint8 images
+        textures = torch.from_numpy(chunk['texture']).permute(0, 3, 1, 2).float() / 255.
+        masks = torch.from_numpy(chunk['texture_mask'])
+        if tex_sum is None:
+            tex_sum = torch.zeros(textures.shape[1:])
+            count = torch.zeros(masks.shape[1:], dtype=torch.long)
+
+        tex_sum += (textures * masks[:, None]).sum(dim=0)
+        count += masks.sum(dim=0)
+
+    if tex_sum is None:
+        return None, None
+
+    return tex_sum / count.clamp(min=1), count
@@ -0,0 +1,193 @@
+""" Module to tune the number of (torch/onnxruntime) threads and the batch size of a
+reconstruction model for the current machine. The best settings are persisted per
+machine and model (in ``tuning.json`` in the cache directory, see
+``flame.utils.get_cache_dir``), such that freshly started workers can apply them
+without tuning again.
+
+Examples
+--------
+>>> from flame import DecaReconModel
+>>> from flame.tuning import autotune, apply_tuning
+>>> model = DecaReconModel('emoca-coarse', device='cpu', backend='jit')  # doctest: +SKIP
+>>> best = autotune(model, batch_sizes=(1, 4, 8), n_threads=(1, 2, 4))  # doctest: +SKIP
+
+And later (e.g., in a worker process):
+
+>>> tuning = apply_tuning(model)  # doctest: +SKIP
+"""
+
+import os
+import json
+import time
+import torch
+import socket
+import platform
+import numpy as np
+
+from .utils import get_logger, get_cache_dir
+
+logger = get_logger()
+
+
+def _machine_key():
+    """ Identifies the current machine (and the number of cores available to it). """
+    return f"{socket.gethostname()}|{platform.machine()}|{platform.processor()}|{os.cpu_count()}"
+
+
+def _model_key(model):
+    """ Identifies a reconstruction model (including the settings that affect its speed). """
+    items = [model.__class__.__name__, getattr(model, 'name', 'mica'), model.device,
+             getattr(model, 'backend', 'torch'), getattr(model, 'precision', 'float32'),
+             getattr(model, 'encoder_mode', '')]
+    return '|'.join(items)
+
+
+def _tuning_file():
+    return get_cache_dir() / 'tuning.json'
+
+
+def _load_all():
+    f_tuning = _tuning_file()
+    if not f_tuning.is_file():
+        return {}
+
+    with open(f_tuning, 'r') as f_in:
+        return json.load(f_in)
+
+
+def _save(model, result):
+    """ Stores the tuning result of a model (for the current machine). """
+    tunings = _load_all()
+    tunings.setdefault(_machine_key(), {})[_model_key(model)] = result
+
+    # Write to a temporary file first, so that other processes never read a partial file
+    f_tuning = _tuning_file()
+    f_tuning.parent.mkdir(parents=True, exist_ok=True)
+    f_tmp = f_tuning.with_name(f'{f_tuning.name}.{os.getpid()}.tmp')
+    with open(f_tmp, 'w') as f_out:
+        json.dump(tunings, f_out, indent=2)
+
+    os.replace(f_tmp, f_tuning)
+
+
+def load_tuning(model):
+    """ Returns the persisted tuning result of a model on the current machine.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model
+
+    Returns
+    -------
+    tuning : dict, None
+        Dictionary with (at least) the ``"n_threads"`` and ``"batch_size"`` keys, or
+        ``None`` if the model has not been tuned on this machine
+    """
+    return _load_all().get(_machine_key(), {}).get(_model_key(model))
+
+
+def apply_tuning(model, warmup=True):
+    """ Applies the persisted number of threads of a model (if it has been tuned on the
+    current machine) and, optionally, warms up the model with the tuned batch size.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model
+    warmup : bool
+        Whether to warm up the model (see ``FlameReconModel.warmup``)
+
+    Returns
+    -------
+    tuning : dict, None
+        The applied tuning result (see ``load_tuning``)
+    """
+    tuning = load_tuning(model)
+    if tuning is None:
+        logger.info(f"No tuning found for {_model_key(model)}; using the default settings")
+        return None
+
+    model.set_num_threads(tuning['n_threads'])
+    if warmup:
+        model.warmup((tuning['batch_size'],))
+
+    return tuning
+
+
+def autotune(model, batch_sizes=(1, 2, 4, 8, 16), n_threads=None, n_iter=5, max_latency_ms=None,
+             persist=True):
+    """ Measures the throughput of a model for all combinations of the given batch sizes
+    and numbers of threads and picks the combination with the highest throughput.
+
+    Parameters
+    ----------
+    model : DecaReconModel, MicaReconModel
+        The reconstruction model
+    batch_sizes : tuple
+        Batch sizes to try
+    n_threads : tuple
+        Numbers of threads to try; if ``None``, powers of two up to (and including) the
+        number of available cores
+    n_iter : int
+        Number of (timed) runs per combination (after warming up)
+    max_latency_ms : float
+        If not ``None``, only combinations with a mean latency (per batch) below this
+        value are considered (e.g., for online serving)
+    persist : bool
+        Whether to store the result for the current machine (see ``load_tuning``)
+
+    Returns
+    -------
+    best : dict
+        Dictionary with the best number of threads (``"n_threads"``) and batch size
+        (``"batch_size"``), the corresponding throughput (``"throughput"``, images per
+        second) and latency (``"latency_ms"``), and the measurements of all
+        combinations (``"results"``)
+
+    Raises
+    ------
+    ValueError
+        If no combination satisfies ``max_latency_ms``
+    """
+    if n_threads is None:
+        n_cpus = os.cpu_count() or 1
+        n_threads = sorted({2 ** i for i in range(int(np.log2(n_cpus)) + 1)} | {n_cpus})
+
+    w, h = model._crop_img_size
+    orig_threads = torch.get_num_threads()
+    results = []
+    try:
+        for n_thr in n_threads:
+            model.set_num_threads(n_thr)
+            for batch_size in batch_sizes:
+                images = torch.rand(batch_size, 3, h, w, device=model.device)
+                kwargs = model._dummy_kwargs(batch_size)
+                model.warmup((batch_size,))
+
+                latencies = []
+                for _ in range(n_iter):
+                    t_start = time.perf_counter()
+                    model.reconstruct(images, **kwargs)
+                    latencies.append(time.perf_counter() - t_start)
+
+                latency = float(np.mean(latencies))
+                results.append({'n_threads': n_thr, 'batch_size': batch_size,
+                                'throughput': batch_size / latency, 'latency_ms': latency * 1000})
+                logger.info(f"n_threads={n_thr}, batch_size={batch_size}: "
+                            f"{results[-1]['throughput']:.1f} img/s, {latency * 1000:.1f} ms/batch")
+    finally:
+        model.set_num_threads(orig_threads)
+
+    candidates = [res for res in results
+                  if max_latency_ms is None or res['latency_ms'] <= max_latency_ms]
+    if not candidates:
+        raise ValueError(f"No combination of threads and batch size has a latency below "
+                         f"{max_latency_ms} ms!")
+
+    best = dict(max(candidates, key=lambda res: res['throughput']))
+    best['results'] = results
+    if persist:
+        _save(model, best)
+
+    return best
@@ -91,29 +91,75 @@ def load_obj(obj_filename):
 
 
 def upsample_mesh(v, normals, disp_map, dense_template):
-    
+    """ Upsamples a coarse mesh to the dense (59315 vertices) mesh by interpolating
+    the coarse vertices and normals and adding the (detail) displacements.
+
+    Parameters
+    ----------
+    v : np.ndarray
+        Coarse vertices, either a single (5023 x 3) mesh or a batch (B x 5023 x 3)
+    normals : np.ndarray
+        Coarse vertex normals, with the same shape as ``v``
+    disp_map : np.ndarray
+        Displacement map in UV space, either (256 x 256) or (B x 256 x 256)
+    dense_template : dict
+        Dictionary with the dense template data (``texture_data_256.npy``)
+
+    Returns
+    -------
+    v_dense : np.ndarray
+        Dense vertices, either (59315 x 3) or (B x 59315 x 3)
+    """
     x_coords = dense_template['x_coords']
     y_coords = dense_template['y_coords']
     valid_pixel_ids = dense_template['valid_pixel_ids']
     valid_pixel_3d_faces = dense_template['valid_pixel_3d_faces']
     valid_pixel_b_coords = dense_template['valid_pixel_b_coords']
 
-    pixel_3d_points = v[valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
-                        v[valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
-                        v[valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
+    pixel_3d_points = v[..., valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
+                        v[..., valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
+                        v[..., valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
 
-    pixel_3d_normals = normals[valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
-                        normals[valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
-                        normals[valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
+    pixel_3d_normals = normals[..., valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
+                        normals[..., valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
+                        normals[..., valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
     
-    pixel_3d_normals = pixel_3d_normals / np.linalg.norm(pixel_3d_normals, axis=-1)[:, np.newaxis]
-    displacements = disp_map[y_coords[valid_pixel_ids].astype(int), x_coords[valid_pixel_ids].astype(int)]
-    offsets = np.einsum('i,ij->ij', displacements, pixel_3d_normals)
+    pixel_3d_normals = pixel_3d_normals / np.linalg.norm(pixel_3d_normals, axis=-1, keepdims=True)
+    displacements = disp_map[..., y_coords[valid_pixel_ids].astype(int), x_coords[valid_pixel_ids].astype(int)]
+    offsets = displacements[..., np.newaxis] * pixel_3d_normals
     v_dense = pixel_3d_points + offsets
 
     return v_dense
 
 
+def generate_triangles(h, w, margin_x=2, margin_y=5):
+    """ Creates the faces of a regular triangle mesh with a vertex per pixel of an
+    h x w (UV) image, excluding a margin, as in DECA.
+
+    Parameters
+    ----------
+    h : int
+        Height of the image
+    w : int
+        Width of the image
+    margin_x : int
+        Number of pixels at the left and right edge without faces
+    margin_y : int
+        Number of pixels at the top and bottom edge without faces
+
+    Returns
+    -------
+    triangles : np.ndarray
+        An F x 3 array with vertex (i.e., flattened pixel) indices
+    """
+    x, y = np.meshgrid(np.arange(margin_x, w - 1 - margin_x),
+                       np.arange(margin_y, h - 1 - margin_y), indexing='ij')
+    x, y = x.reshape(-1), y.reshape(-1)
+    triangle0 = np.stack([y * w + x, (y + 1) * w + x, y * w + x + 1], axis=1)
+    triangle1 = np.stack([y * w + x + 1, (y + 1) * w + x, (y + 1) * w + x + 1], axis=1)
+    return np.stack([triangle0, triangle1], axis=1).reshape(-1, 3)
+
+
 import logging
 
 
@@ -144,4 +190,21 @@ def get_logger(verbose="INFO"):
         ],
     )
     logger = logging.getLogger("medusa")
-    return logger
\ No newline at end of file
+    return logger
+
+def get_cache_dir():
+    """ Returns the directory used to cache data that is expensive to (re)compute,
+    like exported model graphs; defaults to ``~/.cache/flame`` but can be changed by
+    setting the ``FLAME_CACHE`` environment variable.
+
+    Returns
+    -------
+    cache_dir : pathlib.Path
+        Path to the (existing) cache directory
+    """
+    import os
+    from pathlib import Path
+
+    cache_dir = Path(os.environ.get('FLAME_CACHE', Path.home() / '.cache' / 'flame'))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
@@ -0,0 +1,88 @@
+""" Module with precomputed UV rasterization tables, which map attributes of the FLAME
+vertices (e.g., positions or normals) to UV space without rasterizing the (fixed) UV
+layout again for every frame. """
+
+import torch
+
+from .renderer import rasterize, ndc_to_pixel
+
+
+class UVRasterTable:
+    """ Rasterizes a UV layout once and maps vertex attributes to UV space as a single
+    (batched) gather, which gives the same result as rasterizing the UV layout with the
+    face vertex attributes (as in DECA's ``world2uv``).
+
+    Parameters
+    ----------
+    uvcoords : torch.Tensor
+        A (1 x) T x 2 tensor with the UV coordinates (between 0 and 1)
+    uvfaces : torch.Tensor
+        A (1 x) F x 3 tensor with the UV coordinate indices of each face
+    faces : torch.Tensor
+        A (1 x) F x 3 tensor with the vertex indices of each face
+    size : int
+        Width and height of the UV map
+    device : str
+        Either 'cuda' or 'cpu'
+
+    Attributes
+    ----------
+    pix_to_face : torch.Tensor
+        A (size x size) tensor with the index of the face of each pixel (-1 if none)
+    bary_coords : torch.Tensor
+        A (size x size x 3) tensor with the barycentric weights of each pixel
+    mask : torch.Tensor
+        A (size x size) boolean tensor indicating which pixels are covered by a face
+
+    Examples
+    --------
+    >>> from pathlib import Path
+    >>> from flame.utils import load_obj
+    >>> _, uvcoords, faces, uvfaces = load_obj(Path(__file__).parent / 'data/head_template.obj')
+    >>> table = UVRasterTable(uvcoords, uvfaces, faces, size=256, device='cpu')
+    >>> table.world2uv(torch.rand(2, 5023, 3)).shape
+    torch.Size([2, 3, 256, 256])
+    """
+    def __init__(self, uvcoords, uvfaces, faces, size=256, device='cuda'):
+        self.size = size
+        self.device = device
+
+        uvcoords, uvfaces, faces = uvcoords.reshape(-1, 2), uvfaces.reshape(-1, 3), faces.reshape(-1, 3)
+
+        # Same normalization as DECA's UV rasterizer: [0, 1] -> [-1, 1] (with a flipped
+        # y-axis) and a constant depth
+        uv = uvcoords * 2 - 1
+        uv = torch.cat([uv[:, :1], -uv[:, 1:], torch.ones_like(uv[:, :1])], dim=1)
+        uv = ndc_to_pixel(uv[None], size, size)[0]
+
+        _, pix_to_face, bary_coords = rasterize(uv[uvfaces.long()][None], size, size)
+        self.pix_to_face = pix_to_face[0].long().to(device)
+        self.bary_coords = bary_coords[0].to(device)
+        self.mask = self.pix_to_face > -1
+
+        # Vertex indices and weights of the covered pixels, which is all that is needed to
+        # map vertex attributes to UV space
+        self._pix_idx = torch.nonzero(self.mask.reshape(-1)).squeeze(1)
+        self._vert_idx = faces.to(device).long()[self.pix_to_face.reshape(-1)[self._pix_idx]]
+        self._weights = self.bary_coords.reshape(-1, 3)[self._pix_idx]
+
+    def world2uv(self, attr):
+        """ Maps vertex attributes to UV space.
+
+        Parameters
+        ----------
+        attr : torch.Tensor
+            A B x V x C tensor with vertex attributes (e.g., positions or normals)
+
+        Returns
+        -------
+        uv_attr : torch.Tensor
+            A B x C x size x size tensor with the (barycentric) interpolated attributes
+            in UV space (zeros outside the UV layout)
+        """
+        batch_size, _, n_chan = attr.shape
+        # B x P x 3 x C -> B x P x C
+        vals = (attr[:, self._vert_idx] * self._weights[None, :, :, None].to(attr.dtype)).sum(dim=2)
+        uv_attr = attr.new_zeros(batch_size, self.size * self.size, n_chan)
+        uv_attr[:, self._pix_idx] = vals
+        return uv_attr.permute(0, 2, 1).reshape(batch_size, n_chan, self.size, self.size)
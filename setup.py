@@ -30,6 +30,9 @@ opts = dict(
     version=VERSION,
     packages=PACKAGES,
     package_data=PACKAGE_DATA,
+    entry_points={
+        "console_scripts": ["flame=flame.cli:main"]
+    },
     install_requires=[
         "click",
         "pyyaml",
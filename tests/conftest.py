@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def synthetic_config(tmp_path_factory):
+    """ Creates synthetic stand-ins for the external data (see ``flame.data.synthetic``)
+    once per test session and returns the path to their config file. """
+    from flame.data.synthetic import create_synthetic_assets
+    return create_synthetic_assets(tmp_path_factory.mktemp('synthetic'))
+
+
+@pytest.fixture()
+def synthetic_models(synthetic_config, tmp_path, monkeypatch):
+    """ Makes the models load the synthetic data (and cache to a temporary directory). """
+    monkeypatch.setenv('FLAME_CONFIG', str(synthetic_config))
+    monkeypatch.setenv('FLAME_CACHE', str(tmp_path / 'cache'))
@@ -0,0 +1,88 @@
+import torch
+import pytest
+import numpy as np
+
+from flame.crop import FanCropModel
+from flame.cache import CropCache, EncoderCache
+
+
+class FakeCropModel(FanCropModel):
+    """ A ``FanCropModel`` with fixed landmarks instead of the face alignment model,
+    which counts how often it crops; frames without a face are black. """
+    def __init__(self):
+        self.device = 'cpu'
+        self.target_size = (224, 224)
+        self.n_calls = 0
+
+    def crop(self, image):
+        self.n_calls += 1
+        if image.max() == 0:
+            raise ValueError("Could not detect any faces!")
+
+        x, y = np.meshgrid(np.linspace(100, 200, 17), np.linspace(80, 200, 4))
+        return self._crop_face(image, np.c_[x.ravel(), y.ravel()], np.array([90., 70., 210., 210.]))
+
+
+@pytest.mark.parametrize("store_crops", [False, True])
+def test_crop_cache(store_crops, tmp_path):
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(240, 320, 3), dtype=np.uint8)
+    crop_model = FakeCropModel()
+
+    cache = CropCache(tmp_path / 'crops.sqlite', store_crops=store_crops)
+    out = cache.crop(crop_model, img, 'video.mp4', 0)
+    with pytest.raises(ValueError):
+        cache.crop(crop_model, np.zeros_like(img), 'video.mp4', 1)
+
+    cache.commit()
+
+    # A new cache (e.g., in a later run) skips the crop model for both frames
+    cache = CropCache(tmp_path / 'crops.sqlite', store_crops=store_crops)
+    cached = cache.crop(crop_model, img, 'video.mp4', 0)
+    with pytest.raises(ValueError):
+        cache.crop(crop_model, np.zeros_like(img), 'video.mp4', 1)
+
+    assert(crop_model.n_calls == 2)
+    for key in ('tform', 'img_size', 'lm', 'bbox'):
+        np.testing.assert_allclose(cached[key], out[key])
+
+    # Stored crops are rounded to 8 bits, while recropping gives the same crop
+    atol = 0.5 / 255 + 1e-6 if store_crops else 1e-6
+    torch.testing.assert_close(cached['img_crop'], out['img_crop'], atol=atol, rtol=0)
+
+    # Other frames, sources and crop models are not cached
+    assert(cache.get(crop_model, 'video.mp4', 2) is None)
+    assert(cache.get(crop_model, 'other.mp4', 0) is None)
+    crop_model.target_size = (112, 112)
+    assert(cache.get(crop_model, 'video.mp4', 0) is None)
+
+
+def test_encoder_cache_near_duplicates():
+
+    # A smooth image, such that its thumbnail is (much) more than noise
+    y, x = torch.meshgrid(torch.linspace(0, 1, 224), torch.linspace(0, 1, 224), indexing='ij')
+    img = torch.stack([x, y, x * y])[None]
+
+    cache = EncoderCache(max_size=4, threshold=0.02)
+    keys, outputs = cache.lookup(img, namespace='E_flame')
+    assert(outputs == [None])
+    cache.insert(keys, img, [torch.ones(3)], namespace='E_flame')
+
+    # Noise and brightness/contrast changes still match, a different image or
+    # encoder does not
+    noisy = (img + 0.01 * torch.randn(img.shape, generator=torch.Generator().manual_seed(0)))
+    brighter = img * 0.8 + 0.1
+    different = img.flip(dims=(2,))
+    _, outputs = cache.lookup(torch.cat([noisy, brighter, different]), namespace='E_flame')
+    assert(outputs[0] is not None and outputs[1] is not None and outputs[2] is None)
+    _, outputs = cache.lookup(noisy, namespace='E_detail')
+    assert(outputs == [None])
+    assert(cache.hits == 2 and cache.misses == 3)
+
+    # Without a threshold, only identical images match
+    cache = EncoderCache(max_size=4)
+    keys, _ = cache.lookup(img)
+    cache.insert(keys, img, [torch.ones(3)])
+    _, outputs = cache.lookup(torch.cat([img, noisy]))
+    assert(outputs[0] is not None and outputs[1] is None)
@@ -1,7 +1,11 @@
 import os
+import cv2
 import pytest
+import threading
+import numpy as np
 from pathlib import Path
-from flame.crop import FanCropModel, InsightFaceCropModel
+from types import SimpleNamespace
+from flame.crop import FanCropModel, InsightFaceCropModel, CombinedCropModel
 
 
 @pytest.mark.parametrize("Model", [FanCropModel, InsightFaceCropModel])
@@ -21,3 +25,212 @@ def test_recon(Model, device):
     else:
         img = crop_model.to_numpy(out, scale=255., mean=0, to_rgb=False)
         assert(img.shape[:2] == (112, 112))
+
+
+@pytest.mark.parametrize("device", ['cuda', 'cpu'])
+def test_combined_crop(device):
+
+    if 'GITHUB_ACTIONS' in os.environ and device == 'cuda':
+        return
+
+    img = Path(__file__).parent / 'obama.jpeg'
+    crop_model = CombinedCropModel(device=device)
+    out = crop_model.crop_batch([img, img])
+
+    assert(out['detected'].all())
+    assert(out['deca']['img_crop'].shape == (2, 3, 224, 224))
+    assert(out['mica']['img_crop'].shape == (2, 3, 112, 112))
+    assert(out['deca']['lm'].shape == (2, 68, 2))
+
+
+class StubDetector:
+    """ Stands in for the face detectors of both crop models: detects white squares
+    (faces) in black images, but depending on ``mode``, only in images smaller than the
+    frames (``"local"``), only with a lowered threshold (``"low_threshold"``), or not at
+    all (``"none"``). """
+    def __init__(self, frame_shape):
+        self.frame_shape = frame_shape
+        self.mode = 'detected'
+        self.filter_threshold = 0.5
+
+    @property
+    def det_thresh(self):
+        return self.filter_threshold
+
+    @det_thresh.setter
+    def det_thresh(self, value):
+        self.filter_threshold = value
+
+    def detect_from_image(self, img):
+        if (self.mode == 'none' or (self.mode == 'local' and img.shape[:2] == self.frame_shape)
+                or (self.mode == 'low_threshold' and self.filter_threshold >= 0.5)):
+            return np.zeros((0, 5))
+
+        n, _, stats, _ = cv2.connectedComponentsWithStats((img[..., 0] > 128).astype(np.uint8))
+        x, y, w, h = stats[1:, :4].T.astype(np.float64)
+        return np.c_[x, y, x + w, y + h, np.full(n - 1, 0.99)]
+
+    def detect(self, img, max_num=0, metric='default'):
+        bboxes = self.detect_from_image(img)
+        # Eyes, nose and mouth corners, relative to the box
+        kps = np.array([[0.3, 0.35], [0.7, 0.35], [0.5, 0.55], [0.35, 0.75], [0.65, 0.75]])
+        kpss = [kps * (x2 - x1, y2 - y1) + (x1, y1) for x1, y1, x2, y2, _ in bboxes]
+        return bboxes, np.array(kpss).reshape(-1, 5, 2)
+
+
+class StubFaceAlignment:
+    """ Stands in for ``face_alignment.FaceAlignment``, of which the landmarks depend
+    on the detector box like those of FAN: its center is moved up by 12% of the height
+    and the size of the landmarks is proportional to the size of the box. """
+    # 68 points of which the extent matches the box
+    template = np.stack(np.meshgrid(np.linspace(-48.75, 48.75, 17), np.linspace(-48.75, 48.75, 4)), axis=-1).reshape(-1, 2)
+
+    def __init__(self, detector):
+        self.face_detector = detector
+
+    def get_landmarks_from_image(self, img, detected_faces):
+        lm = []
+        for x1, y1, x2, y2 in (face[:4] for face in detected_faces):
+            center = np.array([(x1 + x2) / 2, (y1 + y2) / 2 - 0.12 * (y2 - y1)])
+            lm.append(center + self.template * (x2 - x1 + y2 - y1) / 195)
+
+        return lm
+
+
+class StubFanCropModel(FanCropModel):
+    def __init__(self, detector):
+        self.device = 'cpu'
+        self.target_size = (224, 224)
+        self.fallback_confidence = 0.2
+        self.model = StubFaceAlignment(detector)
+        self._warned_about_multiple_faces = False
+        self._threshold_lock = threading.Lock()
+
+
+class StubInsightFaceCropModel(InsightFaceCropModel):
+    def __init__(self, detector):
+        self.detector = detector
+        super().__init__(device='cpu')
+
+    def _setup_model(self):
+        self.app = SimpleNamespace(det_model=self.detector)
+
+
+def _frame(*faces):
+    """ Creates a black frame with white squares (x1, y1, x2, y2) as faces. """
+    img = np.zeros((240, 320, 3), dtype=np.uint8)
+    for x1, y1, x2, y2 in faces:
+        img[y1:y2, x1:x2] = 255
+
+    return img
+
+
+@pytest.mark.parametrize("Model", [StubFanCropModel, StubInsightFaceCropModel])
+def test_crop_tracked(Model):
+
+    img = _frame((140, 100, 200, 160))
+    detector = StubDetector(img.shape[:2])
+    crop_model = Model(detector)
+
+    first = out = crop_model.crop_tracked(img)
+    assert(out['fallback'] == 'detected' and out['n_reused'] == 0)
+
+    detector.mode = 'local'
+    out = crop_model.crop_tracked(img, out)
+    assert(out['fallback'] == 'local' and out['n_reused'] == 0)
+    np.testing.assert_allclose(out['tform'], first['tform'], atol=1e-6)
+
+    # The previous face is reused for at most `max_reuse` consecutive frames, after
+    # which the detector runs with a lower threshold (which is restored afterwards)
+    detector.mode = 'low_threshold'
+    for n_reused in (1, 2):
+        out = crop_model.crop_tracked(img, out, max_reuse=2)
+        assert(out['fallback'] == 'previous' and out['n_reused'] == n_reused)
+        np.testing.assert_allclose(out['tform'], first['tform'], atol=1e-6)
+
+    out = crop_model.crop_tracked(img, out, max_reuse=2)
+    assert(out['fallback'] == 'low_threshold' and out['n_reused'] == 0)
+    assert(detector.filter_threshold == 0.5)
+
+    detector.mode = 'none'
+    out = crop_model.crop_tracked(img, out, max_reuse=1)
+    assert(out['fallback'] == 'previous')
+    with pytest.raises(ValueError):
+        crop_model.crop_tracked(img, out, max_reuse=1)
+
+
+def test_crop_previous_stable():
+
+    img = _frame((140, 100, 200, 160))
+    crop_model = StubFanCropModel(StubDetector(img.shape[:2]))
+    first = crop_model.crop(img)
+
+    # Also without a detector box (e.g., when the previous frame was cached)
+    no_box = {key: value for key, value in first.items() if key != 'face_box'}
+    for out in (first, no_box):
+        for _ in range(10):
+            out = crop_model._crop_previous(img, out)
+            np.testing.assert_allclose(out['tform'], first['tform'], atol=1e-6)
+            np.testing.assert_allclose(out['lm'], first['lm'], atol=1e-6)
+
+
+def test_crop_local_closest_face():
+
+    # The region around a face at the border of the frame is clipped, so its center
+    # is closer to the (partially visible) second face
+    prev = StubInsightFaceCropModel(StubDetector((240, 320))).crop(_frame((0, 100, 40, 140)))
+    img = _frame((0, 100, 40, 140), (50, 100, 90, 140))
+    detector = StubDetector(img.shape[:2])
+    detector.mode = 'local'
+    out = StubInsightFaceCropModel(detector).crop_tracked(img, {**prev, 'n_reused': 0})
+    assert(out['fallback'] == 'local')
+    np.testing.assert_allclose(out['bbox'], prev['bbox'])
+
+
+@pytest.mark.parametrize("Model", [StubFanCropModel, StubInsightFaceCropModel])
+def test_crop_threads(Model):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    imgs = [_frame((x, y, x + 60, y + 60)) for x in (20, 100, 180) for y in (20, 100)]
+    crop_model = Model(StubDetector(imgs[0].shape[:2]))
+    expected = [crop_model.crop(img) for img in imgs]
+
+    # A single crop model shared by multiple threads
+    with ThreadPoolExecutor(4) as pool:
+        outs = list(pool.map(crop_model.crop, imgs * 3))
+
+    for out, exp in zip(outs, expected * 3):
+        for key, value in exp.items():
+            np.testing.assert_allclose(np.asarray(out[key]), np.asarray(value))
+
+    # The stateful `__call__` gives the same crops
+    for img, exp in zip(imgs, expected):
+        np.testing.assert_allclose(crop_model(img).numpy(), exp['img_crop'].numpy())
+        if Model == StubFanCropModel:
+            np.testing.assert_allclose(crop_model.tform.params, exp['tform'][0])
+
+
+@pytest.mark.parametrize("Model", [StubFanCropModel, StubInsightFaceCropModel])
+def test_crop_faces(Model):
+
+    boxes = [(20, 20, 80, 80), (180, 100, 240, 160), (100, 60, 180, 140)]
+    imgs = [_frame(*boxes[:2]), _frame(), _frame(boxes[2])]
+    crop_model = Model(StubDetector(imgs[0].shape[:2]))
+
+    # The faces of all images in a single batch, with the image of each face
+    out = crop_model.crop_faces(imgs)
+    assert(out['n_images'] == 3)
+    assert(sorted(out['img_idx']) == [0, 0, 2])
+    assert(out['img_crop'].shape[0] == 3)
+
+    # Each face is cropped like it would be if it were the only face in the image
+    for box in boxes:
+        expected = crop_model.crop(_frame(box))
+        i = np.flatnonzero([np.allclose(tform, expected['tform'][0]) for tform in out['tform']])
+        assert(len(i) == 1 and out['img_idx'][i[0]] == (2 if box == boxes[2] else 0))
+        np.testing.assert_allclose(out['img_size'][i[0]], expected['img_size'][0])
+
+    # No faces in any of the images
+    out = crop_model.crop_faces([_frame(), _frame()])
+    assert(out['n_images'] == 2 and out['img_idx'].size == 0 and 'img_crop' not in out)
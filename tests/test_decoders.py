@@ -0,0 +1,33 @@
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+from flame.decoders import FLAMETex
+
+
+def _decode_full_res(tex_space, texcode):
+    """ The original decoding: the full resolution (512 x 512, BGR) texture, which is
+    resized and converted to RGB afterwards. """
+    mean = torch.from_numpy(tex_space['MU'].reshape(1, -1)).float()
+    basis = torch.from_numpy(tex_space['PC'].reshape(-1, tex_space['PC'].shape[-1])).float()
+    texture = mean + (basis[None, :, :texcode.shape[1]] * texcode[:, None, :]).sum(-1)
+    texture = texture.reshape(texcode.shape[0], 512, 512, 3).permute(0, 3, 1, 2)
+    texture = F.interpolate(texture, [256, 256])
+    return texture[:, [2, 1, 0], :, :]
+
+
+def test_flame_tex(tmp_path):
+
+    rng = np.random.default_rng(0)
+    tex_space = {'MU': rng.random((1, 512 * 512 * 3), dtype=np.float32),
+                 'PC': rng.normal(size=(512, 512, 3, 5)).astype(np.float32)}
+    np.savez(tmp_path / 'tex.npz', **tex_space)
+
+    tex = FLAMETex(tmp_path / 'tex.npz', n_tex=4)
+    texcode = torch.randn(3, 4)
+    torch.testing.assert_close(tex(texcode), _decode_full_res(tex_space, texcode), rtol=1e-5, atol=1e-4)
+
+    # The (blue) first channel of the BGR texture is the last channel of the output
+    texture = tex(torch.zeros(1, 4))[0]
+    torch.testing.assert_close(texture[2, 0, 0], torch.tensor(tex_space['MU'][0, 0]))
+    torch.testing.assert_close(texture[0, 0, 0], torch.tensor(tex_space['MU'][0, 2]))
@@ -0,0 +1,54 @@
+import torch
+import pytest
+import numpy as np
+
+from flame import DecaReconModel, MicaReconModel
+
+
+def _create_models(name, backends):
+    if name == 'mica':
+        return [MicaReconModel(device='cpu', backend=backend) for backend in backends]
+
+    return [DecaReconModel(name, device='cpu', backend=backend) for backend in backends]
+
+
+def _inputs(name, batch_size):
+    if name == 'mica':
+        return (torch.rand(batch_size, 3, 112, 112) * 2 - 1,)
+
+    tform = np.tile([[0.5, 0, 10], [0, 0.5, 5], [0, 0, 1]], (batch_size, 1, 1))
+    return torch.rand(batch_size, 3, 224, 224), tform, np.tile([640, 480], (batch_size, 1))
+
+
+@pytest.mark.parametrize("name", ['mica', 'emoca-coarse', 'deca-dense'])
+def test_onnx_backend(name, synthetic_models):
+
+    pytest.importorskip('onnxruntime')
+
+    torch.manual_seed(0)
+    models = _create_models(name, ('torch', 'onnx'))
+
+    # The graphs are exported with a batch size of 2, but have a dynamic batch size
+    for batch_size in (1, 2, 3):
+        inputs = _inputs(name, batch_size)
+        out = [model.reconstruct(*inputs) for model in models]
+        assert(out[0].keys() == out[1].keys())
+        for key, value in out[0].items():
+            np.testing.assert_allclose(out[1][key], value, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("name", ['mica', 'emoca-coarse'])
+def test_jit_backend(name, synthetic_models):
+
+    torch.manual_seed(0)
+    models = _create_models(name, ('torch', 'jit'))
+    graph = models[1]._encoder_graph
+
+    # The graphs are traced once for each (new) batch size
+    for batch_size, traced in [(2, [2]), (3, [2, 3]), (2, [2, 3])]:
+        inputs = _inputs(name, batch_size)
+        out = [model.reconstruct(*inputs) for model in models]
+        assert(graph.batch_sizes == traced)
+        assert(out[0].keys() == out[1].keys())
+        for key, value in out[0].items():
+            np.testing.assert_allclose(out[1][key], value, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+
+from flame.io import ChunkedStore
+
+
+def test_chunked_store(tmp_path):
+
+    store = ChunkedStore(tmp_path, n_frames=10, chunk_size=4, meta={'name': 'emoca-coarse'})
+    assert(store.n_chunks == 3 and store.chunk_range(2) == (8, 10))
+
+    store.write(0, v=np.zeros((4, 2)))
+    assert(store.is_done(0) and store.todo() == [1, 2])
+
+    # A chunk written by a worker that was interrupted before marking it as done
+    # (and a temporary file that was never completed) when resuming
+    store.write_chunk(1, v=np.ones((4, 2)))
+    (tmp_path / 'chunk_000002.tmp.npz').touch()
+    store = ChunkedStore(tmp_path, n_frames=10, chunk_size=4, meta={'name': 'emoca-coarse'})
+    assert(store.todo() == [2])
+
+    out = ChunkedStore(tmp_path).load()
+    np.testing.assert_array_equal(out['v'], np.r_[np.zeros((4, 2)), np.ones((4, 2))])
+
+    with pytest.raises(ValueError):
+        ChunkedStore(tmp_path, n_frames=10, chunk_size=8, meta={'name': 'emoca-coarse'})
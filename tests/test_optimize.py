@@ -0,0 +1,57 @@
+import copy
+import torch
+import pytest
+
+from flame.deca.encoders import ResnetEncoder
+from flame.mica.encoders import Arcface
+from flame.optimize import fold_batchnorm
+
+
+@pytest.mark.parametrize("model", ['resnet', 'arcface'])
+def test_fold_batchnorm(model):
+
+    torch.manual_seed(0)
+    if model == 'resnet':
+        model, img_size = ResnetEncoder(outsize=236), 224
+    else:
+        model, img_size = Arcface(), 112
+
+    # Randomize batch norm statistics, otherwise folding is (almost) a no-op
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            torch.nn.init.kaiming_normal_(module.weight)
+            module.weight.data *= 0.5
+        elif isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            module.running_mean.normal_(0, 0.1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.normal_(0, 0.1)
+
+    model.eval()
+    folded = fold_batchnorm(copy.deepcopy(model))
+    assert(not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in folded.modules()))
+
+    img = torch.rand(2, 3, img_size, img_size)
+    with torch.inference_mode():
+        torch.testing.assert_close(folded(img), model(img), atol=1e-4, rtol=1e-4)
+
+
+def test_quantize_deca(synthetic_models, tmp_path):
+
+    import numpy as np
+    from PIL import Image
+    from flame import DecaReconModel
+
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        img = rng.integers(0, 256, size=(224, 224, 3), dtype=np.uint8)
+        Image.fromarray(img).save(tmp_path / f'crop_{i}.png')
+
+    model = DecaReconModel('emoca-coarse', device='cpu', encoder_mode='sequential')
+    namespace = model._cache_namespace
+    report = model.quantize(tmp_path, batch_size=2)
+    assert(report['n_images'] == 4 and report['accepted'])
+
+    # Cached encodings of the original encoders are not reused
+    assert(model._cache_namespace != namespace)
+    assert(model.reconstruct(torch.rand(1, 3, 224, 224))['v'].shape == (1, 5023, 3))
@@ -0,0 +1,12 @@
+import pytest
+
+from flame.pipeline import _split_segments
+
+
+@pytest.mark.parametrize("chunks,n_segments,expected", [
+    ([0, 1, 2, 3, 4, 5], 2, [[0, 1, 2], [3, 4, 5]]),
+    ([0, 1, 2, 3, 5, 6, 9], 2, [[0, 1, 2, 3], [5, 6], [9]]),  # split on finished chunks
+    ([0, 1], 4, [[0], [1]])
+])
+def test_split_segments(chunks, n_segments, expected):
+    assert(_split_segments(chunks, n_segments) == expected)
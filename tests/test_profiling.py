@@ -0,0 +1,88 @@
+import mmap
+import time
+import torch
+import pytest
+import threading
+import numpy as np
+
+from flame.profiling import Profiler, stage, _resident_memory
+
+
+def test_profiler():
+
+    calls = []
+    with stage('inactive'):
+        pass
+
+    with Profiler(callback=lambda *args: calls.append(args)) as prof:
+        for _ in range(4):
+            with stage('outer'):
+                with stage('inner'):
+                    time.sleep(0.01)
+
+        # Stages in other threads are not recorded (each thread has its own context)
+        def run():
+            with stage('thread'):
+                pass
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        # Failed stages are not recorded either
+        with pytest.raises(RuntimeError), stage('failed'):
+            raise RuntimeError
+
+    with stage('after'):
+        pass
+
+    # Inner stages finish (and are recorded) first
+    assert([name for name, _, _ in calls] == ['inner', 'outer'] * 4)
+    assert(all(mem is None for _, _, mem in calls))
+    assert(list(prof.times) == ['inner', 'outer'])
+
+    summary = prof.summary(percentiles=(50, 100))
+    for name in ('inner', 'outer'):
+        times = np.array(prof.times[name]) * 1000
+        assert(summary[name]['n'] == 4 and summary[name]['p100_ms'] == times.max())
+        assert(summary[name]['mean_ms'] >= 10 and 'peak_mb' not in summary[name])
+
+    assert(summary['outer']['total_ms'] >= summary['inner']['total_ms'])
+    assert('inner' in prof.report() and 'p50_ms' in prof.report())
+
+
+def test_profiler_memory():
+
+    if _resident_memory() is None:
+        pytest.skip("Resident memory is not available on this platform")
+
+    with Profiler(memory=True) as prof:
+        with stage('allocate'):
+            # New anonymous memory (i.e., not reused from the heap) of which all pages
+            # are touched, so that they are resident
+            buf = mmap.mmap(-1, 64 * 2 ** 20)
+            np.frombuffer(buf, dtype=np.uint8)[:] = 1
+
+        with stage('noop'):
+            pass
+
+    # Per stage, so not the memory of everything allocated before the stage
+    assert(prof.memory['allocate'][0] >= 48 * 2 ** 20)
+    assert(prof.memory['noop'][0] < 16 * 2 ** 20)
+    assert(prof.summary()['allocate']['peak_mb'] >= 48)
+    buf.close()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_profiler_cuda_memory():
+
+    with Profiler(memory=True) as prof:
+        with stage('outer', 'cuda'):
+            x = torch.empty(64 * 2 ** 20, dtype=torch.uint8, device='cuda')
+            del x
+            with stage('inner', 'cuda'):
+                y = torch.empty(2 ** 20, dtype=torch.uint8, device='cuda')
+
+    # Resetting the peak for the inner stage does not affect the peak of the outer stage
+    assert(prof.memory['outer'][0] >= 64 * 2 ** 20 > prof.memory['inner'][0])
+    del y
@@ -50,3 +50,171 @@ def test_deca_recon(name, device, example_img):
     else:
         assert(out['v'].shape == (5023, 3))
 
+
+@pytest.mark.parametrize("name", ['mica', 'deca-dense', 'emoca-coarse'])
+@pytest.mark.parametrize("device", ['cpu'])
+def test_output_backend(name, device, synthetic_models):
+
+    torch.manual_seed(0)
+    if name == 'mica':
+        models = [MicaReconModel(device=device, output_backend=out) for out in ('numpy', 'torch')]
+        img = torch.rand(1, 3, 112, 112) * 2 - 1
+        kwargs = {}
+    else:
+        models = [DecaReconModel(name, device=device, output_backend=out) for out in ('numpy', 'torch')]
+        img = torch.rand(1, 3, 224, 224)
+        kwargs = {'tform': np.eye(3), 'img_size': (640, 480)}
+
+    out_np = models[0].reconstruct(img, **kwargs)
+    out_torch = models[1].reconstruct(img, **kwargs)
+
+    for key in ('v', 'mat'):
+        assert(torch.is_tensor(out_torch[key]) and out_torch[key].device.type == device)
+        np.testing.assert_allclose(out_torch[key].cpu().numpy(), out_np[key], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("name", ['mica', 'emoca-coarse'])
+def test_bfloat16(name, synthetic_models):
+
+    torch.manual_seed(0)
+    if name == 'mica':
+        models = [MicaReconModel(device='cpu', precision=p) for p in ('float32', 'bfloat16')]
+        img = torch.rand(2, 3, 112, 112) * 2 - 1
+    else:
+        models = [DecaReconModel(name, device='cpu', precision=p) for p in ('float32', 'bfloat16')]
+        img = torch.rand(2, 3, 224, 224)
+
+    # The (shared) folded encoders of the float32 model should not be converted to
+    # the channels last format of the bfloat16 model
+    for model, memory_format in zip(models, (torch.contiguous_format, torch.channels_last)):
+        convs = [m for m in vars(model).values() if isinstance(m, torch.nn.Module)]
+        convs = [m for module in convs for m in module.modules() if isinstance(m, torch.nn.Conv2d)]
+        assert(convs and all(m.weight.is_contiguous(memory_format=memory_format) for m in convs))
+
+    # Each bfloat16 operation has a relative error of (at most) 2^-8
+    with torch.inference_mode():
+        enc = [model._encode(img) for model in models]
+
+    if name == 'mica':
+        enc = [{'shape': e} for e in enc]
+
+    for key, value in enc[0].items():
+        assert(enc[1][key].dtype == torch.float32)
+        assert((enc[1][key] - value).norm() / value.norm() < 0.02)
+
+
+@pytest.mark.parametrize("name", ['mica', 'emoca-coarse'])
+def test_reconstruct_threads(name, synthetic_models):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    torch.manual_seed(0)
+    if name == 'mica':
+        model = MicaReconModel(device='cpu')
+        inputs = [(torch.rand(1, 3, 112, 112) * 2 - 1,) for _ in range(8)]
+    else:
+        model = DecaReconModel(name, device='cpu')
+        inputs = [(torch.rand(1, 3, 224, 224), np.array([[s, 0, 10 * s], [0, s, 5 * s], [0, 0, 1]]),
+                   (640, 480)) for s in np.linspace(0.5, 2, 8)]
+
+    expected = [model.reconstruct(*args) for args in inputs]
+
+    # A single model shared by multiple threads (each input multiple times)
+    with ThreadPoolExecutor(4) as pool:
+        outs = list(pool.map(lambda args: model.reconstruct(*args), inputs * 3))
+
+    for out, exp in zip(outs, expected * 3):
+        for key in ('v', 'mat'):
+            np.testing.assert_allclose(out[key], exp[key], rtol=1e-5, atol=1e-5)
+
+    # The stateful `__call__` gives the same results
+    if name != 'mica':
+        model.tform, model.img_size = inputs[0][1:]
+
+    out = model(inputs[0][0])
+    for key in ('v', 'mat'):
+        np.testing.assert_allclose(out[key], expected[0][key][0], rtol=1e-5, atol=1e-5)
+
+
+def test_identity_locked(synthetic_models):
+
+    from flame import IdentityLockedReconModel
+    from flame.decoders import FLAME
+
+    torch.manual_seed(0)
+    model = IdentityLockedReconModel('emoca-coarse', device='cpu')
+    img = torch.rand(2, 3, 224, 224)
+    tform, img_size = np.array([[0.5, 0, 10], [0, 0.5, 5], [0, 0, 1]]), (640, 480)
+
+    with pytest.raises(ValueError):
+        model.reconstruct(img, tform, img_size)
+
+    shape = model.set_identity(torch.rand(3, 3, 112, 112) * 2 - 1)
+    assert(shape.shape == (1, 300))
+    out = model.reconstruct(img, tform, img_size)
+
+    # Same as decoding the DECA expression and pose together with the MICA shape
+    # in a FLAME model with all 300 shape components
+    ref = DecaReconModel('emoca-coarse', device='cpu')
+    ref.D_flame = FLAME(ref.cfg['flame_path'], n_shape=300, n_exp=50).eval()
+    with torch.inference_mode():
+        enc = ref._encode(img)
+        enc['shape'] = shape.expand(img.shape[0], -1)
+        expected = ref._decode(enc, tform, img_size)
+
+    for key in ('v', 'mat'):
+        np.testing.assert_allclose(out[key], expected[key], rtol=1e-4, atol=1e-4)
+
+
+def test_reconstruct_faces(synthetic_models):
+
+    from flame.crop import BaseModel
+
+    torch.manual_seed(0)
+    model = DecaReconModel('emoca-coarse', device='cpu')
+
+    # Two faces in the first image, none in the second and fourth, one in the third
+    faces = [(i, {'img_crop': torch.rand(1, 3, 224, 224),
+                  'tform': np.array([[[s, 0, 10 * s], [0, s, 5 * s], [0, 0, 1]]]),
+                  'img_size': np.array([[640, 480]])})
+             for i, s in zip((0, 0, 2), (0.5, 1, 2))]
+
+    crops = BaseModel._stack_faces(faces, 4)
+    out = model.reconstruct_faces(crops)
+    assert(len(out) == 4 and out[1] is None and out[3] is None)
+    assert(out[0]['v'].shape[0] == 2 and out[2]['v'].shape[0] == 1)
+
+    # Same as reconstructing each face separately
+    for (i, face), j in zip(faces, (0, 1, 0)):
+        expected = model.reconstruct(face['img_crop'], face['tform'], face['img_size'])
+        for key in ('v', 'mat'):
+            np.testing.assert_allclose(out[i][key][j], expected[key][0], rtol=1e-4, atol=1e-4)
+
+    assert(model.reconstruct_faces(BaseModel._stack_faces([], 2)) == [None, None])
+
+
+@pytest.mark.parametrize("encoder_mode", ['stacked', 'threaded'])
+def test_encoder_mode(encoder_mode, synthetic_models):
+
+    torch.manual_seed(0)
+    models = [DecaReconModel('emoca-coarse', device='cpu', encoder_mode=mode)
+              for mode in ('sequential', encoder_mode)]
+    img = torch.rand(2, 3, 224, 224)
+    tform, img_size = np.array([[0.5, 0, 10], [0, 0.5, 5], [0, 0, 1]]), (640, 480)
+
+    with torch.inference_mode():
+        enc = [model._encode(img) for model in models]
+
+    # Emoca has multiple encoders, so they are actually stacked/threaded
+    if encoder_mode == 'stacked':
+        assert(models[1].E_stacked is not None)
+    else:
+        assert(models[1]._encoder_executor is not None)
+
+    assert(enc[0].keys() == enc[1].keys())
+    for key, value in enc[0].items():
+        torch.testing.assert_close(enc[1][key], value, rtol=1e-4, atol=1e-5)
+
+    out = [model.reconstruct(img, tform, img_size) for model in models]
+    for key in ('v', 'mat'):
+        np.testing.assert_allclose(out[1][key], out[0][key], rtol=1e-4, atol=1e-4)
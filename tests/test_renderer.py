@@ -0,0 +1,65 @@
+import torch
+from flame.renderer import rasterize, CudaRenderer
+
+
+def test_rasterize_depth_test():
+
+    # Two overlapping triangles; the second one is closer to the camera
+    tri = torch.tensor([[0., 0., 2.], [15., 0., 2.], [0., 15., 2.]])
+    f_vs = torch.stack([tri, tri - torch.tensor([0., 0., 1.])])[None]
+    depth, triangle, baryw = rasterize(f_vs, 16, 16)
+
+    assert(depth.shape == (1, 16, 16) and baryw.shape == (1, 16, 16, 3))
+    assert((triangle[0, :5, :5] == 1).all())
+    assert(torch.allclose(depth[0, :5, :5], torch.tensor(1.)))
+    assert((triangle[0, -1, -1] == -1) and (depth[0, -1, -1] == 1e6))
+    assert(torch.allclose(baryw[triangle > -1].sum(dim=-1), torch.tensor(1.)))
+
+
+def test_renderer_cpu():
+
+    v = torch.tensor([[[-0.5, -0.5, 0.], [0.5, -0.5, 0.], [0., 0.5, 0.]]])
+    f = torch.tensor([[[0, 1, 2]]], dtype=torch.int32)
+    attrs = torch.ones(1, 1, 3, 3)
+
+    renderer = CudaRenderer(32, device='cpu')
+    assert(renderer.backend == 'torch')
+    img = renderer(v, f, attrs)
+    assert(img.shape == (1, 4, 32, 32))
+    assert(img[0, 3].sum() > 0)
+
+
+def test_uv_table():
+
+    from pathlib import Path
+    from flame.uv import UVRasterTable
+    from flame.utils import load_obj, face_vertices
+
+    _, uvcoords, faces, uvfaces = load_obj(Path(__file__).parents[1] / 'flame/data/head_template.obj')
+    table = UVRasterTable(uvcoords, uvfaces, faces, size=64, device='cpu')
+    attr = torch.rand(2, faces.max() + 1, 3)
+    uv_attr = table.world2uv(attr)
+
+    # Should be the same as rasterizing the UV layout with the face attributes
+    uv = torch.cat([uvcoords, torch.ones_like(uvcoords[..., :1])], dim=-1) * 2 - 1
+    uv[..., 1] = -uv[..., 1]
+    renderer = CudaRenderer(64, device='cpu')
+    expected = renderer(uv.expand(2, -1, -1), uvfaces.expand(2, -1, -1),
+                        face_vertices(attr, faces.expand(2, -1, -1)))[:, :3]
+    assert(torch.allclose(uv_attr, expected))
+
+
+def test_qc_renderer():
+
+    import numpy as np
+    from flame.qc import QCRenderer
+
+    # Single triangle in front of the camera (in world space) and one frame without mesh
+    v = np.array([[[-0.5, -0.5, 0.], [0.5, -0.5, 0.], [0., 0.5, 0.]], np.full((3, 3), np.nan)])
+    renderer = QCRenderer(faces=[[0, 1, 2]], device='cpu', scale=0.5, alpha=1.)
+    frames = np.zeros((2, 64, 64, 3), dtype=np.uint8)
+    out = renderer.render(frames, v=v)
+
+    assert(out.shape == (2, 32, 32, 3))
+    assert(out[0, 16, 16].sum() > 0 and out[0, 0, 0].sum() == 0)
+    assert(out[1].sum() == 0)
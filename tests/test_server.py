@@ -0,0 +1,127 @@
+import cv2
+import json
+import torch
+import asyncio
+import numpy as np
+
+from flame.server import MicroBatcher, ReconServer
+
+
+def test_micro_batcher():
+
+    batches = []
+
+    def fn(items):
+        batches.append(list(items))
+        if 'fail' in items:
+            raise RuntimeError("Batch failed!")
+
+        return [ValueError(item) if item.startswith('bad') else item.upper() for item in items]
+
+    async def run():
+        batcher = MicroBatcher(fn, max_batch_size=2, max_wait=0.05)
+        task = asyncio.create_task(batcher.run())
+
+        # Full batches are processed right away, the rest after `max_wait`
+        results = await asyncio.gather(*[batcher.submit(item) for item in 'abcde'])
+        assert(results == list('ABCDE') and [len(b) for b in batches] == [2, 2, 1])
+
+        # Requests that arrive later than `max_wait` after the first are not batched
+        batches.clear()
+        first = asyncio.create_task(batcher.submit('a'))
+        await asyncio.sleep(0.2)
+        assert(await asyncio.gather(first, batcher.submit('b')) == ['A', 'B'])
+        assert(batches == [['a'], ['b']])
+
+        # Exceptions only affect their own request, unless the whole batch fails
+        results = await asyncio.gather(batcher.submit('bad'), batcher.submit('c'),
+                                       return_exceptions=True)
+        assert(isinstance(results[0], ValueError) and results[1] == 'C')
+        results = await asyncio.gather(batcher.submit('fail'), batcher.submit('d'),
+                                       return_exceptions=True)
+        assert(all(isinstance(r, RuntimeError) for r in results))
+
+        task.cancel()
+
+    asyncio.run(run())
+
+
+class StubCropModel:
+    """ Crops any image, unless it is black (no face). """
+    def crop(self, img):
+        if img.max() == 0:
+            raise ValueError("Could not detect any faces!")
+
+        h, w = img.shape[:2]
+        return {'img_crop': torch.zeros(1, 3, 224, 224), 'tform': np.eye(3)[None],
+                'img_size': np.array([[w, h]])}
+
+
+class StubReconModel:
+    """ Returns the image width as vertices. """
+    def warmup(self, batch_sizes):
+        pass
+
+    def reconstruct(self, img_crop, tform, img_size):
+        v = np.repeat(img_size[:, None, :1], 3, axis=2).astype(np.float64)
+        return {'v': v, 'mat': np.tile(np.eye(4), (len(img_crop), 1, 1))}
+
+
+class StubServer(ReconServer):
+    def _load_models(self):
+        self.crop_model, self.recon_model = StubCropModel(), StubReconModel()
+
+
+async def _request(port, data):
+    """ Sends raw request data and returns the status and (JSON) response. """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    head, body = (await reader.read()).split(b'\r\n\r\n', 1)
+    writer.close()
+    return int(head.split(b' ')[1]), json.loads(body)
+
+
+def _post(body, path='/reconstruct'):
+    return (f'POST {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n').encode() + body
+
+
+def test_server():
+
+    server = StubServer(device='cpu', max_batch_size=4, max_body_size=2 ** 20)
+    img = np.full((48, 64, 3), 128, dtype=np.uint8)
+    png = cv2.imencode('.png', img)[1].tobytes()
+    black = cv2.imencode('.png', img * 0)[1].tobytes()
+
+    async def run():
+        tcp = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = tcp.sockets[0].getsockname()[1]
+        task = asyncio.create_task(server.batcher.run())
+
+        status, out = await _request(port, b'GET /health HTTP/1.1\r\nConnection: close\r\n\r\n')
+        assert(status == 200 and out == {'status': 'ok'})
+
+        # Concurrent requests (in micro-batches)
+        results = await asyncio.gather(*[_request(port, _post(png)) for _ in range(6)])
+        for status, out in results:
+            assert(status == 200 and np.array(out['v']).shape == (1, 3) and out['v'][0][0] == 64)
+
+        expected = {
+            _post(png, '/unknown'): 404,
+            _post(b'not an image'): 422,
+            _post(black): 422,  # no face
+            b'GARBAGE\r\n\r\n': 400,
+            b'POST /reconstruct HTTP/1.1\r\nbad header\r\n\r\n': 400,
+            b'POST /reconstruct HTTP/1.1\r\nContent-Length: -1\r\n\r\n': 400,
+            b'POST /reconstruct HTTP/1.1\r\nContent-Length: 1073741824\r\n\r\n': 413,
+        }
+        for data, expected_status in expected.items():
+            status, out = await _request(port, data)
+            assert(status == expected_status and 'error' in out)
+
+        task.cancel()
+        tcp.close()
+        await tcp.wait_closed()
+
+    asyncio.run(run())
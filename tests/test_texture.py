@@ -0,0 +1,87 @@
+import torch
+import numpy as np
+
+from flame.io import ChunkedStore
+from flame.texture import TextureExtractor, average_store_textures
+
+
+def _grid(x, y, z, n=5):
+    """ Creates a (camera facing) n x n grid of vertices and its faces. """
+    xx, yy = np.meshgrid(np.linspace(-x, x, n), np.linspace(-y, y, n))
+    v = np.c_[xx.ravel(), yy.ravel(), np.full(n * n, z)]
+    idx = np.arange(n * n).reshape(n, n)
+    a, b, c, d = idx[:-1, :-1].ravel(), idx[:-1, 1:].ravel(), idx[1:, :-1].ravel(), idx[1:, 1:].ravel()
+    return v, np.r_[np.c_[a, b, d], np.c_[a, d, c]]
+
+
+def test_texture_occlusion():
+
+    # A small grid in front of a larger one (one world unit is 24 pixels), with a UV
+    # map in which each vertex is a texel
+    v_front, f_front = _grid(0.5, 0.5, 1.)
+    v_back, f_back = _grid(1.2, 0.8, 0.)
+    v = torch.tensor(np.r_[v_front, v_back], dtype=torch.float32)[None]
+    faces = torch.tensor(np.r_[f_front, f_back + len(v_front)])
+
+    def to_uv(attr):
+        return attr.permute(0, 2, 1).reshape(attr.shape[0], attr.shape[2], 10, 5)
+
+    # An image with linear gradients, which are sampled exactly (with bilinear
+    # interpolation)
+    extractor = TextureExtractor(faces, to_uv, device='cpu')
+    y, x = np.mgrid[:48, :64]
+    img = np.stack([2 * x, 3 * y, x + y], axis=-1).astype(np.uint8)
+    textures, masks = extractor.extract([img], v, np.array([[64, 48]]))
+
+    # All texels of the front grid are visible, while those of the back grid are only
+    # visible outside the front grid
+    occluded = ((np.abs(v_back[:, 0]) < 0.5) & (np.abs(v_back[:, 1]) < 0.5)).reshape(5, 5)
+    expected = np.r_[np.ones((5, 5), dtype=bool), ~occluded]
+    assert(occluded.sum() == 3)
+    np.testing.assert_array_equal(masks[0].numpy(), expected)
+
+    # Visible texels sample the image at their vertex, others are zero
+    x, y = 31.5 + 24 * v[0, :, 0].numpy(), 23.5 - 24 * v[0, :, 1].numpy()
+    sampled = np.stack([2 * x, 3 * y, x + y]).reshape(3, 10, 5) / 255.
+    np.testing.assert_allclose(textures[0].numpy(), sampled * expected, atol=1e-6)
+
+
+def test_texture_synthetic(synthetic_models):
+
+    from flame import DecaReconModel
+
+    model = DecaReconModel('emoca-coarse', device='cpu')
+    extractor = TextureExtractor.from_model(model)
+
+    # The (frontal) template head and the same head turned around, in a 640 x 480 image
+    v = model.D_flame.v_template.float().cpu()
+    v = (v - v.mean(dim=0)) * 4
+    v = torch.stack([v, v * torch.tensor([-1., 1., -1.])])
+    images = [np.full((480, 640, 3), 128, dtype=np.uint8)] * 2
+    textures, masks = extractor.extract(images, v, np.array([[640, 480]] * 2))
+
+    assert(textures.shape == (2, 3, 256, 256) and masks.shape == (2, 256, 256))
+    assert(masks[0].any() and masks[1].any())
+    # Texels visible from the front are occluded from the back (and vice versa)
+    assert(not (masks[0] & masks[1]).any())
+    assert(torch.all(textures.sum(dim=1)[~masks] == 0))
+
+
+def test_average_store_textures(tmp_path):
+
+    store = ChunkedStore(tmp_path, n_frames=6, chunk_size=2)
+    assert(average_store_textures(store) == (None, None))
+
+    # Texel 0 is visible in all frames, texel 1 only in the first frame, and texel 2 in
+    # none; the last chunk is not finished
+    masks = np.zeros((6, 1, 3), dtype=bool)
+    masks[:, 0, 0], masks[0, 0, 1] = True, True
+    textures = np.zeros((6, 1, 3, 3), dtype=np.uint8)
+    textures[:, 0, 0] = [[51], [102], [153], [204], [255], [255]]
+    textures[0, 0, 1] = 255
+    for idx in range(2):
+        store.write(idx, texture=textures[2 * idx:2 * idx + 2], texture_mask=masks[2 * idx:2 * idx + 2])
+
+    texture, count = average_store_textures(store)
+    np.testing.assert_array_equal(count.numpy(), [[4, 1, 0]])
+    np.testing.assert_allclose(texture[:, 0].numpy().T, [[0.5] * 3, [1.] * 3, [0.] * 3])
@@ -0,0 +1,27 @@
+import torch
+
+from flame import MicaReconModel
+from flame.tuning import autotune, load_tuning, apply_tuning
+
+
+def test_tuning(synthetic_models):
+
+    model = MicaReconModel(device='cpu')
+    assert(load_tuning(model) is None)
+
+    # The result is persisted (in the cache directory) for the current machine
+    best = autotune(model, batch_sizes=(1, 2), n_threads=(1, 2), n_iter=1)
+    assert(len(best['results']) == 4)
+    assert(load_tuning(model) == best)
+    assert(load_tuning(MicaReconModel(device='cpu')) == best)
+
+    # ... and per model (settings)
+    assert(load_tuning(MicaReconModel(device='cpu', backend='jit')) is None)
+    assert(load_tuning(MicaReconModel(device='cpu', precision='bfloat16')) is None)
+
+    n_threads = torch.get_num_threads()
+    try:
+        assert(apply_tuning(model, warmup=False) == best)
+        assert(torch.get_num_threads() == best['n_threads'])
+    finally:
+        torch.set_num_threads(n_threads)